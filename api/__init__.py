@@ -1,33 +1,99 @@
 from flask import Flask
-from flask_restx import Api
 from .orders.views import order_namespace
 from .auth.views import auth_namespace
+from .auth.identity import init_identity_cache
+from .auth.hashing import init_password_hasher
+from .auth.tokens import CachingJWTManager, init_token_revocation
+from .orders.cache import init_order_cache
+from .orders.events import init_event_broker
+from .orders.idempotency import init_idempotency_store
+from .orders.kitchen import init_kitchen_queue
+from .orders.archive import orders_cli
+from .orders.jobs import order_webhook
 #locate the config dir, config fie and import config_dict
-from .config.config import config_dict
+from .config.config import config_dict, get_config
 from .utils import db
+from .utils.sqlite import init_sqlite_pragmas
+from .utils.docs import CachedSpecApi
+from .utils.encoding import output_fast_json
+from .utils.instrumentation import init_instrumentation
+from .utils.ratelimit import init_rate_limits
+from .utils.replica import init_read_replica
+from .utils.jobs import init_job_queue, jobs_cli
 from .models.orders import Order
 from .models.users import User
+from .models.rollups import OrderRollup
+from .models.tokens import TokenRevocation
+from .models.idempotency import IdempotencyKey
+from .models.archive import OrderArchive
+from .models.jobs import Job, DeadJob
 #flask migrate helps us to modify our database without having to delete it
 from flask_migrate import Migrate
-from flask_jwt_extended import JWTManager
 # error handling library
 from werkzeug.exceptions import NotFound, MethodNotAllowed
+from werkzeug.middleware.proxy_fix import ProxyFix
+from werkzeug.utils import import_string
 
 
-def create_app(config=config_dict['dev']):
+# the config profile is picked by the FLASK_CONFIG environment variable (dev, prod or test) unless one is passed in
+def create_app(config=None):
     app = Flask(__name__)
 
-    app.config.from_object(config)
+    app.config.from_object(config or get_config())
+
+    # request.remote_addr is the client's address behind PROXY_FIX_X_FOR trusted proxies
+    if app.config['PROXY_FIX_X_FOR']:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_FIX_X_FOR'])
+
+    # a pool class named by its dotted path in the config is imported, into a copy so the config class is left as is
+    engine_options = app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {}
+
+    if isinstance(engine_options.get('poolclass'), str):
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = dict(engine_options, poolclass=import_string(engine_options['poolclass']))
+
+    # the read replica is a bind of db, so it's set up first
+    init_read_replica(app)
 
     #telling db, this is our app
     db.init_app(app)
 
-    #
-    jwt = JWTManager(app)
+    # WAL, busy timeout, etc. on SQLite connections
+    init_sqlite_pragmas(app)
+
+    # verified tokens are cached by CachingJWTManager
+    jwt = CachingJWTManager(app)
+
+    # logged out tokens and the tokens of deactivated users are refused
+    init_token_revocation(app, jwt)
+
+    # cache of the current user looked up by order endpoints
+    init_identity_cache(app)
+
+    # hashes passwords for signup and login, off the request thread when workers are configured
+    init_password_hasher(app)
+
+    # marshalled orders served to pollers, invalidated when an order changes
+    init_order_cache(app)
+
+    # responses of order creations sent with an Idempotency-Key, replayed to retries
+    init_idempotency_store(app)
+
+    # order changes published to the clients streaming /orders/user/<user_id>/events
+    init_event_broker(app)
+
+    # PENDING orders in the order the kitchen makes them, loaded on first use
+    init_kitchen_queue(app)
+
+    # side effects of committed changes run in the background, from the jobs table
+    init_job_queue(app)
     
     #takes two 
     migrate = Migrate(app, db)
 
+    # flask orders archive/export and flask jobs work/retry, next to the flask db commands
+    app.cli.add_command(orders_cli)
+    app.cli.add_command(jobs_cli)
+
     authorizations = {
         "Bearer Auth": {
             "type" : "apiKey",
@@ -38,13 +104,27 @@ def create_app(config=config_dict['dev']):
         
     }
 
-    api = Api(app, 
+    # the Swagger UI and swagger.json, left out altogether when API_DOCS is off
+    docs = app.config['API_DOCS']
+
+    api = CachedSpecApi(app, 
               title = "Pizza Delivery API",
               description= "A simple pizza delivery REST API service",
               authorizations= authorizations, 
-              security= "Bearer Auth"
+              security= "Bearer Auth",
+              doc = "/" if docs else False,
+              add_specs = docs
             )
 
+    if app.config['FAST_JSON_RESPONSES']:
+        api.representations['application/json'] = output_fast_json
+
+    # Server-Timing header, slow query log and Prometheus metrics
+    init_instrumentation(app, api, jwt)
+
+    # per client rate limits and load shedding, after the instrumentation so refused requests are counted too
+    init_rate_limits(app)
+
     api.add_namespace(order_namespace)
     api.add_namespace(auth_namespace, path="/auth")
 
@@ -0,0 +1,67 @@
+import atexit
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from threading import BoundedSemaphore, Lock
+from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.utils import import_string
+from ..utils.jobs import PROCESS_START_METHOD
+
+
+# hashes and checks passwords with werkzeug, in a pool of worker processes when workers > 0
+# so the CPU-heavy key derivation doesn't hold the GIL of the process serving requests
+class WerkzeugPasswordHasher:
+
+    def __init__(self, method='pbkdf2:sha256:260000', salt_length=16, workers=0, max_pending=None):
+        self.method = method
+        self.salt_length = salt_length
+        self.workers = workers
+        # callers beyond this many block until a slot frees up instead of piling work onto the pool
+        self._slots = BoundedSemaphore(max_pending or max(workers, 1) * 4)
+        self._pool = None
+        self._pool_lock = Lock()
+
+    def _run(self, function, *args):
+        if not self.workers:
+            return function(*args)
+
+        with self._slots:
+            return self._get_pool().submit(function, *args).result()
+
+    # the pool is started on first use so it is created in the serving process, not before a fork, and its
+    # processes are started like the job runner's rather than forked from the serving process
+    def _get_pool(self):
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context(PROCESS_START_METHOD)
+                )
+                atexit.register(self.shutdown)
+
+            return self._pool
+
+    def shutdown(self):
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method, self.salt_length)
+
+    def verify(self, password_hash, password):
+        return self._run(check_password_hash, password_hash, password)
+
+    # a hash made with other parameters than the configured ones should be replaced on the next login
+    def needs_rehash(self, password_hash):
+        return password_hash.split('$', 1)[0] != self.method
+
+
+def init_password_hasher(app):
+    hasher_class = import_string(app.config['PASSWORD_HASHER'])
+
+    app.extensions['password_hasher'] = hasher_class(
+        method=app.config['PASSWORD_HASH_METHOD'],
+        salt_length=app.config['PASSWORD_SALT_LENGTH'],
+        workers=app.config['PASSWORD_HASH_WORKERS'],
+        max_pending=app.config['PASSWORD_HASH_MAX_PENDING']
+    )
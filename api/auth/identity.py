@@ -0,0 +1,73 @@
+from collections import namedtuple
+from flask import current_app, g, has_app_context
+from flask_jwt_extended import get_jwt, get_jwt_identity
+from sqlalchemy import event
+from ..models.users import User
+from ..utils import db
+from ..utils.cache import TTLCache
+
+# the few user columns a request needs, cached instead of the User object itself
+Identity = namedtuple('Identity', ['id', 'username', 'is_active', 'is_staff'])
+IDENTITY_COLUMNS = (User.id, User.username, User.is_active, User.is_staff)
+
+
+def init_identity_cache(app):
+    app.extensions['identity_cache'] = TTLCache(
+        maxsize=app.config['IDENTITY_CACHE_SIZE'],
+        ttl=app.config['IDENTITY_CACHE_TTL']
+    )
+
+    # g outlives the request when an app context is shared (e.g. the test client), so start every request clean
+    @app.before_request
+    def reset_identity():
+        g.pop('identity', None)
+
+
+# claims added to every token so the user id is known without a query
+def identity_claims(user):
+    return {'user_id': user.id}
+
+
+def load_identity(user_id):
+    row = db.session.query(*IDENTITY_COLUMNS).filter(User.id == user_id).first()
+
+    return Identity(*row) if row is not None else None
+
+
+# identity of the user making the request, memoized on g for the request and in the process-level cache
+# returns None when the token has no user behind it (or the user was removed)
+def current_identity():
+    if 'identity' in g:
+        return g.identity
+
+    user_id = get_jwt().get('user_id')
+
+    if user_id is None:
+        # tokens issued before user_id was added to the claims only carry the username
+        row = db.session.query(*IDENTITY_COLUMNS).filter_by(username=get_jwt_identity()).first()
+        identity = Identity(*row) if row is not None else None
+    else:
+        cache = current_app.extensions['identity_cache']
+        identity = cache.get(user_id)
+
+        if identity is None:
+            identity = load_identity(user_id)
+
+            if identity is not None:
+                cache.set(user_id, identity)
+
+    g.identity = identity
+
+    return identity
+
+
+def invalidate_identity(user_id):
+    if has_app_context() and 'identity_cache' in current_app.extensions:
+        current_app.extensions['identity_cache'].delete(user_id)
+
+
+# any change to a user (deactivation included) or its removal drops the cached identity
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def user_changed(mapper, connection, target):
+    invalidate_identity(target.id)
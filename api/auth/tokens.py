@@ -0,0 +1,249 @@
+import hashlib
+import inspect
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+from threading import Lock
+from flask import current_app, has_app_context
+from flask_jwt_extended import JWTManager
+from flask_jwt_extended.config import config as jwt_config
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from ..models.tokens import TokenRevocation
+from ..models.users import User
+from ..utils import db
+from ..utils.cache import TTLCache
+
+logger = logging.getLogger(__name__)
+
+# flask-jwt-extended has no public hook ahead of decoding a token: the decorators and decode_token() all go through
+# JWTManager._decode_jwt_from_config, which is where the cache sits. It's only used while that method still takes
+# the arguments it was written against (Flask-JWT-Extended 4.x), after an upgrade that changes them tokens are
+# decoded by the library alone instead of through an override that no longer fits
+DECODE_PARAMETERS = ('self', 'encoded_token', 'csrf_value', 'allow_expired')
+
+
+def decode_is_cacheable():
+    decode = getattr(JWTManager, '_decode_jwt_from_config', None)
+
+    return decode is not None and tuple(inspect.signature(decode).parameters) == DECODE_PARAMETERS
+
+
+# JWTManager that remembers the claims of tokens it has already verified, keyed by a hash of the token, so a
+# client sending the same token again skips the base64/JSON decoding and the HMAC check until the token expires
+class CachingJWTManager(JWTManager):
+
+    def init_app(self, app, *args, **kwargs):
+        super().init_app(app, *args, **kwargs)
+
+        maxsize = app.config['JWT_TOKEN_CACHE_SIZE']
+
+        if maxsize > 0 and not decode_is_cacheable():
+            logger.warning('JWTManager._decode_jwt_from_config changed, verified tokens are not cached')
+            maxsize = 0
+
+        app.extensions['token_cache'] = TTLCache(maxsize=maxsize, ttl=app.config['JWT_TOKEN_CACHE_TTL'])
+
+    def _decode_jwt_from_config(self, encoded_token, csrf_value=None, allow_expired=False):
+        cache = current_app.extensions.get('token_cache')
+
+        # CSRF double submit and expired token lookups are rare and checked on every call, they skip the cache
+        if cache is None or cache.maxsize <= 0 or csrf_value or allow_expired:
+            return super()._decode_jwt_from_config(encoded_token, csrf_value, allow_expired)
+
+        key = hashlib.sha256(encoded_token.encode()).digest()
+        claims = cache.get(key)
+
+        # an expired token goes through the full decode again so it fails the usual way
+        if claims is None or 'exp' in claims and claims['exp'] + jwt_config.leeway <= time.time():
+            claims = super()._decode_jwt_from_config(encoded_token, csrf_value, allow_expired)
+
+            ttl = cache.ttl
+            if 'exp' in claims:
+                ttl = min(ttl, claims['exp'] + jwt_config.leeway - time.time())
+
+            if ttl > 0:
+                cache.set(key, claims, ttl)
+
+        # callers get their own copy, the cached claims are never handed out
+        return dict(claims)
+
+
+def epoch(date):
+    return date.replace(tzinfo=timezone.utc).timestamp()
+
+
+def from_epoch(seconds):
+    return datetime.fromtimestamp(seconds, timezone.utc).replace(tzinfo=None)
+
+
+# the longest a token can live, a user revocation has to outlast every token issued before it
+def max_token_lifetime(app):
+    lifetimes = [app.config['JWT_ACCESS_TOKEN_EXPIRES'], app.config['JWT_REFRESH_TOKEN_EXPIRES']]
+
+    # False means the tokens never expire
+    if not all(lifetimes):
+        return timedelta(days=3650)
+
+    return max(lifetimes)
+
+
+# revoked token ids and per user cutoffs held in memory so checking a token is two dict lookups, the
+# token_revocations table is read again every sync_interval seconds to pick up other processes' revocations.
+# A sync reads the rows revoked since the previous one started, less sync_overlap seconds: ids can't be used
+# as a high-water mark, SQLite hands out a deleted id again and a transaction can commit a revocation some
+# time after it stamped revoked_at. clock gives the epoch seconds user revocations and the iat of new tokens
+# are stamped with
+class RevocationList:
+
+    def __init__(self, sync_interval=5, sync_overlap=60, timer=time.monotonic, clock=time.time):
+        self.sync_interval = sync_interval
+        self.sync_overlap = sync_overlap
+        self.timer = timer
+        self.clock = clock
+        # jti -> expiry, user id -> (tokens issued before this are revoked, expiry), both in epoch seconds
+        self._jtis = {}
+        self._users = {}
+        # epoch seconds the last sync started at, None until the first one has loaded every revocation
+        self._synced_at = None
+        self._next_sync = timer() + sync_interval
+        self._lock = Lock()
+        self._sync_lock = Lock()
+
+    def __len__(self):
+        return len(self._jtis) + len(self._users)
+
+    def add(self, jti=None, user_id=None, revoked_at=None, expires_at=None):
+        with self._lock:
+            if jti is not None:
+                self._jtis[jti] = expires_at
+
+            if user_id is not None:
+                cutoff, expiry = self._users.get(user_id, (revoked_at, expires_at))
+                self._users[user_id] = (max(cutoff, revoked_at), max(expiry, expires_at))
+
+    def is_revoked(self, claims):
+        if self.timer() >= self._next_sync:
+            self.sync()
+
+        if claims.get('jti') in self._jtis:
+            return True
+
+        user = self._users.get(claims.get('user_id'))
+
+        return user is not None and claims.get('iat', 0) < user[0]
+
+    # loads the revocations written since the last sync and forgets the ones whose tokens have expired,
+    # a request finding a sync already running doesn't wait for it
+    def sync(self):
+        if not self._sync_lock.acquire(blocking=False):
+            return
+
+        try:
+            now = self.clock()
+            table = TokenRevocation.__table__
+
+            query = db.select(table).where(table.c.expires_at > from_epoch(now))
+
+            # rows read again in the overlap are added again, which changes nothing
+            if self._synced_at is not None:
+                query = query.where(table.c.revoked_at >= from_epoch(self._synced_at - self.sync_overlap))
+
+            # on its own connection so the request's transaction is left alone
+            with db.engine.connect() as connection:
+                rows = connection.execute(query).all()
+
+            for row in rows:
+                self.add(row.jti, row.user_id, epoch(row.revoked_at), epoch(row.expires_at))
+
+            self._synced_at = now
+
+            with self._lock:
+                self._jtis = {jti: expiry for jti, expiry in self._jtis.items() if expiry > now}
+                self._users = {user_id: user for user_id, user in self._users.items() if user[1] > now}
+
+            self._next_sync = self.timer() + self.sync_interval
+        finally:
+            self._sync_lock.release()
+
+
+def init_token_revocation(app, jwt):
+    revocations = app.extensions['token_revocations'] = RevocationList(
+        sync_interval=app.config['TOKEN_REVOCATION_SYNC_INTERVAL'],
+        sync_overlap=app.config['TOKEN_REVOCATION_SYNC_OVERLAP']
+    )
+
+    # revocations made before this process started, unless the database hasn't been migrated yet
+    with app.app_context():
+        if db.inspect(db.engine).has_table(TokenRevocation.__tablename__):
+            revocations.sync()
+
+    @jwt.token_in_blocklist_loader
+    def token_revoked(jwt_header, jwt_data):
+        return current_app.extensions['token_revocations'].is_revoked(jwt_data)
+
+    # a user revocation covers the tokens issued before it, both are stamped by the same clock
+    @jwt.additional_claims_loader
+    def issued_at(identity):
+        return {'iat': int(current_app.extensions['token_revocations'].clock())}
+
+
+# revokes a single token, e.g. on logout, the row is written right away and other processes see it on their next sync
+def revoke_token(claims):
+    expires_at = from_epoch(claims['exp']) if 'exp' in claims else datetime.utcnow() + max_token_lifetime(current_app)
+
+    db.session.add(TokenRevocation(jti=claims['jti'], expires_at=expires_at))
+
+    # a revocation is only needed until its tokens expire
+    db.session.execute(db.delete(TokenRevocation).where(TokenRevocation.expires_at <= datetime.utcnow()))
+
+    db.session.commit()
+
+    current_app.extensions['token_revocations'].add(jti=claims['jti'], expires_at=epoch(expires_at))
+
+
+# deactivating or removing a user revokes every token it was issued so far, in the same transaction
+def revoke_user_tokens(connection, target):
+    if not has_app_context() or 'token_revocations' not in current_app.extensions:
+        return
+
+    revoked_at = from_epoch(current_app.extensions['token_revocations'].clock())
+    expires_at = revoked_at + max_token_lifetime(current_app)
+
+    connection.execute(
+        TokenRevocation.__table__.insert().values(user_id=target.id, revoked_at=revoked_at, expires_at=expires_at)
+    )
+
+    # applied in memory once the transaction commits
+    db.object_session(target).info.setdefault('token_revocations', []).append(
+        (target.id, epoch(revoked_at), epoch(expires_at))
+    )
+
+
+@event.listens_for(User, 'after_update')
+def user_updated(mapper, connection, target):
+    history = db.inspect(target).attrs.is_active.history
+
+    if history.has_changes() and not target.is_active:
+        revoke_user_tokens(connection, target)
+
+
+@event.listens_for(User, 'after_delete')
+def user_deleted(mapper, connection, target):
+    revoke_user_tokens(connection, target)
+
+
+@event.listens_for(Session, 'after_commit')
+def apply_token_revocations(session):
+    revocations = session.info.pop('token_revocations', None)
+
+    if not revocations or not has_app_context() or 'token_revocations' not in current_app.extensions:
+        return
+
+    for user_id, revoked_at, expires_at in revocations:
+        current_app.extensions['token_revocations'].add(user_id=user_id, revoked_at=revoked_at, expires_at=expires_at)
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_token_revocations(session):
+    session.info.pop('token_revocations', None)
@@ -1,10 +1,11 @@
 from flask_restx import Namespace, Resource, fields
-from flask import request
+from flask import request, current_app
 from ..models.users import User
 from ..utils import db
-from werkzeug.security import generate_password_hash, check_password_hash
 from http import HTTPStatus
-from flask_jwt_extended import create_access_token, create_refresh_token, jwt_required, get_jwt_identity
+from flask_jwt_extended import create_access_token, create_refresh_token, jwt_required, get_jwt_identity, get_jwt
+from .identity import identity_claims
+from .tokens import revoke_token
 
 auth_namespace = Namespace('auth', description= 'name space for authentication')
 
@@ -54,7 +55,7 @@ class SignUp(Resource):
         new_user = User(
             username = data.get('username'),
             email = data.get('email'),
-            password_hash = generate_password_hash(data.get('password')) 
+            password_hash = current_app.extensions['password_hasher'].hash(data.get('password'))
         )
 
         # saves new_user to db
@@ -82,10 +83,18 @@ class Login(Resource):
         # using the email entered, query the db and grab all details associatede with that user
         user = User.query.filter_by(email=email).first()
 
-        #if the user is not empty, unhash password = password
-        if (user is not None) and check_password_hash(user.password_hash, password):
-            access_token = create_access_token(identity=  user.username)
-            refresh_token = create_refresh_token(identity = user.username)
+        hasher = current_app.extensions['password_hasher']
+
+        #if the user is not empty, unhash password = password, deactivated users can't log in
+        if (user is not None) and user.is_active and hasher.verify(user.password_hash, password):
+            # upgrade hashes made with older algorithm/cost settings while we have the plain password
+            if hasher.needs_rehash(user.password_hash):
+                user.password_hash = hasher.hash(password)
+                db.session.commit()
+
+            # the user id rides along in the token so order endpoints don't have to look the user up
+            access_token = create_access_token(identity=  user.username, additional_claims = identity_claims(user))
+            refresh_token = create_refresh_token(identity = user.username, additional_claims = identity_claims(user))
 
             response = {
                 'access_token': access_token, 
@@ -104,8 +113,21 @@ class Refresh(Resource):
         # get_jwt_identity helps get the identity of the user
         username = get_jwt_identity()
 
-        access_token = create_access_token(identity= username)
+        # carry the user id claim over from the refresh token
+        claims = {'user_id': get_jwt()['user_id']} if 'user_id' in get_jwt() else {}
+
+        access_token = create_access_token(identity= username, additional_claims = claims)
 
         return {'access_token': access_token}, HTTPStatus.OK
-    
-==
\ No newline at end of file
+
+@auth_namespace.route('/logout')
+class Logout(Resource):
+    # works with the access token or the refresh token, call it with both to revoke both
+    @jwt_required(verify_type=False)
+    def post(self):
+        """
+            Revoke the token sent with the request
+        """
+        revoke_token(get_jwt())
+
+        return {'message': 'Logged out'}, HTTPStatus.OK
\ No newline at end of file
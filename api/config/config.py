@@ -1,5 +1,5 @@
 import os
-from decouple import config
+from decouple import config, Csv
 from datetime import timedelta
 
 BASE_DIR = os.path.dirname(os.path.realpath(__file__))
@@ -9,28 +9,197 @@ class Config:
     JWT_SECRET_KEY = config('JWT_SECRET_KEY')
     JWT_ACCESS_TOKEN_EXPIRES = timedelta (minutes = 30)
     JWT_REFRESH_TOKEN_EXPIRES = timedelta (minutes= 30)
+    # claims of already verified tokens kept in memory, at most JWT_TOKEN_CACHE_TTL seconds and never past their expiry,
+    # 0 entries turns the cache off
+    JWT_TOKEN_CACHE_SIZE = config('JWT_TOKEN_CACHE_SIZE', 10000, cast=int)
+    JWT_TOKEN_CACHE_TTL = config('JWT_TOKEN_CACHE_TTL', 300, cast=int)
+    # seconds between reloads of the revoked tokens written by other processes
+    TOKEN_REVOCATION_SYNC_INTERVAL = config('TOKEN_REVOCATION_SYNC_INTERVAL', 5, cast=int)
+    # seconds every sync reads back past the previous one, longer than a transaction revoking tokens can take
+    TOKEN_REVOCATION_SYNC_OVERLAP = config('TOKEN_REVOCATION_SYNC_OVERLAP', 60, cast=int)
+    # default and maximum number of orders returned per page on list endpoints
+    ORDERS_PAGE_SIZE = config('ORDERS_PAGE_SIZE', 50, cast=int)
+    ORDERS_MAX_PAGE_SIZE = config('ORDERS_MAX_PAGE_SIZE', 500, cast=int)
+    # rows fetched per query when streaming orders as NDJSON
+    ORDERS_STREAM_BATCH_SIZE = config('ORDERS_STREAM_BATCH_SIZE', 1000, cast=int)
+    # rows per INSERT batch and maximum orders accepted by the bulk order endpoint
+    ORDERS_BULK_CHUNK_SIZE = config('ORDERS_BULK_CHUNK_SIZE', 1000, cast=int)
+    ORDERS_BULK_MAX_ITEMS = config('ORDERS_BULK_MAX_ITEMS', 50000, cast=int)
+    # `flask orders archive` moves DELIVERED orders older than this many days to orders_archive, in batches
+    ORDERS_ARCHIVE_AFTER_DAYS = config('ORDERS_ARCHIVE_AFTER_DAYS', 90, cast=int)
+    ORDERS_ARCHIVE_BATCH_SIZE = config('ORDERS_ARCHIVE_BATCH_SIZE', 1000, cast=int)
+    # rows read from the database at a time by the order export endpoint and `flask orders export`
+    ORDERS_EXPORT_BATCH_SIZE = config('ORDERS_EXPORT_BATCH_SIZE', 2000, cast=int)
+    # kitchen queue: seconds of prep per pizza of each size (PENDING orders are made by date_created plus their
+    # prep time), seconds between reads of the orders placed by other processes, most orders /kitchen/next returns
+    KITCHEN_PREP_SECONDS = {'SMALL': 60, 'MEDIUM': 90, 'LARGE': 120, 'EXTRA_LARGE': 150}
+    KITCHEN_QUEUE_SYNC_INTERVAL = config('KITCHEN_QUEUE_SYNC_INTERVAL', 5, cast=int)
+    # seconds every sync reads back past the previous one, longer than a transaction placing orders can take
+    KITCHEN_QUEUE_SYNC_OVERLAP = config('KITCHEN_QUEUE_SYNC_OVERLAP', 60, cast=int)
+    KITCHEN_MAX_NEXT = config('KITCHEN_MAX_NEXT', 50, cast=int)
+    # background jobs, queued in the jobs table: jobs run at the same time by each web process (0 leaves them to
+    # `flask jobs work`) on threads or processes (forkserver), seconds between polls for jobs other processes queued
+    # or that are due for a retry, seconds a job may run before another worker takes it over, attempts before it
+    # goes to dead_jobs and the backoff between them (doubling from JOB_BACKOFF_BASE up to JOB_BACKOFF_MAX seconds)
+    JOB_WORKERS = config('JOB_WORKERS', 2, cast=int)
+    JOB_POOL = config('JOB_POOL', 'thread')
+    JOB_POLL_INTERVAL = config('JOB_POLL_INTERVAL', 1.0, cast=float)
+    JOB_LEASE = config('JOB_LEASE', 300, cast=int)
+    JOB_MAX_ATTEMPTS = config('JOB_MAX_ATTEMPTS', 8, cast=int)
+    JOB_BACKOFF_BASE = config('JOB_BACKOFF_BASE', 2.0, cast=float)
+    JOB_BACKOFF_MAX = config('JOB_BACKOFF_MAX', 3600, cast=int)
+    # the changes of every order transaction are POSTed to ORDER_WEBHOOK_URL by a background job when it's set,
+    # ORDER_JOB_TASKS lists the tasks enqueued for order changes
+    ORDER_WEBHOOK_URL = config('ORDER_WEBHOOK_URL', '')
+    ORDER_WEBHOOK_TIMEOUT = config('ORDER_WEBHOOK_TIMEOUT', 10, cast=int)
+    ORDER_JOB_TASKS = config('ORDER_JOB_TASKS', 'orders.webhook' if ORDER_WEBHOOK_URL else '', cast=Csv())
+    # password hashing: the hasher class, werkzeug method string (algorithm and cost) and salt length
+    PASSWORD_HASHER = config('PASSWORD_HASHER', 'api.auth.hashing.WerkzeugPasswordHasher')
+    PASSWORD_HASH_METHOD = config('PASSWORD_HASH_METHOD', 'pbkdf2:sha256:260000')
+    PASSWORD_SALT_LENGTH = config('PASSWORD_SALT_LENGTH', 16, cast=int)
+    # worker processes doing the hashing (0 hashes on the request thread) and how many hashes may wait for them.
+    # Every SERVER_WORKERS process of serve.py starts its own, so there are SERVER_WORKERS times this many in all
+    PASSWORD_HASH_WORKERS = config('PASSWORD_HASH_WORKERS', min(os.cpu_count() or 1, 2), cast=int)
+    PASSWORD_HASH_MAX_PENDING = config('PASSWORD_HASH_MAX_PENDING', 0, cast=int)
+    # how User.orders is loaded, read once when the models are imported
+    USER_ORDERS_LOADING = config('USER_ORDERS_LOADING', 'select')
+    # process-level cache of the current user's id/username/is_active, keyed by user id
+    IDENTITY_CACHE_SIZE = config('IDENTITY_CACHE_SIZE', 1024, cast=int)
+    IDENTITY_CACHE_TTL = config('IDENTITY_CACHE_TTL', 60, cast=int)
+    # cache of marshalled orders for the read endpoints, any class implementing utils.cache.CacheBackend, with at
+    # most ORDER_CACHE_USER_PAGES pages of each user's orders
+    ORDER_CACHE_BACKEND = config('ORDER_CACHE_BACKEND', 'api.utils.cache.TTLCache')
+    ORDER_CACHE_SIZE = config('ORDER_CACHE_SIZE', 10000, cast=int)
+    ORDER_CACHE_TTL = config('ORDER_CACHE_TTL', 300, cast=int)
+    ORDER_CACHE_USER_PAGES = config('ORDER_CACHE_USER_PAGES', 20, cast=int)
+    # read replica of the database (empty for none) used by the order read endpoints. A user reads from the primary
+    # for REPLICA_STICKY_SECONDS after a write of theirs, which is also the replication lag the replica is expected
+    # to stay within: the write's time is handed back signed with SECRET_KEY in the last_write cookie and the
+    # X-Last-Write header, so every worker process honours it. A replica that can't be reached is left alone for
+    # REPLICA_RETRY_INTERVAL seconds
+    REPLICA_DATABASE_URL = config('REPLICA_DATABASE_URL', '')
+    REPLICA_STICKY_SECONDS = config('REPLICA_STICKY_SECONDS', 5, cast=int)
+    REPLICA_RETRY_INTERVAL = config('REPLICA_RETRY_INTERVAL', 30, cast=int)
+    # Idempotency-Key of order creation: responses are kept IDEMPOTENCY_KEY_TTL seconds in the database with a
+    # cache in front, and a duplicate waits up to IDEMPOTENCY_WAIT_TIMEOUT seconds for the first request to finish
+    IDEMPOTENCY_KEY_TTL = config('IDEMPOTENCY_KEY_TTL', 86400, cast=int)
+    IDEMPOTENCY_CACHE_SIZE = config('IDEMPOTENCY_CACHE_SIZE', 10000, cast=int)
+    IDEMPOTENCY_CACHE_TTL = config('IDEMPOTENCY_CACHE_TTL', 300, cast=int)
+    IDEMPOTENCY_WAIT_TIMEOUT = config('IDEMPOTENCY_WAIT_TIMEOUT', 10, cast=int)
+    # order events streamed to clients: the broker class, per-subscriber queue size, what happens when a
+    # queue is full (drop_oldest, drop_newest or disconnect) and seconds between keepalives on idle streams
+    EVENT_BROKER = config('EVENT_BROKER', 'api.utils.broker.InProcessBroker')
+    EVENT_QUEUE_SIZE = config('EVENT_QUEUE_SIZE', 100, cast=int)
+    EVENT_DROP_POLICY = config('EVENT_DROP_POLICY', 'drop_oldest')
+    EVENT_KEEPALIVE = config('EVENT_KEEPALIVE', 15, cast=int)
+    # per-request timings (Server-Timing header, /metrics) and the slow query log with its EXPLAIN plan,
+    # SLOW_QUERY_THRESHOLD is in seconds and left empty to turn the log off
+    INSTRUMENTATION = config('INSTRUMENTATION', True, cast=bool)
+    SERVER_TIMING = config('SERVER_TIMING', True, cast=bool)
+    METRICS_PATH = config('METRICS_PATH', '/metrics')
+    SLOW_QUERY_THRESHOLD = config('SLOW_QUERY_THRESHOLD', '0.25', cast=lambda value: float(value) if value else None)
+    # encode JSON responses with orjson when it is installed: same data, compact bytes
+    FAST_JSON_RESPONSES = config('FAST_JSON_RESPONSES', False, cast=bool)
+    # serve.py: address, worker processes forked from a master that loads the app once, request threads per worker
+    # (0 starts one per connection), seconds workers get to finish in-flight requests on shutdown and before an
+    # idle keep-alive connection is closed, and whether every request line is logged.
+    # The default order cache, event broker and rate limit backend keep their state in each process, so with more
+    # than one worker orders changed through one are served stale by the others, event streams miss the changes
+    # made through the others and the rate limits are multiplied: raise SERVER_WORKERS once ORDER_CACHE_BACKEND,
+    # EVENT_BROKER and RATE_LIMIT_BACKEND are shared backends, serve.py warns about the ones that aren't.
+    # An open event stream holds one of the SERVER_THREADS threads of its worker for as long as it is open, a
+    # worker with as many streams as threads stops answering anything else: size the pool for the streams
+    # expected or use 0
+    SERVER_HOST = config('SERVER_HOST', '0.0.0.0')
+    SERVER_PORT = config('SERVER_PORT', 8000, cast=int)
+    SERVER_WORKERS = config('SERVER_WORKERS', 1, cast=int)
+    SERVER_THREADS = config('SERVER_THREADS', 16, cast=int)
+    SERVER_GRACEFUL_TIMEOUT = config('SERVER_GRACEFUL_TIMEOUT', 30, cast=int)
+    SERVER_KEEPALIVE_TIMEOUT = config('SERVER_KEEPALIVE_TIMEOUT', 5, cast=int)
+    SERVER_ACCESS_LOG = config('SERVER_ACCESS_LOG', False, cast=bool)
+    # token bucket limits, per client IP and per token identity, keyed by 'METHOD /route' for one route or by a path
+    # prefix ('/orders') for every route of a namespace, written as '<requests>/<second|minute|hour|day>' with an
+    # optional ';burst=<requests>'. Every matching entry applies. The backend is any RateLimitBackend class, the
+    # in-memory one keeps the buckets of each SERVER_WORKERS process apart so a client gets up to SERVER_WORKERS
+    # times these limits, a backend shared by the processes is needed to enforce them exactly
+    RATE_LIMITING = config('RATE_LIMITING', True, cast=bool)
+    RATE_LIMIT_BACKEND = config('RATE_LIMIT_BACKEND', 'api.utils.ratelimit.InMemoryRateLimitBackend')
+    RATE_LIMIT_MAX_KEYS = config('RATE_LIMIT_MAX_KEYS', 100000, cast=int)
+    RATE_LIMITS = {
+        'POST /auth/login': {'ip': '10/minute'},
+        'POST /auth/signup': {'ip': '5/minute'},
+        'POST /orders/orders': {'identity': '60/minute', 'ip': '120/minute'},
+        'POST /orders/orders/bulk': {'identity': '10/minute'},
+        '/orders': {'identity': '1200/minute;burst=100'},
+    }
+    # proxies in front of the app trusted to append the client address to X-Forwarded-For. The per IP limits see
+    # the address that many proxies back, with 0 they see the peer address and the header is ignored: behind a
+    # proxy every client then shares the proxy's limits, while trusting a header clients set would let them pick
+    # any address
+    PROXY_FIX_X_FOR = config('PROXY_FIX_X_FOR', 0, cast=int)
+    # load shedding, answered with 503 and Retry-After: requests in flight in a worker process (0 for no limit) and
+    # seconds a checkout may have been waiting for a pooled DB connection (empty for no limit, needs TimedQueuePool)
+    ADMISSION_MAX_IN_FLIGHT = config('ADMISSION_MAX_IN_FLIGHT', 128, cast=int)
+    ADMISSION_MAX_POOL_WAIT = config('ADMISSION_MAX_POOL_WAIT', '1.0', cast=lambda value: float(value) if value else None)
+    ADMISSION_RETRY_AFTER = config('ADMISSION_RETRY_AFTER', 1, cast=int)
+    # Swagger UI at / and the spec at /swagger.json, the spec is built on its first request and kept encoded
+    API_DOCS = config('API_DOCS', True, cast=bool)
+    # nothing listens to the Flask-SQLAlchemy modification signals, tracking them only costs CPU
+    SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # PRAGMAs run on every new SQLite connection, e.g. {'journal_mode': 'WAL'}
+    SQLITE_PRAGMAS = {}
 
 
 # class for development config 
 class DevConfig(Config):
     # cast tells the config that debug is a boolean expression
-    DEBUG = config('DEBUG', cast=bool)
-    SQLALCHEMY_TRACK_MODIFICATIONS = True
-    SQLALCHEMY_ECHO = True
+    DEBUG = config('DEBUG', False, cast=bool)
+    SQLALCHEMY_ECHO = config('SQLALCHEMY_ECHO', True, cast=bool)
     SQLALCHEMY_DATABASE_URI = 'sqlite:///'+os.path.join(BASE_DIR, 'db.sqlite3')
 
 class TestConfig(Config):
     TESTING = True
-    SQLALCHEMY_TRACK_MODIFICATIONS = True
+    # cheap hashes computed inline keep the suite fast
+    PASSWORD_HASH_METHOD = 'pbkdf2:sha256:1000'
+    PASSWORD_HASH_WORKERS = 0
+    # the suite and the load benchmarks send far more requests per client than the limits allow
+    RATE_LIMITING = False
+    # tests run the jobs they queue themselves
+    JOB_WORKERS = 0
     SQLALCHEMY_ECHO = True
      # using a memory db
     SQLALCHEMY_DATABASE_URI = 'sqlite://'
 
 class ProdConfig(Config):
-    pass
+    DEBUG = False
+    SQLALCHEMY_ECHO = False
+    SQLALCHEMY_DATABASE_URI = config('DATABASE_URL', 'sqlite:///'+os.path.join(BASE_DIR, 'db.sqlite3'))
+    # connection pool shared by the threads of a worker process
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        # lets the admission control see how long requests wait for a connection, a dotted path so this module
+        # imports none of the app's, create_app imports it
+        'poolclass': 'api.utils.ratelimit.TimedQueuePool',
+        'pool_size': config('DB_POOL_SIZE', 10, cast=int),
+        'max_overflow': config('DB_MAX_OVERFLOW', 20, cast=int),
+        'pool_recycle': config('DB_POOL_RECYCLE', 1800, cast=int),
+        'pool_timeout': config('DB_POOL_TIMEOUT', 30, cast=int),
+        'pool_pre_ping': config('DB_POOL_PRE_PING', True, cast=bool),
+    }
+    # only applied when DATABASE_URL points at SQLite: readers don't block the writer under WAL,
+    # NORMAL sync is safe with WAL, writers wait for the lock instead of failing, reads go through mmap
+    SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': config('SQLITE_BUSY_TIMEOUT', 5000, cast=int),
+        'mmap_size': config('SQLITE_MMAP_SIZE', 268435456, cast=int),
+    }
 
 config_dict = {
     'dev': DevConfig,
     'prod': ProdConfig,
     'test': TestConfig
-}
\ No newline at end of file
+}
+
+# the profile create_app uses when none is passed in
+def get_config():
+    return config_dict[config('FLASK_CONFIG', 'dev')]
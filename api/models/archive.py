@@ -0,0 +1,25 @@
+from ..utils import db
+from ..utils.codes import EnumCode
+from .orders import Sizes, OrderStatus, OrderFlavour, SIZE_CODES, ORDER_STATUS_CODES, FLAVOUR_CODES
+from datetime import datetime
+
+
+# delivered orders moved out of the orders table by `flask orders archive`, same columns and ids as they had there
+class OrderArchive(db.Model):
+    __tablename__ = 'orders_archive'
+    # a user's history is read a page at a time, in the order of the orders list
+    __table_args__ = (
+        db.Index('ix_orders_archive_customer_date_created', 'customer', 'date_created', 'id'),
+    )
+
+    id = db.Column(db.Integer(), primary_key = True, autoincrement = False)
+    size = db.Column(EnumCode(Sizes, SIZE_CODES))
+    order_status = db.Column(EnumCode(OrderStatus, ORDER_STATUS_CODES))
+    flavour = db.Column(EnumCode(OrderFlavour, FLAVOUR_CODES), nullable = False)
+    quantity = db.Column(db.Integer())
+    date_created = db.Column(db.DateTime())
+    customer = db.Column(db.Integer(), db.ForeignKey('users.id'))
+    archived_at = db.Column(db.DateTime(), nullable = False, default = datetime.utcnow)
+
+    def __repr__(self):
+        return f"<OrderArchive {self.id}>"
@@ -0,0 +1,44 @@
+from collections import namedtuple
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+# one inserted/updated/deleted/archived order, handed to the subscribers once the transaction has committed.
+# An archived order left orders for orders_archive: it's gone from orders like a deleted one but still counts in
+# the stats. date_created, size and quantity are only filled in by inserts and by updates made through the ORM
+OrderChange = namedtuple(
+    'OrderChange', ['action', 'id', 'customer', 'order_status', 'date_created', 'size', 'quantity'],
+    defaults=(None, None, None)
+)
+
+_subscribers = []
+
+
+# registers fn(changes) to be called with the list of OrderChange of every committed transaction
+def on_order_change(fn):
+    _subscribers.append(fn)
+
+    return fn
+
+
+# queues a change on the session until it commits, called from the Order mapper events and by bulk statements
+def record_order_change(session, action, id, customer, order_status, date_created=None, size=None, quantity=None):
+    session.info.setdefault('order_changes', []).append(
+        OrderChange(action, id, customer, order_status, date_created, size, quantity)
+    )
+
+
+# subscribers only hear about changes that made it to the database
+@event.listens_for(Session, 'after_commit')
+def publish_order_changes(session):
+    changes = session.info.pop('order_changes', None)
+
+    if not changes:
+        return
+
+    for subscriber in _subscribers:
+        subscriber(changes)
+
+
+@event.listens_for(Session, 'after_rollback')
+def discard_order_changes(session):
+    session.info.pop('order_changes', None)
@@ -0,0 +1,27 @@
+from ..utils import db
+from datetime import datetime
+
+# the longest Idempotency-Key the key column holds, longer ones are refused before they get to it
+IDEMPOTENCY_KEY_MAX_LENGTH = 255
+
+
+# the response sent for the first request carrying an Idempotency-Key, replayed to the retries of that request
+class IdempotencyKey(db.Model):
+    __tablename__ = 'idempotency_keys'
+    # keys are chosen by the clients, so they are only unique per user
+    __table_args__ = (
+        db.UniqueConstraint('scope', 'key', name='uq_idempotency_keys_scope_key'),
+    )
+
+    id = db.Column(db.Integer(), primary_key = True)
+    scope = db.Column(db.String(80), nullable = False)
+    key = db.Column(db.String(IDEMPOTENCY_KEY_MAX_LENGTH), nullable = False)
+    # hash of the request body, the same key sent with a different body is refused
+    fingerprint = db.Column(db.String(64), nullable = False)
+    status_code = db.Column(db.Integer(), nullable = False)
+    response = db.Column(db.Text(), nullable = False)
+    created_at = db.Column(db.DateTime(), nullable = False, default = datetime.utcnow)
+    expires_at = db.Column(db.DateTime(), nullable = False, index = True)
+
+    def __repr__(self):
+        return f"<IdempotencyKey {self.scope} {self.key}>"
@@ -0,0 +1,40 @@
+from ..utils import db
+from datetime import datetime
+
+
+# a background job waiting to run, the table is the queue so jobs outlive the process that enqueued them.
+# A job is inserted in the transaction whose side effect it is and can only be picked up once that commits
+class Job(db.Model):
+    __tablename__ = 'jobs'
+
+    id = db.Column(db.Integer(), primary_key = True)
+    # name the task was registered with, see api.utils.jobs.task
+    task = db.Column(db.String(120), nullable = False)
+    payload = db.Column(db.Text(), nullable = False)
+    attempts = db.Column(db.Integer(), nullable = False, default = 0)
+    max_attempts = db.Column(db.Integer(), nullable = False)
+    # not picked up before this time, pushed back after every failed attempt
+    run_at = db.Column(db.DateTime(), nullable = False, default = datetime.utcnow, index = True)
+    # set while a worker runs the job, a worker that died leaves it to be picked up again once this has passed
+    locked_until = db.Column(db.DateTime())
+    last_error = db.Column(db.Text())
+    created_at = db.Column(db.DateTime(), nullable = False, default = datetime.utcnow)
+
+    def __repr__(self):
+        return f"<Job {self.id} {self.task}>"
+
+
+# jobs that failed max_attempts times, kept until someone looks at them and retries or deletes them
+class DeadJob(db.Model):
+    __tablename__ = 'dead_jobs'
+
+    id = db.Column(db.Integer(), primary_key = True)
+    task = db.Column(db.String(120), nullable = False)
+    payload = db.Column(db.Text(), nullable = False)
+    attempts = db.Column(db.Integer(), nullable = False)
+    error = db.Column(db.Text())
+    created_at = db.Column(db.DateTime(), nullable = False)
+    failed_at = db.Column(db.DateTime(), nullable = False, default = datetime.utcnow)
+
+    def __repr__(self):
+        return f"<DeadJob {self.id} {self.task}>"
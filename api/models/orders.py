@@ -1,4 +1,7 @@
 from ..utils import db
+from ..utils.codes import EnumCode, enum_member
+from .changes import record_order_change
+from collections import defaultdict, deque
 from enum import Enum
 from datetime import datetime
 
@@ -15,25 +18,54 @@ class OrderStatus(Enum):
     IN_TRANSIT = 'in-transit'
     DELIVERED = 'delivered'
 
+# the status an order must be in before it can move to each status, orders only ever move forward
+ORDER_STATUS_TRANSITIONS = {
+    'IN_TRANSIT': OrderStatus.PENDING,
+    'DELIVERED': OrderStatus.IN_TRANSIT,
+}
+
 class OrderFlavour(Enum):
     PEPPERONI = 'pepperroni'
     CHICKEN = 'chicken'
     PORK = 'pork'
     MIX = 'mix'
 
-    
+    # shown as its value ('pork') whatever spelling was sent. Before flavours were coded they were returned as
+    # sent ('Pork'), and as 'OrderFlavour.MIX' when the model's default was used: a code doesn't keep the case
+    def __str__(self):
+        return self.value
+
+# the small integer codes sizes, statuses and flavours are stored as, the lookup table between the database and
+# the enums the rest of the app uses. Numbered in the order of the names they replaced so anything sorted on
+# these columns comes out as before. Codes are never renumbered or reused, a new member takes the next free one
+SIZE_CODES = {Sizes.EXTRA_LARGE: 1, Sizes.LARGE: 2, Sizes.MEDIUM: 3, Sizes.SMALL: 4}
+ORDER_STATUS_CODES = {OrderStatus.DELIVERED: 1, OrderStatus.IN_TRANSIT: 2, OrderStatus.PENDING: 3}
+FLAVOUR_CODES = {OrderFlavour.CHICKEN: 1, OrderFlavour.MIX: 2, OrderFlavour.PEPPERONI: 3, OrderFlavour.PORK: 4}
+
 
 class Order(db.Model):
     __tablename__ = 'orders'
+    # composite indexes backing the keyset pagination and filters on the orders list, the active statuses
+    # have partial indexes of their own below. Without AUTOINCREMENT SQLite hands out max(id) + 1, the id of
+    # an order deleted or archived while it was the newest would be given to the next one
+    __table_args__ = (
+        db.Index('ix_orders_date_created_id', 'date_created', 'id'),
+        db.Index('ix_orders_customer_id', 'customer', 'id'),
+        {'sqlite_autoincrement': True},
+    )
 
     id = db.Column(db.Integer(), primary_key = True)
-    size = db.Column(db.Enum(Sizes), default = Sizes.SMALL)
-    order_status = db.Column(db.Enum(OrderStatus), default = OrderStatus.PENDING)
-    flavour = db.Column(db.String(), nullable = False, default = OrderFlavour.MIX)
+    size = db.Column(EnumCode(Sizes, SIZE_CODES), default = Sizes.SMALL)
+    order_status = db.Column(EnumCode(OrderStatus, ORDER_STATUS_CODES), default = OrderStatus.PENDING)
+    flavour = db.Column(EnumCode(OrderFlavour, FLAVOUR_CODES), nullable = False, default = OrderFlavour.MIX)
     quantity = db.Column(db.Integer())
     date_created = db.Column(db.DateTime(), default = datetime.utcnow)
     # linking order to user by getting the user's id
     customer = db.Column(db.Integer(), db.ForeignKey('users.id'))
+    # bumped by every update, an UPDATE or DELETE made from a stale copy of the order matches no row and fails
+    version = db.Column(db.Integer(), nullable = False, default = 1)
+
+    __mapper_args__ = {'version_id_col': version}
 
     def __repr__(self):
         return f"<Order {self.id}>"
@@ -42,6 +74,105 @@ class Order(db.Model):
         db.session.add(self)
         db.session.commit()
 
+    # inserts many orders in one transaction, chunk_size rows per executemany, returning the new ids in the order
+    # of rows. Neither SQLite nor PostgreSQL promise RETURNING comes back in the order the rows were sent, so each
+    # returned row is matched to a row of rows by its values: rows with the same values can take either id
+    @classmethod
+    def bulk_insert(cls, rows, chunk_size=1000):
+        # imported here because the rollups module imports this one
+        from .rollups import apply_rollup_deltas, bulk_rollup_deltas
+
+        returned = defaultdict(deque)
+
+        for start in range(0, len(rows), chunk_size):
+            result = db.session.execute(
+                db.insert(cls).returning(cls.id, cls.date_created, cls.customer, cls.size, cls.flavour, cls.quantity, cls.order_status),
+                rows[start:start + chunk_size]
+            )
+
+            for row in result:
+                returned[(row.customer, row.size, row.flavour, row.quantity, row.order_status)].append(row)
+
+        inserted = [returned[cls.bulk_row_key(row)].popleft() for row in rows]
+
+        # bulk statements skip the mapper events, so the changes are recorded by hand
+        for row in inserted:
+            record_order_change(
+                db.session, 'insert', row.id, row.customer, row.order_status, row.date_created, row.size, row.quantity
+            )
+
+        apply_rollup_deltas(db.session.connection(), bulk_rollup_deltas(
+            (row.date_created, row.size, row.flavour, row.order_status, row.quantity) for row in inserted
+        ))
+
+        db.session.commit()
+
+        return [row.id for row in inserted]
+
+    # the values a row given to bulk_insert is stored with, as they are read back
+    @classmethod
+    def bulk_row_key(cls, row):
+        def member(enum, name, default):
+            value = row.get(name, default)
+
+            return None if value is None else enum_member(enum, value)
+
+        return (
+            row.get('customer'), member(Sizes, 'size', Sizes.SMALL), member(OrderFlavour, 'flavour', OrderFlavour.MIX),
+            row.get('quantity'), member(OrderStatus, 'order_status', OrderStatus.PENDING)
+        )
+
+    # moves every order matching criteria to status in one UPDATE, the allowed transition is enforced in
+    # the WHERE clause and the rows of the orders that moved come back through RETURNING. No row is read
+    # first, so nothing is locked between deciding and writing: a concurrent change just makes the WHERE miss
+    @classmethod
+    def transition_rows(cls, status, *criteria):
+        # imported here because the rollups module imports this one
+        from .rollups import apply_rollup_deltas, bulk_rollup_deltas
+
+        previous_status = ORDER_STATUS_TRANSITIONS[status.name]
+
+        statement = (
+            db.update(cls)
+            .where(cls.order_status == previous_status, *criteria)
+            .values(order_status = status, version = cls.version + 1)
+            .returning(cls.id, cls.customer, cls.date_created, cls.size, cls.flavour, cls.order_status, cls.quantity, cls.version)
+            .execution_options(synchronize_session = False)
+        )
+
+        rows = db.session.execute(statement).all()
+
+        for row in rows:
+            record_order_change(db.session, 'update', row.id, row.customer, status)
+
+        # every moved order leaves its previous status bucket for the new one
+        apply_rollup_deltas(db.session.connection(), bulk_rollup_deltas(
+            ((row.date_created, row.size, row.flavour, row.order_status, row.quantity) for row in rows), previous_status
+        ))
+
+        db.session.commit()
+
+        return rows
+
+    # ids of the orders transition_rows moved
+    @classmethod
+    def transition_status(cls, status, *criteria):
+        return [row.id for row in cls.transition_rows(status, *criteria)]
+
+    # compare-and-set of one order's status: it moves only from the preceding status and, when versions are
+    # given as (date_created, version) pairs, only while the order is at one of them. Returns the updated row,
+    # or None when nothing matched
+    @classmethod
+    def compare_and_set_status(cls, order_id, status, versions=None):
+        criteria = [cls.id == order_id]
+
+        if versions is not None:
+            criteria.append(db.tuple_(cls.date_created, cls.version).in_(versions))
+
+        rows = cls.transition_rows(status, *criteria)
+
+        return rows[0] if rows else None
+
     #cls represents the model and ca be represented by anything
     @classmethod
     def get_by_id(cls, id):
@@ -54,4 +185,43 @@ class Order(db.Model):
     # function to delete an order
     def delete(self):
         db.session.delete(self)
-        db.session.commit()
\ No newline at end of file
+        db.session.commit()
+
+
+# most orders are DELIVERED, the PENDING and IN_TRANSIT ones the kitchen and the status filters look for are
+# kept in partial indexes a fraction of the size of one over every order
+db.Index(
+    'ix_orders_pending_date_created', Order.date_created, Order.id,
+    sqlite_where = Order.order_status == OrderStatus.PENDING, postgresql_where = Order.order_status == OrderStatus.PENDING
+)
+db.Index(
+    'ix_orders_in_transit_date_created', Order.date_created, Order.id,
+    sqlite_where = Order.order_status == OrderStatus.IN_TRANSIT, postgresql_where = Order.order_status == OrderStatus.IN_TRANSIT
+)
+
+
+# every ORM insert/update/delete of an order is queued and handed to the on_order_change subscribers after commit
+def record_change(action, target):
+    # views assign the status by name ('IN_TRANSIT'), subscribers always get the enum member
+    order_status = None if target.order_status is None else enum_member(OrderStatus, target.order_status)
+    size = None if target.size is None else enum_member(Sizes, target.size)
+
+    record_order_change(
+        db.object_session(target), action, target.id, target.customer, order_status,
+        target.date_created, size, target.quantity
+    )
+
+
+@db.event.listens_for(Order, 'after_insert')
+def order_inserted(mapper, connection, target):
+    record_change('insert', target)
+
+
+@db.event.listens_for(Order, 'after_update')
+def order_updated(mapper, connection, target):
+    record_change('update', target)
+
+
+@db.event.listens_for(Order, 'after_delete')
+def order_deleted(mapper, connection, target):
+    record_change('delete', target)
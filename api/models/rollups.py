@@ -0,0 +1,265 @@
+from collections import defaultdict
+from datetime import datetime
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from ..utils import db
+from ..utils.codes import EnumCode, enum_member
+from .archive import OrderArchive
+from .orders import Order, OrderStatus, OrderFlavour, Sizes, SIZE_CODES, ORDER_STATUS_CODES, FLAVOUR_CODES
+
+
+# the code a missing size, flavour or status is stored as in the rollups, so every bucket is one row: the
+# upserts find a bucket through its unique constraint, where NULLs would never match
+ROLLUP_NONE_CODE = 0
+
+
+# orders placed per hour, size, flavour and status, kept up to date in the same transaction as the orders
+# themselves so the dashboards read a few rows per hour instead of scanning orders
+class OrderRollup(db.Model):
+    __tablename__ = 'order_rollups'
+    __table_args__ = (
+        db.UniqueConstraint('hour', 'size', 'flavour', 'order_status', name='uq_order_rollups_bucket'),
+    )
+
+    id = db.Column(db.Integer(), primary_key = True)
+    hour = db.Column(db.DateTime(), nullable = False)
+    size = db.Column(EnumCode(Sizes, SIZE_CODES, none_code = ROLLUP_NONE_CODE), nullable = False)
+    flavour = db.Column(EnumCode(OrderFlavour, FLAVOUR_CODES, none_code = ROLLUP_NONE_CODE), nullable = False)
+    order_status = db.Column(EnumCode(OrderStatus, ORDER_STATUS_CODES, none_code = ROLLUP_NONE_CODE), nullable = False)
+    # number of orders and sum of their quantities in the bucket
+    orders = db.Column(db.Integer(), nullable = False, default = 0)
+    quantity = db.Column(db.Integer(), nullable = False, default = 0)
+
+    def __repr__(self):
+        return f"<OrderRollup {self.hour} {self.size} {self.flavour} {self.order_status}>"
+
+    # recomputes every bucket from the orders and the archived orders, for a database filled before the rollups
+    # existed or rollups gone wrong (flask orders rebuild-rollups)
+    @classmethod
+    def rebuild(cls):
+        db.session.execute(db.delete(cls))
+
+        for row in aggregate_orders(('hour', 'size', 'flavour', 'order_status')):
+            db.session.add(cls(**row))
+
+        db.session.commit()
+
+
+# the start of the hour a date falls in
+def hour_of(date):
+    return date.replace(minute=0, second=0, microsecond=0)
+
+
+# SQL expression truncating a datetime column to its hour, formatted like the datetimes SQLAlchemy stores on SQLite
+def hour_bucket(column):
+    if db.engine.dialect.name == 'sqlite':
+        return db.func.strftime('%Y-%m-%d %H:00:00.000000', column)
+
+    return db.func.date_trunc('hour', column)
+
+
+# criteria keeping date_column in [date_from, date_to)
+def date_range(date_column, date_from=None, date_to=None):
+    criteria = []
+
+    if date_from is not None:
+        criteria.append(date_column >= date_from)
+
+    if date_to is not None:
+        criteria.append(date_column < date_to)
+
+    return criteria
+
+
+# every order ever placed, the orders table and the archived ones
+def order_history():
+    columns = ('id', 'date_created', 'size', 'flavour', 'order_status', 'quantity')
+
+    return db.union_all(
+        db.select(*(getattr(Order, name) for name in columns)),
+        db.select(*(getattr(OrderArchive, name) for name in columns)),
+    ).subquery('order_history')
+
+
+# GROUP BY over the orders themselves, for ranges the hourly rollups can't answer
+def aggregate_orders(group_by, date_from=None, date_to=None):
+    history = order_history()
+
+    columns = {
+        'hour': hour_bucket(history.c.date_created),
+        'size': history.c.size,
+        'flavour': history.c.flavour,
+        'order_status': history.c.order_status,
+    }
+    keys = [columns[name].label(name) for name in group_by]
+
+    query = (
+        db.session.query(
+            *keys,
+            db.func.count(history.c.id).label('orders'),
+            db.func.coalesce(db.func.sum(history.c.quantity), 0).label('quantity'),
+        )
+        .filter(*date_range(history.c.date_created, date_from, date_to))
+        .group_by(*keys)
+        .order_by(*keys)
+    )
+
+    for row in query:
+        row = row._asdict()
+
+        # the SQLite hour bucket comes back as text
+        if isinstance(row.get('hour'), str):
+            row['hour'] = datetime.fromisoformat(row['hour'])
+
+        yield row
+
+
+# the same grouping read from the rollups, which only costs one row per bucket
+def aggregate_rollups(group_by, date_from=None, date_to=None):
+    keys = [getattr(OrderRollup, name) for name in group_by]
+
+    query = (
+        db.session.query(
+            *keys,
+            db.func.sum(OrderRollup.orders).label('orders'),
+            db.func.sum(OrderRollup.quantity).label('quantity'),
+        )
+        .filter(*date_range(OrderRollup.hour, date_from, date_to))
+        .group_by(*keys)
+        .having(db.func.sum(OrderRollup.orders) > 0)
+        .order_by(*keys)
+    )
+
+    return (row._asdict() for row in query)
+
+
+# bucket of an order from its attribute values, values set by name are turned into their enum member
+def rollup_bucket(date_created, size, flavour, order_status):
+    def member(enum, value):
+        return None if value is None else enum_member(enum, value)
+
+    return (hour_of(date_created), member(Sizes, size), member(OrderFlavour, flavour), member(OrderStatus, order_status))
+
+
+# adds {bucket: [orders, quantity]} to the rollups on the given connection, inside the caller's transaction
+def apply_rollup_deltas(connection, deltas):
+    table = OrderRollup.__table__
+
+    rows = [
+        {'hour': hour, 'size': size, 'flavour': flavour, 'order_status': order_status, 'orders': orders, 'quantity': quantity}
+        for (hour, size, flavour, order_status), (orders, quantity) in deltas.items()
+        if orders or quantity
+    ]
+
+    if not rows:
+        return
+
+    upserts = {'sqlite': sqlite_insert, 'postgresql': postgresql_insert}
+
+    # a single executemany adding to existing buckets and creating the missing ones
+    if connection.dialect.name in upserts:
+        insert = upserts[connection.dialect.name](table)
+
+        connection.execute(
+            insert.on_conflict_do_update(
+                index_elements = ['hour', 'size', 'flavour', 'order_status'],
+                set_ = {
+                    'orders': table.c.orders + insert.excluded.orders,
+                    'quantity': table.c.quantity + insert.excluded.quantity,
+                }
+            ),
+            rows
+        )
+        return
+
+    for row in rows:
+        # a missing value compares with ROLLUP_NONE_CODE
+        match = [table.c[name] == row[name] for name in ('hour', 'size', 'flavour', 'order_status')]
+
+        result = connection.execute(
+            table.update()
+            .where(*match)
+            .values(orders = table.c.orders + row['orders'], quantity = table.c.quantity + row['quantity'])
+        )
+
+        if result.rowcount == 0:
+            connection.execute(table.insert().values(**row))
+
+
+# deltas of rows written by bulk statements, each row is (date_created, size, flavour, order_status, quantity),
+# rows that moved out of previous_status are taken out of its bucket
+def bulk_rollup_deltas(rows, previous_status=None):
+    deltas = defaultdict(lambda: [0, 0])
+
+    for date_created, size, flavour, order_status, quantity in rows:
+        quantity = quantity or 0
+
+        delta = deltas[rollup_bucket(date_created, size, flavour, order_status)]
+        delta[0] += 1
+        delta[1] += quantity
+
+        if previous_status is not None:
+            delta = deltas[rollup_bucket(date_created, size, flavour, previous_status)]
+            delta[0] -= 1
+            delta[1] -= quantity
+
+    return deltas
+
+
+ROLLUP_ATTRIBUTES = ('date_created', 'size', 'flavour', 'order_status')
+
+
+# the value an attribute had before the flush, or its current one when it didn't change
+def previous_value(state, key):
+    history = state.attrs[key].history
+
+    return history.deleted[0] if history.deleted else state.attrs[key].value
+
+
+# ORM writes of single orders move their bucket counts during the flush, bulk statements in
+# Order.bulk_insert and Order.transition_status apply their own deltas
+@db.event.listens_for(Order, 'after_insert')
+def order_inserted(mapper, connection, target):
+    bucket = rollup_bucket(*(getattr(target, key) for key in ROLLUP_ATTRIBUTES))
+
+    apply_rollup_deltas(connection, {bucket: [1, target.quantity or 0]})
+
+
+@db.event.listens_for(Order, 'after_update')
+def order_updated(mapper, connection, target):
+    state = db.inspect(target)
+
+    old = rollup_bucket(*(previous_value(state, key) for key in ROLLUP_ATTRIBUTES))
+    new = rollup_bucket(*(getattr(target, key) for key in ROLLUP_ATTRIBUTES))
+    old_quantity = previous_value(state, 'quantity') or 0
+    new_quantity = target.quantity or 0
+
+    if old == new and old_quantity == new_quantity:
+        return
+
+    deltas = defaultdict(lambda: [0, 0])
+    deltas[old][0] -= 1
+    deltas[old][1] -= old_quantity
+    deltas[new][0] += 1
+    deltas[new][1] += new_quantity
+
+    apply_rollup_deltas(connection, deltas)
+
+
+@db.event.listens_for(Order, 'after_delete')
+def order_deleted(mapper, connection, target):
+    state = db.inspect(target)
+
+    bucket = rollup_bucket(*(previous_value(state, key) for key in ROLLUP_ATTRIBUTES))
+
+    apply_rollup_deltas(connection, {bucket: [-1, -(previous_value(state, 'quantity') or 0)]})
+
+
+# an attribute set before it was loaded has no previous value in its history, active_history
+# makes SQLAlchemy load it first so the old bucket can be decremented
+def keep_previous_value(target, value, oldvalue, initiator):
+    return value
+
+
+for attribute in (Order.size, Order.flavour, Order.quantity, Order.order_status):
+    db.event.listen(attribute, 'set', keep_previous_value, active_history=True, retval=True)
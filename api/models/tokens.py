@@ -0,0 +1,18 @@
+from ..utils import db
+from datetime import datetime
+
+
+# a revoked token (jti set, on logout) or every token of a user issued before revoked_at (user_id set, on
+# deactivation), kept until the tokens it covers have expired anyway
+class TokenRevocation(db.Model):
+    __tablename__ = 'token_revocations'
+
+    id = db.Column(db.Integer(), primary_key = True)
+    jti = db.Column(db.String(36))
+    user_id = db.Column(db.Integer())
+    # what the other processes' syncs look for new revocations by
+    revoked_at = db.Column(db.DateTime(), nullable = False, default = datetime.utcnow, index = True)
+    expires_at = db.Column(db.DateTime(), nullable = False, index = True)
+
+    def __repr__(self):
+        return f"<TokenRevocation {self.jti or self.user_id}>"
@@ -1,5 +1,6 @@
 # getting db from utils dir
 from ..utils import db
+from ..config.config import Config
 
 class User(db.Model):
     __tablename__ = 'users'
@@ -9,10 +10,12 @@ class User(db.Model):
     email = db.Column(db.String(50), nullable = False, unique = True)
     password_hash = db.Column(db.Text(), nullable = False)
     is_staff = db.Column(db.Boolean(), default = False)
-    is_active = db.Column(db.Boolean(), default = False)
+    # inactive users are refused even while they still hold a valid token
+    is_active = db.Column(db.Boolean(), default = True)
     
     # linking order to users
-    orders = db.relationship('Order', backref = 'user', lazy = True)
+    # the loading strategy (select, selectin, joined, dynamic, raise...) is set by USER_ORDERS_LOADING
+    orders = db.relationship('Order', backref = 'user', lazy = Config.USER_ORDERS_LOADING)
 
 
     def __repr__(self):
@@ -25,4 +28,9 @@ class User(db.Model):
     # cls represents the model and can be represented by anything
     @classmethod
     def get_by_id(model, id):
-        return model.query.get_or_404(id)
\ No newline at end of file
+        return model.query.get_or_404(id)
+
+    # cheap EXISTS check for when we only need to know the user is there
+    @classmethod
+    def exists(model, id):
+        return db.session.query(db.exists().where(model.id == id)).scalar()
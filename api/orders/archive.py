@@ -0,0 +1,66 @@
+import click
+from datetime import datetime, timedelta
+from flask import current_app
+from flask.cli import AppGroup
+from ..models.archive import OrderArchive
+from ..models.changes import record_order_change
+from ..models.orders import Order, OrderStatus
+from ..utils import db
+
+ARCHIVED_COLUMNS = ('id', 'size', 'order_status', 'flavour', 'quantity', 'date_created', 'customer')
+
+orders_cli = AppGroup('orders', help='Maintenance of the orders tables.')
+
+
+# moves DELIVERED orders created before `before` to orders_archive, batch_size orders per transaction,
+# returns how many were moved. Rollups are left alone, archived orders still count in the stats. Orders
+# never reuse an id (sqlite_autoincrement on the table), so any of them can go, the newest one included
+def archive_delivered_orders(before, batch_size=1000):
+    moved = 0
+
+    while True:
+        rows = db.session.execute(
+            db.select(Order.id, Order.customer)
+            .where(Order.order_status == OrderStatus.DELIVERED, Order.date_created < before)
+            .order_by(Order.id)
+            .limit(batch_size)
+        ).all()
+
+        if not rows:
+            return moved
+
+        ids = [row.id for row in rows]
+
+        # copied and deleted in one transaction, an order is never in both tables or in neither
+        db.session.execute(
+            db.insert(OrderArchive).from_select(
+                ARCHIVED_COLUMNS + ('archived_at',),
+                db.select(*(getattr(Order, name) for name in ARCHIVED_COLUMNS), db.literal(datetime.utcnow()))
+                .where(Order.id.in_(ids))
+            )
+        )
+        db.session.execute(
+            db.delete(Order).where(Order.id.in_(ids)).execution_options(synchronize_session = False)
+        )
+
+        # bulk statements skip the mapper events, the changes are recorded by hand
+        for row in rows:
+            record_order_change(db.session, 'archive', row.id, row.customer, OrderStatus.DELIVERED)
+
+        db.session.commit()
+
+        moved += len(ids)
+
+
+# flask orders archive --older-than 90
+@orders_cli.command('archive')
+@click.option('--older-than', type=int, default=None, help='Archive orders delivered and created more than this many days ago.')
+@click.option('--batch-size', type=int, default=None, help='Orders moved per transaction.')
+def archive_command(older_than, batch_size):
+    """Move old DELIVERED orders to orders_archive."""
+    older_than = current_app.config['ORDERS_ARCHIVE_AFTER_DAYS'] if older_than is None else older_than
+    batch_size = batch_size or current_app.config['ORDERS_ARCHIVE_BATCH_SIZE']
+
+    moved = archive_delivered_orders(datetime.utcnow() - timedelta(days=older_than), batch_size)
+
+    click.echo(f'Archived {moved} orders')
@@ -0,0 +1,124 @@
+import uuid
+from collections import namedtuple
+from datetime import datetime, timedelta
+from flask import current_app, has_app_context, json
+from werkzeug.http import generate_etag
+from werkzeug.utils import import_string
+from ..models.changes import on_order_change
+from ..utils.replica import reading_from_replica
+
+# a marshalled response body and its ETag, customer is kept so the per-user routes can reuse order entries
+CachedOrder = namedtuple('CachedOrder', ['payload', 'etag', 'customer'])
+CachedOrders = namedtuple('CachedOrders', ['payload', 'etag', 'next_cursor'])
+
+
+def make_etag(payload):
+    return generate_etag(json.dumps(payload, sort_keys=True).encode())
+
+
+EPOCH = datetime(1970, 1, 1)
+
+
+# an order's ETag is its id, creation time in microseconds and version, so If-Match can be checked against the
+# date_created and version columns without reading the order. An order given the id of a deleted one never
+# matches the ETags of the one before it
+def order_etag(order_id, date_created, version):
+    created = 0 if date_created is None else (date_created - EPOCH) // timedelta(microseconds=1)
+
+    return f'{order_id}.{created}.{version}'
+
+
+# (date_created, version) of an ETag made by order_etag for order_id, None when it's for another order or not one
+def parse_order_etag(order_id, etag):
+    prefix = f'{order_id}.'
+    created, _, version = etag[len(prefix):].partition('.')
+
+    if not etag.startswith(prefix) or not created.isdigit() or not version.isdigit():
+        return None
+
+    return EPOCH + timedelta(microseconds=int(created)), int(version)
+
+
+# where the generation of the cache is kept, in the backend so that with a shared backend an invalidation made
+# by one worker process also stops the others from writing back what they read before it
+GENERATION_KEY = ('generation',)
+
+
+# marshalled order_model payloads keyed by order id and by user, dropped as soon as a change to an order commits.
+# A user's pages live under one key, at most max_user_pages of them, the oldest cached are dropped first
+class OrderCache:
+
+    def __init__(self, backend, max_user_pages=20):
+        self.backend = backend
+        self.max_user_pages = max_user_pages
+
+    # taken before reading the database, an invalidation since then means what was read may already be stale.
+    # Every invalidation stores a new value, nothing is counted so the backend needs no atomic increment
+    def generation(self):
+        return self.backend.get(GENERATION_KEY)
+
+    # what was read is only stored while no invalidation has happened since generation was taken. Between the
+    # check and the write of a shared backend another process may still invalidate, the entry then lives on
+    # until its TTL
+    def is_current(self, generation):
+        return self.backend.get(GENERATION_KEY) == generation
+
+    # what was read from the replica may be as far behind as its lag, it's only kept that long
+    def entry_ttl(self):
+        return current_app.config['REPLICA_STICKY_SECONDS'] if reading_from_replica() else None
+
+    def get_order(self, order_id):
+        return self.backend.get(('order', order_id))
+
+    def set_order(self, order_id, customer, date_created, version, payload, generation):
+        entry = CachedOrder(payload, order_etag(order_id, date_created, version), customer)
+
+        if self.is_current(generation):
+            self.backend.set(('order', order_id), entry, self.entry_ttl())
+
+        return entry
+
+    # every page of a user's orders lives under one key so a single delete invalidates them all
+    def get_user_orders(self, user_id, page):
+        return self.backend.get(('user_orders', user_id), {}).get(page)
+
+    def set_user_orders(self, user_id, page, payload, next_cursor, generation):
+        entry = CachedOrders(payload, make_etag(payload), next_cursor)
+
+        if self.is_current(generation):
+            pages = dict(self.backend.get(('user_orders', user_id), {}))
+            pages.pop(page, None)
+            pages[page] = entry
+
+            while len(pages) > self.max_user_pages:
+                del pages[next(iter(pages))]
+
+            self.backend.set(('user_orders', user_id), pages, self.entry_ttl())
+
+        return entry
+
+    def invalidate(self, order_id, customer):
+        self.backend.set(GENERATION_KEY, uuid.uuid4().hex)
+        self.backend.delete(('order', order_id))
+        self.backend.delete(('user_orders', customer))
+
+
+def init_order_cache(app):
+    backend_class = import_string(app.config['ORDER_CACHE_BACKEND'])
+
+    app.extensions['order_cache'] = OrderCache(
+        backend_class(maxsize=app.config['ORDER_CACHE_SIZE'], ttl=app.config['ORDER_CACHE_TTL']),
+        max_user_pages=app.config['ORDER_CACHE_USER_PAGES']
+    )
+
+
+# runs after commit, so a client reading right after its own write never gets the old order back
+@on_order_change
+def invalidate_changed_orders(changes):
+    if not has_app_context() or 'order_cache' not in current_app.extensions:
+        return
+
+    cache = current_app.extensions['order_cache']
+
+    for change in changes:
+        cache.invalidate(change.id, change.customer)
@@ -0,0 +1,56 @@
+from flask import current_app, has_app_context
+from werkzeug.utils import import_string
+from ..models.changes import on_order_change
+from ..utils.encoding import fast_dumps
+from .serializers import STATUS_LABELS
+
+
+def user_channel(user_id):
+    return f'user:{user_id}'
+
+
+def init_event_broker(app):
+    broker_class = import_string(app.config['EVENT_BROKER'])
+
+    app.extensions['event_broker'] = broker_class(
+        queue_size=app.config['EVENT_QUEUE_SIZE'],
+        policy=app.config['EVENT_DROP_POLICY']
+    )
+
+
+# every committed order change is published on the channel of the user who placed the order
+@on_order_change
+def publish_order_changes(changes):
+    if not has_app_context() or 'event_broker' not in current_app.extensions:
+        return
+
+    broker = current_app.extensions['event_broker']
+
+    for change in changes:
+        if change.customer is None:
+            continue
+
+        broker.publish(user_channel(change.customer), {
+            'action': change.action,
+            'id': change.id,
+            'order_status': STATUS_LABELS.get(change.order_status),
+        })
+
+
+# Server-Sent Events for one subscription, a comment line every keepalive seconds keeps idle connections open
+# and lets the server notice clients that have gone away
+def event_stream(subscription, keepalive):
+    try:
+        # clients reconnect after 3s if the connection drops
+        yield 'retry: 3000\n\n'
+
+        while not subscription.closed:
+            event = subscription.get(timeout=keepalive)
+
+            if event is None:
+                yield ': keepalive\n\n'
+                continue
+
+            yield f"event: order\ndata: {fast_dumps(event)}\n\n"
+    finally:
+        subscription.close()
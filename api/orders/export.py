@@ -0,0 +1,167 @@
+import csv
+import io
+import zlib
+import click
+from flask import current_app
+from ..models.archive import OrderArchive
+from ..models.orders import Order, OrderStatus
+from ..utils import db
+from ..utils.encoding import fast_dumps
+from ..utils.pagination import encode_cursor, keyset_after
+from .archive import orders_cli
+
+# what accounting gets per order, cursor is where an export cut short after this order picks up again
+EXPORT_FIELDS = ('id', 'customer', 'size', 'flavour', 'quantity', 'order_status', 'date_created', 'cursor')
+EXPORT_COLUMNS = ('id', 'customer', 'size', 'flavour', 'quantity', 'order_status', 'date_created')
+# delivered orders moved to the archive are still orders accounting wants, both tables are exported as one
+EXPORTED_MODELS = (Order, OrderArchive)
+
+EXPORT_MIMETYPES = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+
+
+# statuses are OrderStatus names, dates are a half open range on date_created like the order filters
+def export_criteria(model, statuses=(), date_from=None, date_to=None):
+    criteria = []
+
+    if statuses:
+        criteria.append(model.order_status.in_([OrderStatus[status] for status in statuses]))
+
+    if date_from:
+        criteria.append(model.date_created >= date_from)
+
+    if date_to:
+        criteria.append(model.date_created < date_to)
+
+    return criteria
+
+
+# the export columns of the rows of model's table matching filters (the arguments of export_criteria) after cursor
+def export_select(model, filters, cursor=None):
+    query = db.select(*(getattr(model, name) for name in EXPORT_COLUMNS)).where(*export_criteria(model, **filters))
+
+    if cursor:
+        query = keyset_after(query, model, cursor)
+
+    return query
+
+
+# one query over the export columns of orders and of the archive (UNION ALL, ids are never shared between the
+# two so (date_created, id) still orders and resumes the export), read from the database batch_size rows at a
+# time (yield_per streams the result), so neither ORM objects nor the whole result set are ever held in memory.
+# raises ValueError for a bad cursor before anything is read
+def export_batches(filters, batch_size, cursor=None):
+    rows = db.union_all(*(export_select(model, filters, cursor) for model in EXPORTED_MODELS)).subquery()
+
+    query = db.select(rows).order_by(rows.c.date_created, rows.c.id).execution_options(yield_per=batch_size)
+
+    def batches():
+        yield from db.session.execute(query).partitions()
+
+    return batches()
+
+
+def export_record(row):
+    id, customer, size, flavour, quantity, order_status, date_created = row
+
+    return (
+        id,
+        customer,
+        None if size is None else size.name,
+        None if flavour is None else str(flavour),
+        quantity,
+        None if order_status is None else order_status.name,
+        None if date_created is None else date_created.isoformat(),
+        encode_cursor(date_created, id),
+    )
+
+
+def ndjson_chunks(batches):
+    for batch in batches:
+        yield ''.join(fast_dumps(dict(zip(EXPORT_FIELDS, export_record(row)))) + '\n' for row in batch)
+
+
+def csv_chunks(batches, header=True):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    if header:
+        writer.writerow(EXPORT_FIELDS)
+
+    for batch in batches:
+        writer.writerows(export_record(row) for row in batch)
+
+        yield buffer.getvalue()
+
+        buffer.seek(0)
+        buffer.truncate()
+
+    # the header alone when nothing matched
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+# text chunks of the export in format (csv or ndjson), one per batch
+def export_chunks(batches, format, header=True):
+    return csv_chunks(batches, header) if format == 'csv' else ndjson_chunks(batches)
+
+
+# gzip compresses the chunks as they go by. Every chunk is flushed so the client keeps receiving data and a
+# download cut short still decompresses up to its last whole batch; gzip files can be concatenated, so the
+# export resumed from a cursor may simply be appended to it
+def gzip_chunks(chunks, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    for chunk in chunks:
+        yield compressor.compress(chunk.encode()) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    yield compressor.flush()
+
+
+# flask orders export --format csv --status PENDING --date-from 2023-01-01 --gzip -o orders.csv.gz
+@orders_cli.command('export')
+@click.option('--format', 'format', type=click.Choice(list(EXPORT_MIMETYPES)), default='csv', show_default=True)
+@click.option('--status', 'statuses', type=click.Choice([status.name for status in OrderStatus]), multiple=True,
+              help='Only orders in this status, may be given several times.')
+@click.option('--date-from', type=click.DateTime(), default=None, help='Orders created at or after this date.')
+@click.option('--date-to', type=click.DateTime(), default=None, help='Orders created before this date.')
+@click.option('--cursor', default=None, help='Resume after the order this cursor was exported with.')
+@click.option('--gzip', 'compress', is_flag=True, help='Compress the output with gzip.')
+@click.option('--batch-size', type=int, default=None, help='Rows read from the database at a time.')
+@click.option('-o', '--output', type=click.Path(dir_okay=False, writable=True), default='-',
+              help='File to write the export to, a resumed export (--cursor) is appended to it. stdout by default.')
+def export_command(format, statuses, date_from, date_to, cursor, compress, batch_size, output):
+    """Stream orders, archived ones included, as CSV or NDJSON."""
+    batch_size = batch_size or current_app.config['ORDERS_EXPORT_BATCH_SIZE']
+
+    try:
+        batches = export_batches(dict(statuses=statuses, date_from=date_from, date_to=date_to), batch_size, cursor)
+    except ValueError as error:
+        raise click.BadParameter(str(error), param_hint='--cursor')
+
+    exported = 0
+    last = None
+
+    # counts what went out on the way through
+    def counted(batches):
+        nonlocal exported, last
+
+        for batch in batches:
+            exported += len(batch)
+            last = batch[-1]
+            yield batch
+
+    # a resumed CSV export is appended to the first one, it doesn't repeat the header
+    chunks = export_chunks(counted(batches), format, header=not cursor)
+
+    # opened once the cursor is known to be good, a new export replaces what the file held
+    with click.open_file(output, 'ab' if cursor else 'wb') as stream:
+        for chunk in gzip_chunks(chunks) if compress else (chunk.encode() for chunk in chunks):
+            stream.write(chunk)
+            stream.flush()
+
+    message = f'Exported {exported} orders'
+
+    if last is not None:
+        message += f', the next export resumes with --cursor {encode_cursor(last.date_created, last.id)}'
+
+    click.echo(message, err=True)
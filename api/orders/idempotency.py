@@ -0,0 +1,144 @@
+import hashlib
+from collections import namedtuple
+from datetime import datetime, timedelta
+from threading import Event, Lock
+from flask import json
+from sqlalchemy.exc import IntegrityError
+from ..models.idempotency import IDEMPOTENCY_KEY_MAX_LENGTH, IdempotencyKey
+from ..utils import db
+from ..utils.cache import TTLCache
+
+# what is replayed to a retry
+StoredResponse = namedtuple('StoredResponse', ['fingerprint', 'status_code', 'payload'])
+
+
+# the key was already used for a request with a different body
+class IdempotencyKeyReused(Exception):
+    pass
+
+
+# the first request with the key is still running and didn't finish within the wait timeout
+class IdempotencyKeyInProgress(Exception):
+    pass
+
+
+# a key the idempotency_keys table can hold: not empty and no longer than its column
+def valid_idempotency_key(key):
+    return 0 < len(key) <= IDEMPOTENCY_KEY_MAX_LENGTH
+
+
+# hash of a JSON body that doesn't depend on the order of its keys
+def request_fingerprint(data):
+    return hashlib.sha256(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+
+# runs a request once per (scope, key): the response is stored in the idempotency_keys table in the same transaction
+# as the request's own writes and kept in a TTL cache in front of it, retries get the stored response back
+class IdempotencyStore:
+
+    def __init__(self, cache_size=10000, cache_ttl=300, key_ttl=86400, wait_timeout=10):
+        self.cache = TTLCache(maxsize=cache_size, ttl=cache_ttl)
+        self.key_ttl = key_ttl
+        self.wait_timeout = wait_timeout
+        # (scope, key) of the requests running in this process, duplicates wait on the Event
+        self._in_flight = {}
+        self._lock = Lock()
+
+    # stored response of a key, from the cache or else the table
+    def lookup(self, scope, key):
+        stored = self.cache.get((scope, key))
+
+        if stored is not None:
+            return stored
+
+        row = (
+            db.session.query(IdempotencyKey.fingerprint, IdempotencyKey.status_code, IdempotencyKey.response)
+            .filter(IdempotencyKey.scope == scope, IdempotencyKey.key == key, IdempotencyKey.expires_at > datetime.utcnow())
+            .first()
+        )
+
+        if row is None:
+            return None
+
+        stored = StoredResponse(row.fingerprint, row.status_code, json.loads(row.response))
+        self.cache.set((scope, key), stored)
+
+        return stored
+
+    # returns (payload, status_code, replayed). handler() adds the request's writes to db.session without committing
+    # and returns (payload, status_code), they are committed together with the stored response
+    def run(self, scope, key, fingerprint, handler):
+        while True:
+            stored = self.lookup(scope, key)
+
+            if stored is not None:
+                return self.replay(stored, fingerprint)
+
+            with self._lock:
+                event = self._in_flight.get((scope, key))
+                leader = event is None
+
+                if leader:
+                    event = self._in_flight[(scope, key)] = Event()
+
+            if leader:
+                break
+
+            # a duplicate of a request still running here waits for its response instead of running again,
+            # when the first request failed nothing was stored and the duplicate gets to run it itself
+            if not event.wait(self.wait_timeout):
+                raise IdempotencyKeyInProgress(key)
+
+        try:
+            return self.execute(scope, key, fingerprint, handler)
+        finally:
+            with self._lock:
+                del self._in_flight[(scope, key)]
+
+            event.set()
+
+    def execute(self, scope, key, fingerprint, handler):
+        payload, status_code = handler()
+
+        now = datetime.utcnow()
+
+        # keys are only kept for key_ttl seconds
+        db.session.execute(db.delete(IdempotencyKey).where(IdempotencyKey.expires_at <= now))
+
+        db.session.add(IdempotencyKey(
+            scope=scope, key=key, fingerprint=fingerprint, status_code=status_code,
+            response=json.dumps(payload), created_at=now, expires_at=now + timedelta(seconds=self.key_ttl)
+        ))
+
+        try:
+            db.session.commit()
+        except IntegrityError:
+            # another process stored a response for the key first, its writes win and ours are rolled back
+            db.session.rollback()
+
+            stored = self.lookup(scope, key)
+
+            if stored is None:
+                raise
+
+            return self.replay(stored, fingerprint)
+
+        stored = StoredResponse(fingerprint, status_code, payload)
+        self.cache.set((scope, key), stored)
+
+        return payload, status_code, False
+
+    def replay(self, stored, fingerprint):
+        if stored.fingerprint != fingerprint:
+            raise IdempotencyKeyReused(fingerprint)
+
+        return stored.payload, stored.status_code, True
+
+
+def init_idempotency_store(app):
+    app.extensions['idempotency'] = IdempotencyStore(
+        cache_size=app.config['IDEMPOTENCY_CACHE_SIZE'],
+        cache_ttl=app.config['IDEMPOTENCY_CACHE_TTL'],
+        key_ttl=app.config['IDEMPOTENCY_KEY_TTL'],
+        wait_timeout=app.config['IDEMPOTENCY_WAIT_TIMEOUT']
+    )
@@ -0,0 +1,53 @@
+import urllib.request
+from flask import current_app, has_app_context, json
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from ..utils.jobs import enqueue, task
+
+
+# what a job gets to know about an order change, JSON encodable
+def change_payload(change):
+    return {
+        'action': change.action,
+        'id': change.id,
+        'customer': change.customer,
+        'order_status': None if change.order_status is None else change.order_status.name,
+        'date_created': None if change.date_created is None else change.date_created.isoformat(),
+        'size': getattr(change.size, 'name', change.size),
+        'quantity': change.quantity,
+    }
+
+
+# every transaction changing orders enqueues one job per task of ORDER_JOB_TASKS with the list of its changes,
+# inserted in that same transaction so the jobs exist if and only if the changes were committed
+@event.listens_for(Session, 'before_commit')
+def enqueue_order_jobs(session):
+    if not has_app_context() or not current_app.config['ORDER_JOB_TASKS']:
+        return
+
+    # the changes of the objects still pending are only recorded when they're flushed
+    session.flush()
+
+    changes = session.info.get('order_changes')
+
+    if not changes:
+        return
+
+    payload = [change_payload(change) for change in changes]
+
+    for name in current_app.config['ORDER_JOB_TASKS']:
+        enqueue(session, name, payload)
+
+
+# POSTs the changes to ORDER_WEBHOOK_URL, a response other than 2xx fails the job and it's retried
+@task('orders.webhook')
+def order_webhook(changes):
+    config = current_app.config
+
+    request = urllib.request.Request(
+        config['ORDER_WEBHOOK_URL'], data=json.dumps({'changes': changes}).encode(),
+        headers={'Content-Type': 'application/json'}, method='POST'
+    )
+
+    with urllib.request.urlopen(request, timeout=config['ORDER_WEBHOOK_TIMEOUT']):
+        pass
@@ -0,0 +1,181 @@
+import heapq
+import time
+from datetime import datetime, timedelta
+from threading import Lock
+from flask import current_app, has_app_context
+from ..models.changes import on_order_change
+from ..models.orders import Order, OrderStatus, Sizes
+from ..utils import db
+from .serializers import order_rows
+
+
+def init_kitchen_queue(app):
+    app.extensions['kitchen_queue'] = KitchenQueue(
+        prep_seconds=app.config['KITCHEN_PREP_SECONDS'],
+        sync_interval=app.config['KITCHEN_QUEUE_SYNC_INTERVAL'],
+        sync_overlap=app.config['KITCHEN_QUEUE_SYNC_OVERLAP']
+    )
+
+
+# PENDING orders in the order the kitchen should make them, kept in a heap so the next one is found in O(log n).
+# An order's place is the time it would be ready if started right away: date_created plus the prep time of its
+# size for every pizza, so small orders get ahead of big ones placed a little earlier but never of old ones.
+# The heap is loaded from the orders table on first use, kept up to date from the order changes of this
+# process, and orders placed by other processes are read every sync_interval seconds
+class KitchenQueue:
+
+    def __init__(self, prep_seconds, sync_interval=5, sync_overlap=60, timer=time.monotonic):
+        self.prep_seconds = prep_seconds
+        self.sync_interval = sync_interval
+        self.sync_overlap = sync_overlap
+        self.timer = timer
+        # heap of [ready_by, id, queued], an entry is switched off instead of being searched for in the heap
+        self._heap = []
+        # id -> its live heap entry
+        self._entries = {}
+        # date_created the last sync started at, None until the first one has loaded every PENDING order
+        self._synced_at = None
+        self._next_sync = 0
+        self._lock = Lock()
+        self._sync_lock = Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def ready_by(self, date_created, size, quantity):
+        if isinstance(size, Sizes):
+            size = size.name
+
+        return date_created + timedelta(seconds=self.prep_seconds[size or Sizes.SMALL.name] * (quantity or 1))
+
+    def push(self, id, date_created, size, quantity):
+        entry = [self.ready_by(date_created, size, quantity), id, True]
+
+        with self._lock:
+            previous = self._entries.pop(id, None)
+
+            if previous is not None:
+                previous[2] = False
+
+            self._entries[id] = entry
+            heapq.heappush(self._heap, entry)
+
+            # switched off entries are dropped once they outnumber the queued ones
+            if len(self._heap) > 2 * len(self._entries) + 64:
+                self._heap = [entry for entry in self._heap if entry[2]]
+                heapq.heapify(self._heap)
+
+    def discard(self, id):
+        with self._lock:
+            entry = self._entries.pop(id, None)
+
+            if entry is not None:
+                entry[2] = False
+
+    # ids of the first n orders in line, they stay queued
+    def peek(self, n):
+        self.sync()
+
+        with self._lock:
+            entries = []
+
+            while self._heap and len(entries) < n:
+                entry = heapq.heappop(self._heap)
+
+                if entry[2]:
+                    entries.append(entry)
+
+            for entry in entries:
+                heapq.heappush(self._heap, entry)
+
+        return [entry[1] for entry in entries]
+
+    # reads the PENDING orders placed lately, all of them the first time. Another process's changes to orders
+    # already queued aren't read back, the kitchen routes check the orders they hand out are still PENDING
+    def sync(self):
+        if self.timer() < self._next_sync or not self._sync_lock.acquire(blocking=False):
+            return
+
+        try:
+            self._sync()
+        finally:
+            self._sync_lock.release()
+
+    def _sync(self):
+        started = datetime.utcnow()
+
+        # after the first load only the orders placed since the previous sync started, less sync_overlap seconds,
+        # are read from the partial index of PENDING orders. Not the ids past the highest one seen: SQLite hands
+        # out a deleted id again and an order can commit some time after it was stamped with date_created
+        query = (
+            db.select(Order.id, Order.date_created, Order.size, Order.quantity)
+            .where(Order.order_status == OrderStatus.PENDING)
+        )
+
+        if self._synced_at is not None:
+            query = query.where(Order.date_created >= self._synced_at - timedelta(seconds=self.sync_overlap))
+
+        # on its own connection so the request's transaction is left alone
+        with db.engine.connect() as connection:
+            rows = connection.execute(query).all()
+
+        for id, date_created, size, quantity in rows:
+            if id not in self._entries:
+                self.push(id, date_created, size, quantity)
+
+        self._synced_at = started
+
+        self._next_sync = self.timer() + self.sync_interval
+
+
+# the first n orders in line as order rows, orders another process has moved on or deleted are dropped from
+# the queue on the way
+def next_orders(queue, n):
+    while True:
+        ids = queue.peek(n)
+
+        # looked up by primary key, there are only n of them, and the status checked on the rows
+        rows = {row.id: row for row in order_rows().filter(Order.id.in_(ids)) if row.order_status == OrderStatus.PENDING}
+
+        if len(rows) == len(ids):
+            return [rows[id] for id in ids]
+
+        for id in ids:
+            if id not in rows:
+                queue.discard(id)
+
+
+# moves the first order in line, or order_id, from PENDING to IN_TRANSIT in one compare-and-set UPDATE and
+# returns its row. None when the queue is empty or when order_id is no longer PENDING
+def claim_order(queue, order_id=None):
+    if order_id is not None:
+        return Order.compare_and_set_status(order_id, OrderStatus.IN_TRANSIT)
+
+    while True:
+        ids = queue.peek(1)
+
+        if not ids:
+            return None
+
+        row = Order.compare_and_set_status(ids[0], OrderStatus.IN_TRANSIT)
+
+        if row is not None:
+            return row
+
+        # taken by someone else in the meantime, the order is gone from the line either way
+        queue.discard(ids[0])
+
+
+# orders leave the line when they move on from PENDING or are deleted or archived, and are placed again when edited
+@on_order_change
+def update_kitchen_queue(changes):
+    if not has_app_context() or 'kitchen_queue' not in current_app.extensions:
+        return
+
+    queue = current_app.extensions['kitchen_queue']
+
+    for change in changes:
+        if change.action not in ('delete', 'archive') and change.order_status == OrderStatus.PENDING and change.date_created is not None:
+            queue.push(change.id, change.date_created, change.size, change.quantity)
+        elif change.action != 'insert':
+            queue.discard(change.id)
@@ -0,0 +1,47 @@
+from ..models.orders import Order, Sizes, OrderStatus, OrderFlavour
+from ..models.archive import OrderArchive
+
+# the columns order_model reads, selected as plain rows so no ORM objects or identity map are built.
+# date_created and id are also what the keyset cursors are made of
+ORDER_COLUMNS = (Order.id, Order.size, Order.order_status, Order.flavour, Order.quantity, Order.date_created)
+ARCHIVED_ORDER_COLUMNS = (
+    OrderArchive.id, OrderArchive.size, OrderArchive.order_status, OrderArchive.flavour, OrderArchive.quantity,
+    OrderArchive.date_created
+)
+
+# fields.String renders an enum member with str(), looked up once here instead of per row
+SIZE_LABELS = {size: str(size) for size in Sizes}
+SIZE_LABELS[None] = None
+
+STATUS_LABELS = {status: str(status) for status in OrderStatus}
+STATUS_LABELS[None] = None
+
+FLAVOUR_LABELS = {flavour: str(flavour) for flavour in OrderFlavour}
+FLAVOUR_LABELS[None] = None
+
+
+# same dict, key for key and value for value, as marshal(order, order_model)
+def serialize_order(row):
+    id, size, order_status, flavour, quantity = row[:5]
+
+    return {
+        'id': id,
+        'size': SIZE_LABELS[size],
+        'order_status': STATUS_LABELS[order_status],
+        'flavour': FLAVOUR_LABELS[flavour],
+        'quantity': quantity,
+    }
+
+
+def serialize_orders(rows):
+    return [serialize_order(row) for row in rows]
+
+
+# projection query over the orders table, for use with the serializers above
+def order_rows():
+    return Order.query.with_entities(*ORDER_COLUMNS)
+
+
+# the same projection over orders_archive
+def archived_order_rows():
+    return OrderArchive.query.with_entities(*ARCHIVED_ORDER_COLUMNS)
@@ -0,0 +1,72 @@
+import click
+from enum import Enum
+from ..models.orders import OrderFlavour, OrderStatus
+from ..models.rollups import OrderRollup, aggregate_orders, aggregate_rollups, hour_of
+from .archive import orders_cli
+
+# what the stats can be grouped by
+STATS_GROUPS = ('hour', 'size', 'flavour', 'order_status')
+
+
+# the rollups hold whole hours, so they answer any range whose bounds fall on the hour
+def rollups_cover(date_from, date_to):
+    return all(date is None or date == hour_of(date) for date in (date_from, date_to))
+
+
+# grouped order counts and quantity sums, read from the rollups when they can answer the range and
+# computed with a GROUP BY over the orders and the archived orders otherwise, returns the source used and the rows
+def order_stats(group_by, date_from=None, date_to=None, source=None):
+    if source is None:
+        source = 'rollups' if rollups_cover(date_from, date_to) else 'orders'
+
+    aggregate = aggregate_rollups if source == 'rollups' else aggregate_orders
+
+    return source, [serialize_stats_row(row) for row in aggregate(group_by, date_from, date_to)]
+
+
+# enums by name and hours in ISO 8601, the way they are sent in the query string. Flavours are shown the way
+# the orders show them
+def serialize_stats_row(row):
+    for key, value in row.items():
+        if isinstance(value, OrderFlavour):
+            row[key] = str(value)
+        elif isinstance(value, Enum):
+            row[key] = value.name
+        elif key == 'hour' and value is not None:
+            row[key] = value.isoformat()
+
+    row['orders'] = int(row['orders'])
+    row['quantity'] = int(row['quantity'])
+
+    return row
+
+
+# orders per status in the order they move through, each with how many reached at least that status
+def status_funnel(rows):
+    totals = {row['order_status']: row for row in rows}
+
+    funnel = []
+    reached = sum(row['orders'] for row in rows)
+
+    for status in OrderStatus:
+        row = totals.get(status.name, {'orders': 0, 'quantity': 0})
+
+        funnel.append({
+            'order_status': status.name,
+            'orders': row['orders'],
+            'quantity': row['quantity'],
+            'reached': reached,
+        })
+
+        reached -= row['orders']
+
+    return funnel
+
+
+# flask orders rebuild-rollups, after a crash or a manual change to the orders the rollups no longer agree with
+@orders_cli.command('rebuild-rollups')
+def rebuild_rollups_command():
+    """Recompute the hourly order rollups from the orders and the archived orders."""
+    OrderRollup.rebuild()
+
+    click.echo(f'Rebuilt {OrderRollup.query.count()} rollup buckets')
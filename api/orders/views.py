@@ -1,9 +1,26 @@
-from flask_restx import Namespace, Resource, fields
-from ..models.orders import Order
+from flask_restx import Namespace, Resource, fields, inputs, marshal
+from flask import Response, current_app, json, request, stream_with_context
+from ..models.orders import Order, OrderFlavour, OrderStatus, Sizes, ORDER_STATUS_TRANSITIONS
 from http import HTTPStatus
-from flask_jwt_extended import jwt_required, get_jwt_identity
+from flask_jwt_extended import jwt_required, get_jwt, get_jwt_identity
 from ..models.users import User
 from ..utils import db
+from ..auth.identity import current_identity
+from werkzeug.http import quote_etag
+from sqlalchemy.orm.exc import StaleDataError
+from ..utils.codes import enum_member
+from ..utils.encoding import fast_dumps
+from ..utils.instrumentation import phase
+from .cache import order_etag, parse_order_etag
+from .events import event_stream, user_channel
+from .export import EXPORT_MIMETYPES, export_batches, export_chunks, gzip_chunks
+from .kitchen import claim_order, next_orders
+from .serializers import archived_order_rows, order_rows, serialize_order, serialize_orders
+from .stats import STATS_GROUPS, order_stats, status_funnel
+from .idempotency import IdempotencyKeyInProgress, IdempotencyKeyReused, request_fingerprint, valid_idempotency_key
+from ..utils.replica import replica_reads
+from ..utils.pagination import decode_cursor, keyset_page, keyset_batches, keyset_merge_page
+from ..models.archive import OrderArchive
 
 order_namespace = Namespace('orders', description= 'name space for orders')
 
@@ -16,11 +33,23 @@ order_model = order_namespace.model(
         'order_status': fields.String(description='The Status of our Order', required= True,
                                       enum= ['PENDING', 'IN_TRANSIT','DELIVERED']
         ),
-        'flavour': fields.String(description= 'Flavour of pizza', required = True),
+        'flavour': fields.String(description= 'Flavour of pizza, by name or as shown in any case. Always returned as shown, '
+                                              'in lower case, not as it was sent', required = True,
+                                 enum=[str(flavour) for flavour in OrderFlavour]
+        ),
         'quantity' : fields.Integer(description= 'Quantity of pizza', required = True)
     }
 )
 
+order_bulk_result_model = order_namespace.model(
+    'OrderBulkResult', {
+        'index': fields.Integer(description='Position of the order in the request'),
+        'status': fields.Integer(description='201 when the order was created, 400 when it was rejected'),
+        'id': fields.Integer(description='ID of the created order'),
+        'errors': fields.Raw(description='Why the order was rejected')
+    }
+)
+
 order_status_model = order_namespace.model(
     'OrderStatus', {
         'order_status': fields.String(required=True, description = 'Order Status', 
@@ -29,30 +58,246 @@ order_status_model = order_namespace.model(
     }
 )
 
+order_stats_model = order_namespace.model(
+    'OrderStats', {
+        'source': fields.String(description = 'rollups when the hourly rollups answered the query, orders when the orders table was aggregated'),
+        'groups': fields.List(fields.Raw, description = 'One row per group with its keys, the number of orders and their total quantity')
+    }
+)
+
+order_funnel_model = order_namespace.model(
+    'OrderFunnel', {
+        'source': fields.String(description = 'rollups or orders, see OrderStats'),
+        'funnel': fields.List(fields.Raw, description = 'Orders and quantity per status, and how many orders reached at least that status')
+    }
+)
+
+kitchen_claim_model = order_namespace.model(
+    'KitchenClaim', {
+        'id': fields.Integer(description = 'ID of the order to claim, the first order in line when left out')
+    }
+)
+
+order_bulk_status_model = order_namespace.inherit(
+    'OrderBulkStatus', order_status_model, {
+        'ids': fields.List(fields.Integer, description = 'IDs of the orders to move'),
+        'filter': fields.Raw(description = 'Move every order matching these filters instead: size, customer, date_from, date_to')
+    }
+)
+
+order_bulk_status_result_model = order_namespace.model(
+    'OrderBulkStatusResult', {
+        'order_status': fields.String(description = 'The status the orders were moved to'),
+        'updated': fields.List(fields.Integer, description = 'IDs of the orders that were moved'),
+        'skipped': fields.List(fields.Integer, description = 'Requested IDs that were missing or not in the preceding status')
+    }
+)
+
+# query string accepted by every paginated orders endpoint
+order_page_parser = order_namespace.parser()
+order_page_parser.add_argument('limit', type=int, location='args', help='Maximum number of orders to return')
+order_page_parser.add_argument('cursor', type=str, location='args', help='Cursor of the next page, taken from the X-Next-Cursor header')
+
+# query string of a user's orders
+user_orders_parser = order_page_parser.copy()
+user_orders_parser.add_argument('include_archived', type=inputs.boolean, location='args', default=False,
+                                help='Also return the delivered orders moved to the archive')
+
+# query string accepted by the orders list and stream endpoints
+order_filter_parser = order_page_parser.copy()
+order_filter_parser.add_argument('order_status', type=str, location='args', choices=[status.name for status in OrderStatus])
+order_filter_parser.add_argument('size', type=str, location='args', choices=[size.name for size in Sizes])
+order_filter_parser.add_argument('customer', type=int, location='args', help='ID of the user that placed the order')
+order_filter_parser.add_argument('date_from', type=inputs.datetime_from_iso8601, location='args', help='Orders created at or after this ISO 8601 date')
+order_filter_parser.add_argument('date_to', type=inputs.datetime_from_iso8601, location='args', help='Orders created before this ISO 8601 date')
+
+# query string of the export
+order_export_parser = order_namespace.parser()
+order_export_parser.add_argument('format', type=str, location='args', choices=list(EXPORT_MIMETYPES), default='csv')
+order_export_parser.add_argument('order_status', type=str, location='args', action='append', choices=[status.name for status in OrderStatus],
+                                 help='Only orders in this status, may be given several times')
+order_export_parser.add_argument('date_from', type=inputs.datetime_from_iso8601, location='args', help='Orders created at or after this ISO 8601 date')
+order_export_parser.add_argument('date_to', type=inputs.datetime_from_iso8601, location='args', help='Orders created before this ISO 8601 date')
+order_export_parser.add_argument('cursor', type=str, location='args', help='Resume after the order exported with this cursor')
+order_export_parser.add_argument('gzip', type=inputs.boolean, location='args', default=False, help='Send the export gzip compressed')
+
+# query string of the kitchen queue
+kitchen_next_parser = order_namespace.parser()
+kitchen_next_parser.add_argument('n', type=inputs.positive, location='args', default=1, help='Number of orders to return')
+
+# query string accepted by the stats endpoints
+order_stats_parser = order_namespace.parser()
+order_stats_parser.add_argument('date_from', type=inputs.datetime_from_iso8601, location='args', help='Orders created at or after this ISO 8601 date')
+order_stats_parser.add_argument('date_to', type=inputs.datetime_from_iso8601, location='args', help='Orders created before this ISO 8601 date')
+order_stats_parser.add_argument('source', type=str, location='args', choices=['rollups', 'orders'],
+                                help='Force the hourly rollups or the orders table, by default the rollups are used whenever both dates fall on the hour')
+
+order_stats_group_parser = order_stats_parser.copy()
+order_stats_group_parser.add_argument('group_by', type=str, location='args', default='order_status',
+                                      help=f"Comma separated list of {', '.join(STATS_GROUPS)}")
+
+
+# turns the order filters into SQL criteria, shared by the list queries and bulk updates
+def order_criteria(args):
+    criteria = []
+
+    if args.get('order_status'):
+        criteria.append(Order.order_status == OrderStatus[args['order_status']])
+
+    if args.get('size'):
+        criteria.append(Order.size == Sizes[args['size']])
+
+    if args.get('customer') is not None:
+        criteria.append(Order.customer == args['customer'])
+
+    if args.get('date_from'):
+        criteria.append(Order.date_created >= args['date_from'])
+
+    if args.get('date_to'):
+        criteria.append(Order.date_created < args['date_to'])
+
+    return criteria
+
+
+# builds the filtered orders query, every filter is applied in SQL and only the serialized columns are selected
+def filter_orders(args):
+    return order_rows().filter(*order_criteria(args))
+
+
+# id of the current user, from the token claims and the identity cache rather than a users query. A deactivated
+# user is refused whether the token carries its id or, issued before the user_id claim, only its username
+def current_customer_id():
+    identity = current_identity()
+
+    if (identity is not None and not identity.is_active) or (identity is None and get_jwt().get('user_id') is not None):
+        order_namespace.abort(HTTPStatus.UNAUTHORIZED, "User is deactivated")
+
+    return identity.id if identity is not None else None
+
+
+# refuses the request unless it comes from an active staff user
+def require_staff():
+    identity = current_identity()
+
+    if identity is None or not identity.is_active or not identity.is_staff:
+        order_namespace.abort(HTTPStatus.FORBIDDEN, "Only staff can do this")
+
+
+# the OrderFlavour of an order payload, sent by name or as shown ('PEPPERONI', 'pork') in any case
+def payload_flavour(data):
+    try:
+        return enum_member(OrderFlavour, data.get('flavour'))
+    except ValueError as error:
+        order_namespace.abort(HTTPStatus.BAD_REQUEST, str(error))
+
+
+# checks one order of a bulk request against order_model, returning a dict of field errors
+def validate_order(data):
+    if not isinstance(data, dict):
+        return {'order': 'An order must be a JSON object'}
+
+    errors = {}
+
+    if data.get('size') not in order_model['size'].enum:
+        errors['size'] = f"'{data.get('size')}' is not one of {order_model['size'].enum}"
+
+    if not isinstance(data.get('quantity'), int) or isinstance(data.get('quantity'), bool) or data['quantity'] < 1:
+        errors['quantity'] = 'Quantity must be a positive integer'
+
+    try:
+        enum_member(OrderFlavour, data.get('flavour'))
+    except ValueError as error:
+        errors['flavour'] = str(error)
+
+    return errors
+
+
+# answers from a cached entry: 304 with no body when the client already has this version, the payload otherwise
+def conditional_response(entry, headers=None):
+    headers = dict(headers or {}, ETag=quote_etag(entry.etag))
+
+    if request.if_none_match.contains(entry.etag):
+        return Response(status=HTTPStatus.NOT_MODIFIED, headers=headers)
+
+    return entry.payload, HTTPStatus.OK, headers
+
+
+# (date_created, version) of the copies of the order listed in If-Match, None when the header is missing or is *
+# and any version will do
+def if_match_versions(order_id):
+    if not request.if_match or request.if_match.star_tag:
+        return None
+
+    versions = (parse_order_etag(order_id, etag) for etag in request.if_match.as_set())
+
+    return [version for version in versions if version is not None]
+
+
+# 412 when the client's copy of the order, from If-Match, is no longer the current version
+def check_if_match(order):
+    versions = if_match_versions(order.id)
+
+    if versions is not None and (order.date_created, order.version) not in versions:
+        order_namespace.abort(HTTPStatus.PRECONDITION_FAILED, "The order has changed since it was read, fetch it again")
+
+
+# commits the pending update or delete of an order, a concurrent change to it since it was read turns into a 409
+def commit_order_change(action):
+    try:
+        action()
+    except StaleDataError:
+        db.session.rollback()
+
+        order_namespace.abort(HTTPStatus.CONFLICT, "The order was changed by another request, fetch it again")
+
+
+# clamps the requested page size to the configured bounds
+def page_limit(args):
+    limit = args.get('limit') or current_app.config['ORDERS_PAGE_SIZE']
+
+    return max(1, min(limit, current_app.config['ORDERS_MAX_PAGE_SIZE']))
+
+
 # get all orderes and also create an order
 @order_namespace.route('/orders')
 class OrderGetCreate(Resource):
-    # marshall_with helps get AN OBJECT FROM THE DB
+    # rows are serialized by serialize_orders, which gives the same output as marshal_with(order_model) for a fraction of the cost
     # localhost:5000/orders/orders
-    @order_namespace.marshal_with(order_model)
+    @order_namespace.expect(order_filter_parser)
+    @order_namespace.response(HTTPStatus.OK, 'Success', [order_model])
     @order_namespace.doc(
-        description = "Get all orders",
+        description = "Get all orders, a page at a time. The cursor of the next page is sent in the X-Next-Cursor header",
     )
     @jwt_required()
+    @replica_reads
     # get orders
     def get(self):
         """
             Get all orders
         """
-        # returns an empty list of orders
-        orders = Order.query.all()
+        args = order_filter_parser.parse_args()
+
+        try:
+            orders, next_cursor = keyset_page(filter_orders(args), Order, page_limit(args), args.get('cursor'))
+        except ValueError as error:
+            order_namespace.abort(HTTPStatus.BAD_REQUEST, str(error))
+
+        # the page itself stays a plain list, the cursor travels in a header
+        headers = {'X-Next-Cursor': next_cursor} if next_cursor else {}
+
+        with phase('marshal'):
+            payload = serialize_orders(orders)
 
-        return orders, HTTPStatus.OK
+        return payload, HTTPStatus.OK, headers
 
     # localhost:5000/orders/orders
     # create orders
     @order_namespace.expect(order_model)
     @order_namespace.marshal_with(order_model)
+    @order_namespace.header('Idempotency-Key', 'Retries sending the same key get the first response back instead of placing the order again')
+    @order_namespace.response(HTTPStatus.BAD_REQUEST, 'The Idempotency-Key is empty or longer than 255 characters')
+    @order_namespace.response(HTTPStatus.CONFLICT, 'The first request with this Idempotency-Key is still being processed')
+    @order_namespace.response(HTTPStatus.UNPROCESSABLE_ENTITY, 'The Idempotency-Key was already used with a different order')
     @order_namespace.doc(
         description = "Place an order",
     )
@@ -61,51 +306,373 @@ class OrderGetCreate(Resource):
         """
             Place an order
         """
-        username = get_jwt_identity()
-
-        # gets the username if the current user and assign it to current user
-        current_user = User.query.filter_by(username=username).first()
+        customer = current_customer_id()
 
         # payload(funstions as get.json) tells us every information(payload) about the user
         data = order_namespace.payload
 
-        new_order = Order(
-            # getting the size from the payload
-            size = data['size'],
-            quantity = data['quantity'],
-            flavour = data['flavour']
+        flavour = payload_flavour(data)
+
+        def place_order():
+            new_order = Order(
+                # getting the size from the payload
+                size = data['size'],
+                quantity = data['quantity'],
+                flavour = flavour
+            )
+
+            # store the id of the current user as the customer of the new order
+            new_order.customer = customer
+
+            db.session.add(new_order)
+            db.session.flush()
+
+            # reloaded so the response shows the stored values (enums rather than the names sent)
+            db.session.refresh(new_order)
+
+            return marshal(new_order, order_model), HTTPStatus.CREATED
+
+        key = request.headers.get('Idempotency-Key')
+
+        if key is not None and not valid_idempotency_key(key):
+            order_namespace.abort(HTTPStatus.BAD_REQUEST, "Idempotency-Key must be 1 to 255 characters long")
+
+        if key is None:
+            payload, status = place_order()
+            db.session.commit()
+
+            return payload, status
+
+        # keys belong to the user sending them
+        scope = f'user:{customer}' if customer is not None else f'identity:{get_jwt_identity()}'
+
+        try:
+            payload, status, replayed = current_app.extensions['idempotency'].run(
+                scope, key, request_fingerprint(data), place_order
+            )
+        except IdempotencyKeyReused:
+            order_namespace.abort(HTTPStatus.UNPROCESSABLE_ENTITY, "Idempotency-Key was already used with a different order")
+        except IdempotencyKeyInProgress:
+            order_namespace.abort(HTTPStatus.CONFLICT, "A request with this Idempotency-Key is still in progress")
+
+        return payload, status, {'Idempotent-Replayed': 'true' if replayed else 'false'}
+
+# localhost:5000/orders/orders/bulk
+# create many orders in one request and one transaction
+@order_namespace.route('/orders/bulk')
+class OrderBulkCreate(Resource):
+    @order_namespace.expect([order_model])
+    @order_namespace.marshal_list_with(order_bulk_result_model)
+    @order_namespace.doc(
+        description = "Place many orders at once, sent as a JSON array or as newline delimited JSON (application/x-ndjson). "
+                      "Invalid orders are reported per item while the valid ones are still created",
+    )
+    @jwt_required()
+    def post(self):
+        """
+            Place many orders
+        """
+        customer = current_customer_id()
+
+        if request.mimetype == 'application/x-ndjson':
+            items = read_ndjson(request.stream)
+        else:
+            items = request.get_json(silent=True)
+
+            if not isinstance(items, list):
+                order_namespace.abort(HTTPStatus.BAD_REQUEST, "Expected a JSON array of orders")
+
+        results = []
+        rows = []
+
+        for index, data in enumerate(items):
+            if len(results) == current_app.config['ORDERS_BULK_MAX_ITEMS']:
+                order_namespace.abort(
+                    HTTPStatus.REQUEST_ENTITY_TOO_LARGE,
+                    f"At most {current_app.config['ORDERS_BULK_MAX_ITEMS']} orders can be placed at once"
+                )
+
+            errors = validate_order(data)
+
+            if errors:
+                results.append({'index': index, 'status': HTTPStatus.BAD_REQUEST, 'errors': errors})
+                continue
+
+            results.append({'index': index, 'status': HTTPStatus.CREATED})
+            rows.append({
+                'size': data['size'],
+                'quantity': data['quantity'],
+                'flavour': data['flavour'],
+                'customer': customer
+            })
+
+        ids = Order.bulk_insert(rows, current_app.config['ORDERS_BULK_CHUNK_SIZE'])
+
+        # ids come back in the order the rows were sent, match them to the accepted items
+        created = iter(ids)
+        for result in results:
+            if result['status'] == HTTPStatus.CREATED:
+                result['id'] = next(created)
+
+        status = HTTPStatus.CREATED if len(ids) == len(results) else HTTPStatus.MULTI_STATUS
+
+        return results, status
+
+
+# parses an NDJSON body one line at a time, a line that is not JSON becomes an item that fails validation
+def read_ndjson(stream):
+    for line in stream:
+        line = line.strip()
+
+        if not line:
+            continue
+
+        try:
+            yield json.loads(line)
+        except ValueError:
+            yield None
+
+# localhost:5000/orders/orders/stream
+# streams every matching order as NDJSON, one order per line
+@order_namespace.route('/orders/stream')
+class OrderStream(Resource):
+    @order_namespace.expect(order_filter_parser)
+    @order_namespace.produces(['application/x-ndjson'])
+    @order_namespace.doc(
+        description = "Stream all orders as newline delimited JSON",
+    )
+    @jwt_required()
+    def get(self):
+        """
+            Stream all orders
+        """
+        args = order_filter_parser.parse_args()
+
+        # reject a bad cursor before the 200 status line has been sent
+        if args.get('cursor'):
+            try:
+                decode_cursor(args['cursor'])
+            except ValueError as error:
+                order_namespace.abort(HTTPStatus.BAD_REQUEST, str(error))
+
+        batches = keyset_batches(
+            filter_orders(args), Order, current_app.config['ORDERS_STREAM_BATCH_SIZE'],
+            cursor=args.get('cursor'), limit=args.get('limit')
         )
 
-        # use jwt_identity to get the user using the relationship created and now store as the user of the new order 
-        new_order.user = current_user
+        # rows are serialized a batch at a time so the full table is never held in memory
+        def generate():
+            for batch in batches:
+                yield ''.join(fast_dumps(serialize_order(order)) + '\n' for order in batch)
 
-        new_order.save()
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
 
-        return new_order, HTTPStatus.CREATED
+# localhost:5000/orders/orders/export
+# streams the matching orders as CSV or NDJSON for accounting, staff only
+@order_namespace.route('/orders/export')
+class OrderExport(Resource):
+    @order_namespace.expect(order_export_parser)
+    @order_namespace.produces(['text/csv', 'application/x-ndjson', 'application/gzip'])
+    @order_namespace.doc(
+        description = "Export orders, archived ones included, as CSV or NDJSON, oldest first. Every row carries the cursor "
+                      "that resumes the export after it, an export cut short is picked up with that of the last row received",
+    )
+    @jwt_required()
+    def get(self):
+        """
+            Export orders
+        """
+        require_staff()
+
+        args = order_export_parser.parse_args()
+
+        # a bad cursor is refused before the 200 status line has been sent
+        try:
+            batches = export_batches(
+                dict(statuses=args.get('order_status') or (), date_from=args.get('date_from'), date_to=args.get('date_to')),
+                current_app.config['ORDERS_EXPORT_BATCH_SIZE'], args.get('cursor')
+            )
+        except ValueError as error:
+            order_namespace.abort(HTTPStatus.BAD_REQUEST, str(error))
+
+        chunks = export_chunks(batches, args['format'])
+        filename = f"orders.{args['format']}"
+
+        if args['gzip']:
+            chunks = gzip_chunks(chunks)
+            filename += '.gz'
+
+        return Response(
+            stream_with_context(chunks),
+            mimetype='application/gzip' if args['gzip'] else EXPORT_MIMETYPES[args['format']],
+            headers={'Content-Disposition': f'attachment; filename={filename}'}
+        )
+
+# localhost:5000/orders/kitchen/next
+# the PENDING orders the kitchen should make next, first in line first
+@order_namespace.route('/kitchen/next')
+class KitchenNext(Resource):
+    @order_namespace.expect(kitchen_next_parser)
+    @order_namespace.response(HTTPStatus.OK, 'Success', [order_model])
+    @order_namespace.doc(
+        description = "The next n PENDING orders for the kitchen, ordered by when they would be ready: "
+                      "the time they were placed plus the prep time of their size for every pizza. Staff only",
+    )
+    @jwt_required()
+    def get(self):
+        """
+            Get the next orders for the kitchen
+        """
+        require_staff()
+
+        args = kitchen_next_parser.parse_args()
+
+        n = min(args['n'], current_app.config['KITCHEN_MAX_NEXT'])
+
+        orders = next_orders(current_app.extensions['kitchen_queue'], n)
+
+        return serialize_orders(orders), HTTPStatus.OK
+
+# localhost:5000/orders/kitchen/claim
+# takes an order out of the queue by moving it to IN_TRANSIT, only one of several cooks claiming it gets it
+@order_namespace.route('/kitchen/claim')
+class KitchenClaim(Resource):
+    @order_namespace.expect(kitchen_claim_model)
+    @order_namespace.marshal_with(order_model)
+    @order_namespace.response(HTTPStatus.NOT_FOUND, 'No order is waiting, or the order does not exist')
+    @order_namespace.response(HTTPStatus.CONFLICT, 'The order is no longer PENDING')
+    @order_namespace.doc(
+        description = "Claim the first order in line, or the order given by id, by moving it from PENDING to IN_TRANSIT. Staff only",
+    )
+    @jwt_required()
+    def post(self):
+        """
+            Claim an order for the kitchen
+        """
+        require_staff()
+
+        payload = request.get_json(silent=True)
+
+        order_id = payload.get('id') if isinstance(payload, dict) else None
+
+        if order_id is not None and (not isinstance(order_id, int) or isinstance(order_id, bool)):
+            order_namespace.abort(HTTPStatus.BAD_REQUEST, "id must be an integer")
+
+        row = claim_order(current_app.extensions['kitchen_queue'], order_id)
+
+        if row is None:
+            if order_id is None:
+                order_namespace.abort(HTTPStatus.NOT_FOUND, "No order is waiting")
+
+            if db.session.get(Order, order_id) is None:
+                order_namespace.abort(HTTPStatus.NOT_FOUND)
+
+            order_namespace.abort(HTTPStatus.CONFLICT, "The order is no longer PENDING")
+
+        return row, HTTPStatus.OK, {'ETag': quote_etag(order_etag(row.id, row.date_created, row.version))}
+
+# localhost:5000/orders/stats
+# order counts and quantities grouped by hour, size, flavour and/or status
+@order_namespace.route('/stats')
+class OrderStatsView(Resource):
+    @order_namespace.expect(order_stats_group_parser)
+    @order_namespace.marshal_with(order_stats_model)
+    @order_namespace.doc(
+        description = "Count orders and sum their quantities by hour, size, flavour and/or order_status. "
+                      "Ranges on the hour are read from the hourly rollups, other ranges aggregate the orders table",
+    )
+    @jwt_required()
+    def get(self):
+        """
+            Get grouped order stats
+        """
+        args = order_stats_group_parser.parse_args()
+
+        group_by = [name.strip() for name in args['group_by'].split(',') if name.strip()]
+
+        if not group_by or any(name not in STATS_GROUPS for name in group_by):
+            order_namespace.abort(HTTPStatus.BAD_REQUEST, f"group_by must be a list of {', '.join(STATS_GROUPS)}")
+
+        source, groups = order_stats(group_by, args.get('date_from'), args.get('date_to'), args.get('source'))
+
+        return {'source': source, 'groups': groups}, HTTPStatus.OK
+
+# localhost:5000/orders/stats/funnel
+@order_namespace.route('/stats/funnel')
+class OrderStatusFunnel(Resource):
+    @order_namespace.expect(order_stats_parser)
+    @order_namespace.marshal_with(order_funnel_model)
+    @order_namespace.doc(
+        description = "Orders per status from PENDING to DELIVERED",
+    )
+    @jwt_required()
+    def get(self):
+        """
+            Get the order status funnel
+        """
+        args = order_stats_parser.parse_args()
+
+        source, groups = order_stats(['order_status'], args.get('date_from'), args.get('date_to'), args.get('source'))
+
+        return {'source': source, 'funnel': status_funnel(groups)}, HTTPStatus.OK
+
+# localhost:5000/orders/stats/hourly
+@order_namespace.route('/stats/hourly')
+class OrderHourlyStats(Resource):
+    @order_namespace.expect(order_stats_parser)
+    @order_namespace.marshal_with(order_stats_model)
+    @order_namespace.doc(
+        description = "Orders and quantity per hour and size",
+    )
+    @jwt_required()
+    def get(self):
+        """
+            Get orders per hour per size
+        """
+        args = order_stats_parser.parse_args()
+
+        source, groups = order_stats(['hour', 'size'], args.get('date_from'), args.get('date_to'), args.get('source'))
+
+        return {'source': source, 'groups': groups}, HTTPStatus.OK
 
 # localhost:5000/orders/order/order_id
 @order_namespace.route('/order/<int:order_id>')
 class GetUpdateDelete(Resource):
-    @order_namespace.marshal_with(order_model)
+    # marshalled by hand so the cached payload can be sent as is
+    @order_namespace.response(HTTPStatus.OK, 'Success', order_model)
+    @order_namespace.response(HTTPStatus.NOT_MODIFIED, 'The order still matches the ETag sent in If-None-Match')
     @order_namespace.doc(
         description = "Retreive an order by its id",
         params = {'order_id': "An ID for an order"}
     )
     @jwt_required()
+    @replica_reads
     def get(self, order_id):
         """
             Retreiving an order by id
         """
-        order = Order.get_by_id(order_id)
+        cache = current_app.extensions['order_cache']
+
+        entry = cache.get_order(order_id)
+
+        if entry is None:
+            generation = cache.generation()
+
+            order = Order.get_by_id(order_id)
 
-        return order, HTTPStatus.OK
+            with phase('marshal'):
+                entry = cache.set_order(order_id, order.customer, order.date_created, order.version, marshal(order, order_model), generation)
+
+        return conditional_response(entry)
 
     # we need to serialize the data in order to update
     @order_namespace.expect(order_model)
     # because we are printing something out
     @order_namespace.marshal_with(order_model)
+    @order_namespace.response(HTTPStatus.CONFLICT, 'The order was changed by another request while this one ran')
+    @order_namespace.response(HTTPStatus.PRECONDITION_FAILED, 'The order no longer matches the ETag sent in If-Match')
     @order_namespace.doc(
-        description = "Updating an order by id",
+        description = "Updating an order by id, send the ETag of the order in If-Match to only update the version you read",
         params = {'order_id': "An ID for an order"}
 
     )
@@ -118,20 +685,24 @@ class GetUpdateDelete(Resource):
         """
         order_to_update = Order.get_by_id(order_id)
 
+        check_if_match(order_to_update)
+
         # getting all data about the order
         data = order_namespace.payload
 
         order_to_update.quantity = data["quantity"]
         order_to_update.size = data["size"]
-        order_to_update.flavour = data["flavour"]
+        order_to_update.flavour = payload_flavour(data)
 
-        # saving changes to the database only
-        order_to_update.update()
+        # saving changes to the database only, the UPDATE only matches the version that was read
+        commit_order_change(order_to_update.update)
 
-        return order_to_update, HTTPStatus.OK
+        return order_to_update, HTTPStatus.OK, {'ETag': quote_etag(order_etag(order_id, order_to_update.date_created, order_to_update.version))}
 
+    @order_namespace.response(HTTPStatus.CONFLICT, 'The order was changed by another request while this one ran')
+    @order_namespace.response(HTTPStatus.PRECONDITION_FAILED, 'The order no longer matches the ETag sent in If-Match')
     @order_namespace.doc(
-        description = "Delete an order by id",
+        description = "Delete an order by id, send the ETag of the order in If-Match to only delete the version you read",
         params = {'order_id': "An ID for an order"}
 
     )
@@ -145,7 +716,9 @@ class GetUpdateDelete(Resource):
 
         order_to_delete = Order.get_by_id(order_id)
 
-        order_to_delete.delete()
+        check_if_match(order_to_delete)
+
+        commit_order_change(order_to_delete.delete)
 
         return {"message": "Deleted Successfully"}, HTTPStatus.OK
 
@@ -154,44 +727,208 @@ class GetUpdateDelete(Resource):
 @order_namespace.route('/user/<int:user_id>/order/<int:order_id>')
 class GetSpecificOrderbyUser(Resource):
     
-    @order_namespace.marshal_with(order_model)
+    @order_namespace.response(HTTPStatus.OK, 'Success', order_model)
+    @order_namespace.response(HTTPStatus.NOT_MODIFIED, 'The order still matches the ETag sent in If-None-Match')
     @order_namespace.doc(
         description = "Get a user specific order by user id and order id",
         params = {'order_id': "An ID for an order", 'user_id': "An ID for the user"}
     )
     @jwt_required()
+    @replica_reads
     def get(self, user_id, order_id):
         """
             Get a user specific order
         """
-        # get user by user id
-        user = User.get_by_id(user_id)
-        
-        # get order and if the current_user = user(gotten from above), then return the order else return null
-        order = Order.query.filter_by(id=order_id).filter_by(user=user).first()
+        cache = current_app.extensions['order_cache']
+
+        # the entry cached for the order route can be reused when it belongs to this user
+        entry = cache.get_order(order_id)
+
+        if entry is not None and entry.customer == user_id:
+            return conditional_response(entry)
+
+        generation = cache.generation()
+
+        # filter on the foreign key directly so the user row is never loaded
+        order = Order.query.filter_by(id=order_id, customer=user_id).first()
+
+        if order is None:
+            # only when there is no match do we need to know whether the user exists at all
+            if not User.exists(user_id):
+                order_namespace.abort(HTTPStatus.NOT_FOUND)
+
+            return marshal(order, order_model), HTTPStatus.OK
+
+        with phase('marshal'):
+            entry = cache.set_order(order_id, order.customer, order.date_created, order.version, marshal(order, order_model), generation)
 
-        return order, HTTPStatus.OK
+        return conditional_response(entry)
 
 # localhost:5000/orders/user/user_id/orders
 # getting all the orders a user has made
 @order_namespace.route('/user/<int:user_id>/orders')
 class UserOrders(Resource):
     # marshall_list_with returns all the orders
-    @order_namespace.marshal_list_with(order_model)
+    @order_namespace.expect(user_orders_parser)
+    @order_namespace.response(HTTPStatus.OK, 'Success', [order_model])
+    @order_namespace.response(HTTPStatus.NOT_MODIFIED, 'The orders still match the ETag sent in If-None-Match')
     @order_namespace.doc(
-        description = "Get a user's orders by user id",
+        description = "Get a user's orders by user id, a page at a time. The cursor of the next page is sent in the X-Next-Cursor header. "
+                      "Archived orders are only included with include_archived=1",
         params = {'user_id': "An ID for a user"}
     )
     @jwt_required()
+    @replica_reads
     def get(self, user_id):
         """
             Get all user orders
         """
-        user = User.get_by_id(user_id)
+        args = user_orders_parser.parse_args()
+
+        cache = current_app.extensions['order_cache']
+
+        page = (page_limit(args), args.get('cursor'), args['include_archived'])
+
+        entry = cache.get_user_orders(user_id, page)
+
+        if entry is None:
+            generation = cache.generation()
+
+            # a single query on orders.customer instead of loading the user and then user.orders
+            sources = [(order_rows().filter(Order.customer == user_id), Order)]
+
+            # the archive is only read when asked for, and then one page at a time like the orders table
+            if args['include_archived']:
+                sources.append((archived_order_rows().filter(OrderArchive.customer == user_id), OrderArchive))
+
+            try:
+                orders, next_cursor = keyset_merge_page(sources, page_limit(args), args.get('cursor'))
+            except ValueError as error:
+                order_namespace.abort(HTTPStatus.BAD_REQUEST, str(error))
+
+            # a user with orders obviously exists, only an empty page needs the extra check
+            if not orders and not User.exists(user_id):
+                order_namespace.abort(HTTPStatus.NOT_FOUND)
 
-        orders = user.orders
+            with phase('marshal'):
+                entry = cache.set_user_orders(user_id, page, serialize_orders(orders), next_cursor, generation)
 
-        return orders, HTTPStatus.OK
+        headers = {'X-Next-Cursor': entry.next_cursor} if entry.next_cursor else {}
+
+        return conditional_response(entry, headers)
+
+# localhost:5000/orders/user/user_id/events
+# live order changes of a user as Server-Sent Events, instead of polling the order routes
+@order_namespace.route('/user/<int:user_id>/events')
+class UserOrderEvents(Resource):
+    @order_namespace.produces(['text/event-stream'])
+    @order_namespace.doc(
+        description = "Stream a user's order changes (insert, update, delete, archive) as Server-Sent Events",
+        params = {'user_id': "An ID for a user"}
+    )
+    @jwt_required()
+    def get(self, user_id):
+        """
+            Stream a user's order changes
+        """
+        if not User.exists(user_id):
+            order_namespace.abort(HTTPStatus.NOT_FOUND)
+
+        subscription = current_app.extensions['event_broker'].subscribe(user_channel(user_id))
+
+        # no app or request context is needed while streaming, so none is held open
+        response = Response(
+            event_stream(subscription, current_app.config['EVENT_KEEPALIVE']),
+            mimetype='text/event-stream',
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+        )
+
+        # also unsubscribes a client that left before the stream started
+        response.call_on_close(subscription.close)
+
+        return response
+
+# localhost:5000/orders/order/status
+# move many orders to the next status with a single UPDATE
+@order_namespace.route('/order/status')
+class BulkUpdateOrderStatus(Resource):
+    @order_namespace.expect(order_bulk_status_model)
+    @order_namespace.marshal_with(order_bulk_status_result_model)
+    @order_namespace.doc(
+        description = "Move orders, given by ids or by a filter, to the next status. "
+                      "Only PENDING -> IN_TRANSIT and IN_TRANSIT -> DELIVERED are allowed, other orders are left alone",
+    )
+    @jwt_required()
+    def patch(self):
+        """
+            Update status of many orders
+        """
+        data = order_namespace.payload or {}
+
+        if data.get('order_status') not in ORDER_STATUS_TRANSITIONS:
+            order_namespace.abort(
+                HTTPStatus.BAD_REQUEST,
+                f"order_status must be one of {sorted(ORDER_STATUS_TRANSITIONS)}"
+            )
+
+        ids = data.get('ids')
+        order_filter = data.get('filter')
+
+        if ids:
+            if not isinstance(ids, list) or not all(isinstance(id, int) for id in ids):
+                order_namespace.abort(HTTPStatus.BAD_REQUEST, "ids must be a list of integers")
+
+            if len(ids) > current_app.config['ORDERS_BULK_MAX_ITEMS']:
+                order_namespace.abort(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+
+            criteria = [Order.id.in_(ids)]
+        elif order_filter and isinstance(order_filter, dict):
+            try:
+                criteria = order_criteria(bulk_filter_args(order_filter))
+            except (KeyError, ValueError) as error:
+                order_namespace.abort(HTTPStatus.BAD_REQUEST, f"Invalid filter: {error}")
+        else:
+            order_namespace.abort(HTTPStatus.BAD_REQUEST, "Either ids or a filter is required")
+
+        updated = Order.transition_status(OrderStatus[data['order_status']], *criteria)
+
+        result = {'order_status': data['order_status'], 'updated': updated}
+
+        if ids:
+            moved = set(updated)
+            result['skipped'] = [id for id in ids if id not in moved]
+
+        return result, HTTPStatus.OK
+
+
+# the keys a bulk status update can filter on
+BULK_FILTER_KEYS = ('size', 'customer', 'date_from', 'date_to')
+
+
+# the filter of a bulk status update is JSON, parse its dates the way the query string ones are. A filter that
+# doesn't narrow anything down is refused, it would move every order in the preceding status
+def bulk_filter_args(order_filter):
+    unknown = sorted(key for key in order_filter if key not in BULK_FILTER_KEYS)
+
+    if unknown:
+        raise ValueError(f"unknown keys {unknown}, a filter can only have {list(BULK_FILTER_KEYS)}")
+
+    args = {key: order_filter.get(key) for key in ('size', 'customer')}
+
+    if args['size'] is not None and args['size'] not in Sizes.__members__:
+        raise ValueError(f"unknown size '{args['size']}'")
+
+    if args['customer'] is not None and (not isinstance(args['customer'], int) or isinstance(args['customer'], bool)):
+        raise ValueError("customer must be an integer")
+
+    for key in ('date_from', 'date_to'):
+        if order_filter.get(key):
+            args[key] = inputs.datetime_from_iso8601(order_filter[key])
+
+    if all(args.get(key) is None for key in BULK_FILTER_KEYS):
+        raise ValueError(f"at least one of {list(BULK_FILTER_KEYS)} must be given")
+
+    return args
 
 # localhost:5000/orders/order/status/order_id
 @order_namespace.route('/order/status/<int:order_id>')
@@ -199,8 +936,11 @@ class UpdateOrderStatus(Resource):
     @order_namespace.expect(order_status_model)
     # since we are returning use marshall
     @order_namespace.marshal_with(order_model)
+    @order_namespace.response(HTTPStatus.CONFLICT, 'The order is not in the status preceding the requested one')
+    @order_namespace.response(HTTPStatus.PRECONDITION_FAILED, 'The order no longer matches the ETag sent in If-Match')
     @order_namespace.doc(
-        description = "Update an order status by order id",
+        description = "Move an order to the next status: PENDING -> IN_TRANSIT or IN_TRANSIT -> DELIVERED. "
+                      "Send the ETag of the order in If-Match to only move the version you read",
         params = {'order_id': "An ID for an order"}
     )
     @jwt_required()
@@ -211,10 +951,31 @@ class UpdateOrderStatus(Resource):
         """
         data = order_namespace.payload
 
-        order_to_update = Order.get_by_id(order_id)
+        if data.get('order_status') not in ORDER_STATUS_TRANSITIONS:
+            order_namespace.abort(
+                HTTPStatus.BAD_REQUEST,
+                f"order_status must be one of {sorted(ORDER_STATUS_TRANSITIONS)}"
+            )
+
+        status = OrderStatus[data['order_status']]
+        versions = if_match_versions(order_id)
+
+        # a single UPDATE checks the current status (and version) and moves the order, no lock is held in between
+        order = Order.compare_and_set_status(order_id, status, versions)
+
+        if order is None:
+            # only when nothing moved do we read the order, to tell why
+            current = db.session.query(Order.order_status, Order.date_created, Order.version).filter(Order.id == order_id).first()
+
+            if current is None:
+                order_namespace.abort(HTTPStatus.NOT_FOUND)
 
-        order_to_update.order_status = data['order_status']
+            if versions is not None and (current.date_created, current.version) not in versions:
+                order_namespace.abort(HTTPStatus.PRECONDITION_FAILED, "The order has changed since it was read, fetch it again")
 
-        order_to_update.update()
+            order_namespace.abort(
+                HTTPStatus.CONFLICT,
+                f"The order is {current.order_status.name}, only {ORDER_STATUS_TRANSITIONS[status.name].name} orders can move to {status.name}"
+            )
 
-        return order_to_update, HTTPStatus.OK
\ No newline at end of file
+        return order, HTTPStatus.OK, {'ETag': quote_etag(order_etag(order_id, order.date_created, order.version))}
\ No newline at end of file
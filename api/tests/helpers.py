@@ -0,0 +1,128 @@
+import unittest
+from contextlib import contextmanager, nullcontext
+from unittest.mock import patch
+from sqlalchemy import event, orm
+from .. import create_app
+from ..config.config import config_dict
+from ..utils import db
+from ..auth.tokens import RevocationList
+from ..orders.cache import init_order_cache
+from ..orders.events import init_event_broker
+from ..orders.idempotency import init_idempotency_store
+from ..orders.kitchen import init_kitchen_queue
+
+SAVEPOINT_STATEMENTS = ('SAVEPOINT', 'RELEASE SAVEPOINT', 'ROLLBACK TO SAVEPOINT')
+
+# app and schema shared by every TransactionalTestCase of the run, created by the first one
+_session_app = None
+
+
+# records every SQL statement sent to the database while the block runs
+@contextmanager
+def count_queries():
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        # the SAVEPOINTs of TransactionalTestCase stand in for commits, they aren't round trips of the code under test
+        if not statement.startswith(SAVEPOINT_STATEMENTS):
+            statements.append(statement)
+
+    engine = db.engine
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+
+
+# mixin for unittest cases so a change in SQL round trips per request fails the suite
+class QueryCountMixin:
+
+    @contextmanager
+    def assertNumQueries(self, expected):
+        with count_queries() as statements:
+            yield statements
+
+        self.assertEqual(
+            len(statements), expected,
+            f"{len(statements)} queries executed, {expected} expected:\n" + "\n".join(statements)
+        )
+
+
+def session_app():
+    global _session_app
+
+    if _session_app is None:
+        _session_app = create_app(config=config_dict['test'])
+
+        with _session_app.app_context():
+            db.create_all()
+
+    return _session_app
+
+
+# in-memory state a test could leave behind for the next one: caches, revocations and event subscriptions
+def reset_extensions(app):
+    app.extensions['token_cache'].clear()
+    app.extensions['identity_cache'].clear()
+    app.extensions['token_revocations'] = RevocationList(sync_interval=app.config['TOKEN_REVOCATION_SYNC_INTERVAL'])
+
+    init_order_cache(app)
+    init_idempotency_store(app)
+    init_event_broker(app)
+    init_kitchen_queue(app)
+
+
+# test case sharing one app and schema for the whole run instead of creating them for every test: each test runs
+# in a transaction rolled back in tearDown, and the session's commits only release SAVEPOINTs inside it.
+# Tests that need several connections (threads, other processes) keep creating their own app
+class TransactionalTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.app = session_app()
+
+        self.appctx = self.app.app_context()
+
+        self.appctx.push()
+
+        self._config = dict(self.app.config)
+
+        self.connection = db.engine.connect()
+
+        self.transaction = self.connection.begin()
+
+        # pysqlite only opens a transaction before a write, it's opened here so the first SAVEPOINT nests in it
+        if self.connection.dialect.name == 'sqlite':
+            self.connection.exec_driver_sql('BEGIN')
+
+        db.session.registry.set(orm.Session(
+            bind=self.connection, join_transaction_mode='create_savepoint', query_cls=db.Query
+        ))
+
+        # code opening its own connection (the token revocation sync) reads through the test's transaction too
+        self._connect = patch.object(db.engine, 'connect', lambda: nullcontext(self.connection))
+
+        self._connect.start()
+
+        reset_extensions(self.app)
+
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        self._connect.stop()
+
+        db.session.remove()
+
+        self.transaction.rollback()
+
+        self.connection.close()
+
+        # settings changed by the test go back to what the other tests expect
+        self.app.config.clear()
+
+        self.app.config.update(self._config)
+
+        self.appctx.pop()
+
+        self.client = None
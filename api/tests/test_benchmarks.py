@@ -0,0 +1,11 @@
+import unittest
+from benchmarks.load import run
+
+
+class LoadSuiteTestCase(unittest.TestCase):
+
+    # the load suite at a tiny scale, so a route it drives can't break without the suite noticing
+    def test_every_route_succeeds(self):
+        results = run(users=3, orders=400, requests=3, client='test', concurrency=1)
+
+        assert {key: result['errors'] for key, result in results.items() if result['errors']} == {}
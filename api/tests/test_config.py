@@ -0,0 +1,70 @@
+import os
+import tempfile
+import unittest
+from .. import create_app
+from ..config.config import config_dict
+from ..utils import db
+from ..utils.ratelimit import TimedQueuePool
+
+
+class ConfigTestCase(unittest.TestCase):
+
+    def test_create_app_uses_flask_config(self):
+        os.environ['FLASK_CONFIG'] = 'test'
+
+        try:
+            app = create_app()
+        finally:
+            del os.environ['FLASK_CONFIG']
+
+        assert app.config['TESTING']
+
+    def test_sqlite_pragmas_on_connect(self):
+        # WAL needs a database file, an in-memory database always reports "memory"
+        with tempfile.TemporaryDirectory() as directory:
+            class SQLiteProdConfig(config_dict['prod']):
+                SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(directory, 'db.sqlite3')
+
+            app = create_app(config=SQLiteProdConfig)
+
+            with app.app_context():
+                connection = db.engine.raw_connection()
+
+                try:
+                    cursor = connection.cursor()
+
+                    assert cursor.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+
+                    # NORMAL is 1
+                    assert cursor.execute('PRAGMA synchronous').fetchone()[0] == 1
+
+                    assert cursor.execute('PRAGMA busy_timeout').fetchone()[0] == app.config['SQLITE_PRAGMAS']['busy_timeout']
+                finally:
+                    connection.close()
+
+                # named by its dotted path in the config
+                assert isinstance(db.engine.pool, TimedQueuePool)
+
+                db.engine.dispose()
+
+    def test_api_docs(self):
+        client = create_app(config=config_dict['test']).test_client()
+
+        response = client.get('/swagger.json')
+
+        assert response.status_code == 200 and '/orders/orders' in response.json['paths']
+
+        # encoded on the first request and served as is afterwards
+        assert client.get('/swagger.json').data == response.data
+
+        assert client.get('/').status_code == 200
+
+    def test_api_docs_disabled(self):
+        class NoDocsConfig(config_dict['test']):
+            API_DOCS = False
+
+        client = create_app(config=NoDocsConfig).test_client()
+
+        assert client.get('/swagger.json').status_code == 404
+
+        assert client.get('/').status_code == 404
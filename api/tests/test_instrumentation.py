@@ -0,0 +1,90 @@
+import unittest
+from .. import create_app
+from ..config.config import config_dict
+from ..utils import db
+from ..models.orders import Order
+from flask_jwt_extended import create_access_token
+
+
+class InstrumentationTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = create_app(config=config_dict['test'])
+
+        self.appctx = self.app.app_context()
+
+        self.appctx.push()
+
+        self.client = self.app.test_client()
+
+        db.create_all()
+
+        token = create_access_token(identity="testuser")
+
+        self.headers = {
+            "Authorization": f"Bearer {token}"
+        }
+
+    def tearDown(self):
+        db.drop_all()
+
+        self.appctx.pop()
+
+        self.app = None
+
+        self.client = None
+
+    def test_server_timing_header(self):
+        Order(size = 'SMALL', flavour = "Pepperoni", quantity = 1).save()
+
+        response = self.client.get('/orders/orders', headers=self.headers)
+
+        timings = {entry.split(';')[0]: entry for entry in response.headers['Server-Timing'].split(', ')}
+
+        # every phase of the request is reported, the db entry says how many statements ran
+        assert {'jwt', 'marshal', 'encode', 'db', 'total'} <= set(timings)
+
+        assert 'desc="1 queries"' in timings['db']
+
+        # the requests of one app context (this test's) don't add up, each one starts from zero
+        response = self.client.get('/orders/orders', headers=self.headers)
+
+        timings = {entry.split(';')[0]: entry for entry in response.headers['Server-Timing'].split(', ')}
+
+        assert 'desc="1 queries"' in timings['db']
+
+    def test_metrics_endpoint(self):
+        self.client.get('/orders/orders', headers=self.headers)
+        self.client.get('/orders/orders', headers=self.headers)
+
+        response = self.client.get('/metrics')
+
+        assert response.status_code == 200
+
+        assert response.mimetype == 'text/plain'
+
+        labels = 'endpoint="orders_order_get_create",method="GET",status="200"'
+
+        assert f'http_request_duration_seconds_count{{{labels}}} 2' in response.get_data(as_text=True)
+
+        assert f'http_request_duration_seconds_bucket{{{labels},le="+Inf"}} 2' in response.get_data(as_text=True)
+
+    def test_slow_query_log(self):
+        # a new app so the threshold is picked up when the engine events are registered
+        self.appctx.pop()
+
+        class SlowQueryConfig(config_dict['test']):
+            SLOW_QUERY_THRESHOLD = 0
+
+        self.app = create_app(config=SlowQueryConfig)
+
+        self.appctx = self.app.app_context()
+
+        self.appctx.push()
+
+        db.create_all()
+
+        with self.assertLogs('api.slow_query', level='WARNING') as logs:
+            Order.query.filter_by(customer=1).all()
+
+        # the plan shows the query is served by the customer index
+        assert any('ix_orders_customer_id' in message for message in logs.output)
@@ -0,0 +1,208 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from datetime import datetime
+from .. import create_app
+from ..config.config import config_dict
+from ..utils import db
+from ..utils.jobs import enqueue, task
+from ..models.jobs import DeadJob, Job
+from ..models.orders import Order
+from flask_jwt_extended import create_access_token
+
+# payloads seen by the test tasks, and how many more times the flaky one fails
+received = []
+failures = {'left': 0}
+
+
+@task('tests.record')
+def record(payload):
+    received.append(payload)
+
+
+@task('tests.flaky', max_attempts=3)
+def flaky(payload):
+    if failures['left']:
+        failures['left'] -= 1
+        raise RuntimeError('try again')
+
+    received.append(payload)
+
+
+# writes its payload to a file, so what ran in another process can be seen
+@task('tests.write_file')
+def write_file(payload):
+    with open(payload['path'], 'a') as file:
+        file.write(f"{os.getpid()}\n")
+
+
+# the jobs table is a SQLite file so the worker threads and processes have their own connections to it
+class JobQueueTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+        class JobTestConfig(config_dict['test']):
+            SQLALCHEMY_ECHO = False
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(self.directory, 'test.sqlite3')
+            SQLITE_PRAGMAS = {'journal_mode': 'WAL', 'busy_timeout': 10000}
+            ORDER_JOB_TASKS = ['tests.record']
+            JOB_POLL_INTERVAL = 0.05
+
+        self.app = create_app(config=JobTestConfig)
+
+        self.appctx = self.app.app_context()
+
+        self.appctx.push()
+
+        db.create_all()
+
+        self.queue = self.app.extensions['job_queue']
+
+        received.clear()
+
+    def tearDown(self):
+        self.queue.stop()
+
+        db.session.remove()
+
+        db.drop_all()
+
+        db.engine.dispose()
+
+        self.appctx.pop()
+
+        shutil.rmtree(self.directory)
+
+    def wait_for(self, condition, timeout=10):
+        deadline = time.monotonic() + timeout
+
+        while not condition():
+            assert time.monotonic() < deadline
+            time.sleep(0.05)
+
+    def test_order_changes_enqueue_jobs(self):
+        headers = {"Authorization": f"Bearer {create_access_token(identity='testuser')}"}
+
+        response = self.app.test_client().post('/orders/orders', json={"size": "LARGE", "quantity": 2, "flavour": "pork"}, headers=headers)
+
+        assert response.status_code == 201
+
+        # a rolled back change leaves no job behind
+        db.session.add(Order(size = 'SMALL', flavour = "mix", quantity = 1))
+        db.session.flush()
+        db.session.rollback()
+
+        # nothing ran during the request
+        assert received == [] and Job.query.count() == 1
+
+        assert self.queue.run_pending() == 1
+
+        assert [[(change['action'], change['id'], change['size'], change['order_status']) for change in changes] for changes in received] == \
+            [[('insert', response.json['id'], 'LARGE', 'PENDING')]]
+
+        assert Job.query.count() == 0
+
+    def test_failing_jobs_are_retried_then_dead(self):
+        failures['left'] = 5
+
+        enqueue(db.session, 'tests.flaky', {'n': 1})
+        db.session.commit()
+
+        for attempt in range(1, 4):
+            assert self.queue.run_pending() == 1
+
+            db.session.expire_all()
+
+            if attempt < 3:
+                job = Job.query.one()
+
+                # pushed back 1 to 2, then 2 to 4 seconds
+                delay = 2 * 2 ** (attempt - 1)
+
+                assert job.attempts == attempt and 'try again' in job.last_error
+                assert delay * 0.5 - 1 <= (job.run_at - datetime.utcnow()).total_seconds() <= delay
+
+                # due right away for the test
+                job.run_at = datetime.utcnow()
+                db.session.commit()
+
+        assert Job.query.count() == 0
+
+        dead = DeadJob.query.one()
+
+        assert dead.attempts == 3 and 'try again' in dead.error
+
+        failures['left'] = 0
+
+        dead_id = dead.id
+
+        # the command runs in this app context and its session, where the job it requeues can take the id of
+        # the one deleted above
+        db.session.expunge_all()
+
+        result = self.app.test_cli_runner().invoke(args=['jobs', 'retry', str(dead_id)])
+
+        assert result.output == 'Requeued 1 jobs\n'
+
+        assert self.queue.run_pending() == 1 and received == [{'n': 1}]
+
+    def test_finish_after_lease_ran_out(self):
+        enqueue(db.session, 'tests.record', {'n': 1})
+        db.session.commit()
+
+        job = self.queue.claim()
+
+        # the lease runs out while the job is still running and another worker claims it
+        db.session.execute(db.update(Job).values(locked_until=datetime.utcnow()))
+        db.session.commit()
+
+        again = self.queue.claim()
+
+        assert again.id == job.id and again.attempts == 2
+
+        # the first claim can neither delete nor reschedule the job
+        self.queue.finish(job)
+        self.queue.finish(job, 'failed')
+
+        db.session.expire_all()
+
+        assert Job.query.one().locked_until == again.locked_until
+
+        self.queue.finish(again)
+
+        assert Job.query.count() == 0
+
+    def test_worker_pool(self):
+        self.queue.workers = 2
+        self.queue.start()
+
+        for n in range(5):
+            enqueue(db.session, 'tests.record', {'n': n})
+
+        db.session.commit()
+
+        self.wait_for(lambda: len(received) == 5)
+
+        assert sorted(payload['n'] for payload in received) == [0, 1, 2, 3, 4]
+
+        self.wait_for(lambda: db.session.execute(db.select(db.func.count(Job.id))).scalar() == 0)
+
+    def test_process_pool(self):
+        path = os.path.join(self.directory, 'ran')
+
+        self.queue.workers = 2
+        self.queue.pool = 'process'
+        self.queue.start()
+
+        for _ in range(3):
+            enqueue(db.session, 'tests.write_file', {'path': path})
+
+        db.session.commit()
+
+        self.wait_for(lambda: os.path.exists(path) and len(open(path).read().split()) == 3)
+
+        assert str(os.getpid()) not in open(path).read().split()
+
+        self.wait_for(lambda: db.session.execute(db.select(db.func.count(Job.id))).scalar() == 0)
@@ -0,0 +1,65 @@
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+# the database the app created before it had migrations, its tables are those of the initial schema
+BASELINE_DATABASE = os.path.join(ROOT, 'api', 'config', 'db.sqlite3')
+INITIAL_REVISION = '53c75a1025a3'
+
+
+# migrations are run through the flask db command on a copy of the baseline database, as a deployment would
+class MigrationTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.database = os.path.join(self.directory, 'db.sqlite3')
+
+        shutil.copyfile(BASELINE_DATABASE, self.database)
+
+        # a database created without migrations is marked as being at the initial schema first
+        self.flask_db('stamp', INITIAL_REVISION)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def flask_db(self, *args):
+        env = dict(os.environ, FLASK_CONFIG='prod', JWT_SECRET_KEY='secret', DATABASE_URL='sqlite:///' + self.database)
+        result = subprocess.run(
+            [sys.executable, '-m', 'flask', '--app', 'api:create_app', 'db', *args],
+            cwd=ROOT, env=env, capture_output=True, text=True
+        )
+
+        assert result.returncode == 0, result.stderr
+
+        return result.stderr
+
+    def query(self, statement):
+        connection = sqlite3.connect(self.database)
+
+        try:
+            return connection.execute(statement).fetchall()
+        finally:
+            connection.close()
+
+    # users were all stored inactive by the old default, none of them was switched off on purpose
+    def test_baseline_users_are_activated(self):
+        assert self.query("SELECT id, is_active FROM users ORDER BY id") == [(1, 0), (2, 0), (3, 0)]
+
+        self.flask_db('upgrade', '9ea770770efc')
+
+        assert self.query("SELECT id, is_active FROM users ORDER BY id") == [(1, 1), (2, 1), (3, 1)]
+
+    # free-text flavours are coded case-insensitively, the ones that aren't an OrderFlavour become mix
+    def test_baseline_orders_are_coded(self):
+        assert self.query("SELECT id, flavour FROM orders ORDER BY id") == [(1, 'Pork'), (3, 'Onion')]
+
+        output = self.flask_db('upgrade')
+
+        assert self.query("SELECT id, flavour FROM orders ORDER BY id") == [(1, 4), (3, 2)]
+
+        assert "orders: 1 rows with flavours that are not one of OrderFlavour rewritten to 'mix': 'Onion' (1)" in output
@@ -1,31 +1,34 @@
+import csv
+import gzip
+import io
+import os
+import shutil
+import tempfile
+import threading
 import unittest
+from unittest.mock import patch
+from concurrent.futures import ThreadPoolExecutor
 from .. import create_app
 from ..config.config import config_dict
 from ..utils import db
-from ..models.orders import Order
+from ..models.orders import Order, OrderFlavour, OrderStatus, Sizes, FLAVOUR_CODES, ORDER_STATUS_CODES, SIZE_CODES
+from ..models.rollups import OrderRollup, aggregate_orders, aggregate_rollups
+from ..models.archive import OrderArchive
+from ..models.users import User
+from .helpers import QueryCountMixin, TransactionalTestCase
+from ..orders.views import order_model
+from ..orders.cache import OrderCache, order_etag
+from ..utils.cache import TTLCache
+from ..orders.kitchen import KitchenQueue
+from ..orders.serializers import order_rows, serialize_orders
+from flask_restx import marshal
+from ..utils.broker import InProcessBroker, DROP_OLDEST
+from flask import json
 from flask_jwt_extended import create_access_token
+from werkzeug.http import quote_etag
+from datetime import datetime, timedelta
 
-class OrderTestCase(unittest.TestCase):
-    def setUp(self):
-
-        self.app = create_app(config=config_dict['test'])
-
-        self.appctx = self.app.app_context()
-        
-        self.appctx.push()
-
-        self.client = self.app.test_client()
-
-        db.create_all()
-
-    def tearDown(self):
-        db.drop_all()
-
-        self.app = None
-
-        self.client = None
-
-        self.appctx.pop()
+class OrderTestCase(QueryCountMixin, TransactionalTestCase):
 
     # testing route for getting all others
     def test_get_all_orders(self):
@@ -99,3 +102,1116 @@ class OrderTestCase(unittest.TestCase):
         response = self.client.get('/orders/order/1', headers=headers)
 
         assert response.status_code == 200
+
+    # function to test the orders list is returned a page at a time
+    def test_get_orders_paginated(self):
+        for quantity in range(1, 6):
+            Order(size = 'SMALL', flavour = "Pepperoni", quantity = quantity).save()
+
+        token = create_access_token(identity="testuser")
+
+        headers = {
+            "Authorization": f"Bearer {token}"
+        }
+
+        response = self.client.get('/orders/orders?limit=2', headers=headers)
+
+        assert response.status_code == 200
+
+        assert [order['quantity'] for order in response.json] == [1, 2]
+
+        # following the cursors should walk through every order exactly once
+        seen = [order['id'] for order in response.json]
+
+        while 'X-Next-Cursor' in response.headers:
+            response = self.client.get(f"/orders/orders?limit=2&cursor={response.headers['X-Next-Cursor']}", headers=headers)
+
+            seen += [order['id'] for order in response.json]
+
+        assert seen == [1, 2, 3, 4, 5]
+
+    # function to test the orders list filters
+    def test_get_orders_filtered(self):
+        Order(size = 'SMALL', flavour = "Pepperoni", quantity = 1).save()
+        Order(size = 'LARGE', flavour = "Pepperoni", quantity = 2, order_status = OrderStatus.DELIVERED).save()
+
+        token = create_access_token(identity="testuser")
+
+        headers = {
+            "Authorization": f"Bearer {token}"
+        }
+
+        response = self.client.get('/orders/orders?order_status=DELIVERED', headers=headers)
+
+        assert response.status_code == 200
+
+        assert [order['quantity'] for order in response.json] == [2]
+
+        response = self.client.get('/orders/orders?size=SMALL', headers=headers)
+
+        assert [order['quantity'] for order in response.json] == [1]
+
+        # a cursor that was not issued by us is rejected
+        response = self.client.get('/orders/orders?cursor=notacursor', headers=headers)
+
+        assert response.status_code == 400
+
+    # function to test streaming the orders as NDJSON
+    def test_stream_orders(self):
+        for quantity in range(1, 4):
+            Order(size = 'MEDIUM', flavour = "Pepperoni", quantity = quantity).save()
+
+        token = create_access_token(identity="testuser")
+
+        headers = {
+            "Authorization": f"Bearer {token}"
+        }
+
+        # a tiny batch size forces several queries behind the single response
+        self.app.config['ORDERS_STREAM_BATCH_SIZE'] = 2
+
+        response = self.client.get('/orders/orders/stream', headers=headers)
+
+        assert response.status_code == 200
+
+        assert response.mimetype == 'application/x-ndjson'
+
+        orders = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+
+        assert [order['quantity'] for order in orders] == [1, 2, 3]
+
+    # function to test the staff only export, its formats, filters and resuming from a cursor
+    def test_export_orders(self):
+        staff = User(username = "staff", email = "staff@gmail.com", password_hash = "hash", is_staff = True)
+        customer = User(username = "testuser", email = "testuser@gmail.com", password_hash = "hash")
+
+        staff.save()
+        customer.save()
+
+        start = datetime(2023, 1, 1)
+
+        for day in range(5):
+            Order(size = 'SMALL', flavour = "mix", quantity = day + 1, customer = customer.id,
+                  date_created = start + timedelta(days=day)).save()
+
+        Order(size = 'LARGE', flavour = "pork", quantity = 9, customer = customer.id, order_status = OrderStatus.DELIVERED,
+              date_created = start).save()
+
+        db.session.add(OrderArchive(id = 100, size = 'MEDIUM', flavour = "chicken", quantity = 7, customer = customer.id,
+                                    order_status = OrderStatus.DELIVERED, date_created = start - timedelta(days=1)))
+        db.session.commit()
+
+        # a tiny batch size forces several reads behind the single response
+        self.app.config['ORDERS_EXPORT_BATCH_SIZE'] = 2
+
+        headers = {"Authorization": f"Bearer {create_access_token(identity='staff', additional_claims={'user_id': staff.id})}"}
+
+        forbidden = {"Authorization": f"Bearer {create_access_token(identity='testuser', additional_claims={'user_id': customer.id})}"}
+
+        assert self.client.get('/orders/orders/export', headers=forbidden).status_code == 403
+
+        response = self.client.get('/orders/orders/export?order_status=PENDING', headers=headers)
+
+        assert response.status_code == 200 and response.mimetype == 'text/csv'
+
+        rows = list(csv.DictReader(io.StringIO(response.get_data(as_text=True))))
+
+        assert [row['quantity'] for row in rows] == ['1', '2', '3', '4', '5']
+
+        assert rows[0]['size'] == 'SMALL' and rows[0]['order_status'] == 'PENDING' and rows[0]['date_created'] == '2023-01-01T00:00:00'
+
+        # picking up after the third row, with the date and both statuses filtered
+        response = self.client.get(
+            f"/orders/orders/export?format=ndjson&gzip=true&order_status=PENDING&order_status=DELIVERED"
+            f"&date_to=2023-01-05T00:00:00&cursor={rows[2]['cursor']}", headers=headers
+        )
+
+        assert response.mimetype == 'application/gzip'
+
+        orders = [json.loads(line) for line in gzip.decompress(response.data).decode().splitlines()]
+
+        assert [order['quantity'] for order in orders] == [4]
+
+        assert self.client.get('/orders/orders/export?cursor=nope', headers=headers).status_code == 400
+
+        # archived orders are exported with the others, in date order
+        response = self.client.get('/orders/orders/export?order_status=DELIVERED', headers=headers)
+
+        rows = list(csv.DictReader(io.StringIO(response.get_data(as_text=True))))
+
+        assert [(row['id'], row['quantity']) for row in rows] == [('100', '7'), ('6', '9')]
+
+        response = self.client.get(f"/orders/orders/export?order_status=DELIVERED&cursor={rows[0]['cursor']}", headers=headers)
+
+        assert [row['id'] for row in csv.DictReader(io.StringIO(response.get_data(as_text=True)))] == ['6']
+
+        # the CLI replaces what the file held and appends a resumed export to it without repeating the CSV header
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'orders.csv')
+
+        with open(path, 'w') as file:
+            file.write('an earlier export\n')
+
+        try:
+            runner = self.app.test_cli_runner()
+
+            result = runner.invoke(args=['orders', 'export', '--date-to', '2023-01-02', '-o', path])
+
+            assert result.exit_code == 0
+
+            cursor = result.output.split('--cursor ')[1].strip()
+
+            result = runner.invoke(args=['orders', 'export', '--status', 'PENDING', '--cursor', cursor, '-o', path])
+
+            assert 'Exported 4 orders' in result.output
+
+            with open(path, newline='') as file:
+                rows = list(csv.DictReader(file))
+        finally:
+            shutil.rmtree(directory)
+
+        assert [row['quantity'] for row in rows] == ['7', '1', '9', '2', '3', '4', '5']
+
+    # function to test a user's orders are fetched with a single query
+    def test_get_user_orders(self):
+        user = User(username = "testuser", email = "testuser@gmail.com", password_hash = "hash")
+
+        user.save()
+
+        for quantity in range(1, 4):
+            Order(size = 'SMALL', flavour = "Pepperoni", quantity = quantity, customer = user.id).save()
+
+        # an order by someone else must not show up
+        Order(size = 'SMALL', flavour = "Pepperoni", quantity = 9).save()
+
+        token = create_access_token(identity="testuser")
+
+        headers = {
+            "Authorization": f"Bearer {token}"
+        }
+
+        # read before counting, touching expired attributes would itself query
+        url = f'/orders/user/{user.id}/orders?limit=2'
+
+        with self.assertNumQueries(1):
+            response = self.client.get(url, headers=headers)
+
+        assert response.status_code == 200
+
+        assert [order['quantity'] for order in response.json] == [1, 2]
+
+        assert 'X-Next-Cursor' in response.headers
+
+        # a user with no orders is still found, an unknown user is a 404
+        response = self.client.get('/orders/user/99/orders', headers=headers)
+
+        assert response.status_code == 404
+
+    # function to test getting a specific order of a user
+    def test_get_specific_user_order(self):
+        user = User(username = "testuser", email = "testuser@gmail.com", password_hash = "hash")
+
+        user.save()
+
+        order = Order(size = 'LARGE', flavour = "Pepperoni", quantity = 2, customer = user.id)
+
+        order.save()
+
+        token = create_access_token(identity="testuser")
+
+        headers = {
+            "Authorization": f"Bearer {token}"
+        }
+
+        # read before counting, touching expired attributes would itself query
+        url = f'/orders/user/{user.id}/order/{order.id}'
+
+        with self.assertNumQueries(1):
+            response = self.client.get(url, headers=headers)
+
+        assert response.status_code == 200
+
+        assert response.json['quantity'] == 2
+
+        response = self.client.get('/orders/user/99/order/1', headers=headers)
+
+        assert response.status_code == 404
+
+    # function to test an order placed with a user_id claim needs no users query
+    def test_create_order_uses_identity_claim(self):
+        user = User(username = "testuser", email = "testuser@gmail.com", password_hash = "hash")
+
+        user.save()
+
+        user_id = user.id
+
+        token = create_access_token(identity="testuser", additional_claims={"user_id": user_id})
+
+        headers = {
+            "Authorization": f"Bearer {token}"
+        }
+
+        data = {
+            "size": "SMALL",
+            "quantity": 1,
+            "flavour":"Pepperroni"
+        }
+
+        # the first request fills the identity cache
+        response = self.client.post('/orders/orders', json=data, headers=headers)
+
+        assert response.status_code == 201
+
+        # the second one only inserts, adds it to its rollup bucket (and reloads the new row for the response)
+        with self.assertNumQueries(3) as statements:
+            response = self.client.post('/orders/orders', json=data, headers=headers)
+
+        assert response.status_code == 201
+
+        assert not any('FROM users' in statement for statement in statements)
+
+        assert [order.customer for order in Order.query.all()] == [user_id, user_id]
+
+    # function to test a deactivated user can no longer place orders with a live token
+    def test_create_order_deactivated_user(self):
+        user = User(username = "testuser", email = "testuser@gmail.com", password_hash = "hash")
+
+        user.save()
+
+        token = create_access_token(identity="testuser", additional_claims={"user_id": user.id})
+
+        headers = {
+            "Authorization": f"Bearer {token}"
+        }
+
+        data = {
+            "size": "SMALL",
+            "quantity": 1,
+            "flavour":"Pepperroni"
+        }
+
+        response = self.client.post('/orders/orders', json=data, headers=headers)
+
+        assert response.status_code == 201
+
+        # deactivating the user drops the cached identity
+        user.is_active = False
+
+        db.session.commit()
+
+        response = self.client.post('/orders/orders', json=data, headers=headers)
+
+        assert response.status_code == 401
+
+        # tokens issued before the user_id claim only name the user, they are refused too
+        legacy = {"Authorization": f"Bearer {create_access_token(identity='testuser')}"}
+
+        assert self.client.post('/orders/orders', json=data, headers=legacy).status_code == 401
+
+        assert len(Order.query.all()) == 1
+
+    # function to test placing many orders in a single request
+    def test_bulk_create_orders(self):
+        token = create_access_token(identity="testuser")
+
+        headers = {
+            "Authorization": f"Bearer {token}"
+        }
+
+        data = [
+            {"size": "SMALL", "quantity": 1, "flavour": "Pepperroni"},
+            {"size": "HUGE", "quantity": 1, "flavour": "Pepperroni"},
+            {"size": "LARGE", "quantity": 3, "flavour": "Chicken"},
+            {"size": "MEDIUM", "quantity": 2, "flavour": "Pork"},
+            {"size": "SMALL", "quantity": 1, "flavour": "Pineapple"},
+        ]
+
+        # a chunk size smaller than the request exercises several INSERT batches
+        self.app.config['ORDERS_BULK_CHUNK_SIZE'] = 2
+
+        execute = db.session.execute
+
+        # the database is free to send the RETURNING rows back in any order
+        def execute_reversed(statement, *args, **kwargs):
+            result = execute(statement, *args, **kwargs)
+
+            return list(reversed(result.all())) if getattr(statement, 'is_insert', False) else result
+
+        with patch.object(db.session, 'execute', execute_reversed):
+            response = self.client.post('/orders/orders/bulk', json=data, headers=headers)
+
+        # the invalid size and flavour are reported while the other orders are created
+        assert response.status_code == 207
+
+        assert [result['status'] for result in response.json] == [201, 400, 201, 201, 400]
+
+        assert 'size' in response.json[1]['errors']
+
+        assert 'flavour' in response.json[4]['errors']
+
+        orders = {order.id: order for order in Order.query.all()}
+
+        assert len(orders) == 3
+
+        assert orders[response.json[0]['id']].size == Sizes.SMALL
+
+        assert orders[response.json[2]['id']].quantity == 3
+
+        assert orders[response.json[3]['id']].flavour == OrderFlavour.PORK
+
+    # function to test flavours are checked and that sizes, statuses and flavours are stored as codes
+    def test_order_attributes_stored_as_codes(self):
+        headers = {"Authorization": f"Bearer {create_access_token(identity='testuser')}"}
+
+        response = self.client.post('/orders/orders', json={"size": "LARGE", "quantity": 1, "flavour": "Pineapple"}, headers=headers)
+
+        assert response.status_code == 400 and 'Pineapple' in response.json['message']
+
+        # by name or as shown, in any case, and shown the same way whichever was sent
+        for flavour in ("PEPPERONI", "Pepperroni"):
+            response = self.client.post('/orders/orders', json={"size": "LARGE", "quantity": 1, "flavour": flavour}, headers=headers)
+
+            assert response.status_code == 201 and response.json['flavour'] == 'pepperroni'
+
+        row = db.session.execute(db.text("SELECT size, order_status, flavour FROM orders WHERE id = :id"), {'id': response.json['id']}).one()
+
+        assert tuple(row) == (SIZE_CODES[Sizes.LARGE], ORDER_STATUS_CODES[OrderStatus.PENDING], FLAVOUR_CODES[OrderFlavour.PEPPERONI])
+
+        assert self.client.get(f"/orders/order/{response.json['id']}", headers=headers).json == {
+            'id': response.json['id'], 'size': 'Sizes.LARGE', 'order_status': 'OrderStatus.PENDING', 'flavour': 'pepperroni', 'quantity': 1
+        }
+
+        # the active statuses are found through their partial indexes
+        for status, index in ((OrderStatus.PENDING, 'ix_orders_pending_date_created'), (OrderStatus.IN_TRANSIT, 'ix_orders_in_transit_date_created')):
+            query = order_rows().filter(Order.order_status == status).order_by(Order.date_created, Order.id).limit(20)
+
+            statement = query.statement.compile(dialect=db.engine.dialect, compile_kwargs={'literal_binds': True})
+
+            plan = db.session.connection().exec_driver_sql(f'EXPLAIN QUERY PLAN {statement}').all()
+
+            assert index in ' '.join(row.detail for row in plan)
+
+    # function to test placing many orders sent as NDJSON
+    def test_bulk_create_orders_ndjson(self):
+        token = create_access_token(identity="testuser")
+
+        headers = {
+            "Authorization": f"Bearer {token}",
+            "Content-Type": "application/x-ndjson"
+        }
+
+        body = "\n".join(json.dumps({"size": "SMALL", "quantity": quantity, "flavour": "Mix"}) for quantity in range(1, 4))
+
+        response = self.client.post('/orders/orders/bulk', data=body + "\nnot json\n", headers=headers)
+
+        assert response.status_code == 207
+
+        assert [result['status'] for result in response.json] == [201, 201, 201, 400]
+
+        assert [order.quantity for order in Order.query.all()] == [1, 2, 3]
+
+    # function to test moving many orders to the next status at once
+    def test_bulk_update_order_status(self):
+        for quantity in range(1, 4):
+            Order(size = 'SMALL', flavour = "Pepperoni", quantity = quantity).save()
+
+        Order(size = 'SMALL', flavour = "Pepperoni", quantity = 4, order_status = OrderStatus.DELIVERED).save()
+
+        token = create_access_token(identity="testuser")
+
+        headers = {
+            "Authorization": f"Bearer {token}"
+        }
+
+        # the delivered order and the unknown id cannot move to IN_TRANSIT, the rollups are moved by one more statement
+        with self.assertNumQueries(2):
+            response = self.client.patch('/orders/order/status', json={"order_status": "IN_TRANSIT", "ids": [1, 2, 4, 99]}, headers=headers)
+
+        assert response.status_code == 200
+
+        assert sorted(response.json['updated']) == [1, 2]
+
+        assert response.json['skipped'] == [4, 99]
+
+        # orders can only move forward, one step at a time
+        response = self.client.patch('/orders/order/status', json={"order_status": "DELIVERED", "filter": {"size": "SMALL"}}, headers=headers)
+
+        assert sorted(response.json['updated']) == [1, 2]
+
+        response = self.client.patch('/orders/order/status', json={"order_status": "PENDING", "ids": [1]}, headers=headers)
+
+        assert response.status_code == 400
+
+        # a filter that doesn't narrow the orders down would move all of them, it's refused
+        for order_filter in ({"foo": 1}, {"size": None}, {"size": "SMALL", "foo": 1}, {"customer": "1"}, {"customer": True}):
+            response = self.client.patch('/orders/order/status', json={"order_status": "IN_TRANSIT", "filter": order_filter}, headers=headers)
+
+            assert response.status_code == 400
+
+        statuses = {order.id: order.order_status for order in Order.query.all()}
+
+        assert statuses == {
+            1: OrderStatus.DELIVERED,
+            2: OrderStatus.DELIVERED,
+            3: OrderStatus.PENDING,
+            4: OrderStatus.DELIVERED
+        }
+
+    # function to test repeated reads of an order are served from the cache and revalidated with ETags
+    def test_get_order_cached_with_etag(self):
+        Order(size = 'LARGE', flavour = "Pepperoni", quantity = 2).save()
+
+        token = create_access_token(identity="testuser")
+
+        headers = {
+            "Authorization": f"Bearer {token}"
+        }
+
+        response = self.client.get('/orders/order/1', headers=headers)
+
+        assert response.status_code == 200
+
+        etag = response.headers['ETag']
+
+        # the second read doesn't touch the database
+        with self.assertNumQueries(0):
+            response = self.client.get('/orders/order/1', headers=headers)
+
+        assert response.json['quantity'] == 2
+
+        # an unchanged order only costs a 304 with no body
+        response = self.client.get('/orders/order/1', headers=dict(headers, **{"If-None-Match": etag}))
+
+        assert response.status_code == 304
+
+        assert response.data == b''
+
+        # the write is visible to the very next read
+        response = self.client.patch('/orders/order/status/1', json={"order_status": "IN_TRANSIT"}, headers=headers)
+
+        response = self.client.get('/orders/order/1', headers=dict(headers, **{"If-None-Match": etag}))
+
+        assert response.status_code == 200
+
+        assert response.json['order_status'] == 'OrderStatus.IN_TRANSIT'
+
+    # function to test writes made with If-Match only apply to the version of the order that was read
+    def test_update_order_if_match(self):
+        Order(size = 'LARGE', flavour = "Pepperoni", quantity = 2).save()
+
+        token = create_access_token(identity="testuser")
+
+        headers = {
+            "Authorization": f"Bearer {token}"
+        }
+
+        etag = self.client.get('/orders/order/1', headers=headers).headers['ETag']
+
+        data = {"size": "MEDIUM", "quantity": 3, "flavour": "chicken"}
+
+        response = self.client.put('/orders/order/1', json=data, headers=dict(headers, **{"If-Match": etag}))
+
+        assert response.status_code == 200
+
+        assert response.headers['ETag'] != etag
+
+        # the order changed since etag was read
+        response = self.client.put('/orders/order/1', json=data, headers=dict(headers, **{"If-Match": etag}))
+
+        assert response.status_code == 412
+
+        assert self.client.delete('/orders/order/1', headers=dict(headers, **{"If-Match": etag})).status_code == 412
+
+        assert self.client.patch('/orders/order/status/1', json={"order_status": "IN_TRANSIT"}, headers=dict(headers, **{"If-Match": etag})).status_code == 412
+
+        # the status moves with the current ETag, in a single UPDATE
+        etag = self.client.get('/orders/order/1', headers=headers).headers['ETag']
+
+        # an order created at another time under the same id and version, such as one deleted before this one, doesn't match
+        order = db.session.get(Order, 1)
+        other = quote_etag(order_etag(1, order.date_created - timedelta(days=1), order.version))
+
+        assert other != etag
+
+        assert self.client.patch('/orders/order/status/1', json={"order_status": "IN_TRANSIT"}, headers=dict(headers, **{"If-Match": other})).status_code == 412
+
+        assert self.client.put('/orders/order/1', json=data, headers=dict(headers, **{"If-Match": other})).status_code == 412
+
+        with self.assertNumQueries(2):
+            response = self.client.patch('/orders/order/status/1', json={"order_status": "IN_TRANSIT"}, headers=dict(headers, **{"If-Match": etag}))
+
+        assert response.status_code == 200
+
+        assert response.json['order_status'] == 'OrderStatus.IN_TRANSIT' and response.json['quantity'] == 3
+
+        # an order moves to a status once, and never backwards
+        assert self.client.patch('/orders/order/status/1', json={"order_status": "IN_TRANSIT"}, headers=headers).status_code == 409
+
+        assert self.client.patch('/orders/order/status/1', json={"order_status": "PENDING"}, headers=headers).status_code == 400
+
+        assert self.client.patch('/orders/order/status/2', json={"order_status": "IN_TRANSIT"}, headers=headers).status_code == 404
+
+        # If-Match: * accepts any version
+        assert self.client.delete('/orders/order/1', headers=dict(headers, **{"If-Match": "*"})).status_code == 200
+
+    # function to test a user's cached orders are dropped when one of them changes
+    def test_user_orders_cache_invalidated(self):
+        user = User(username = "testuser", email = "testuser@gmail.com", password_hash = "hash")
+
+        user.save()
+
+        user_id = user.id
+
+        Order(size = 'SMALL', flavour = "Pepperoni", quantity = 1, customer = user_id).save()
+
+        token = create_access_token(identity="testuser", additional_claims={"user_id": user_id})
+
+        headers = {
+            "Authorization": f"Bearer {token}"
+        }
+
+        response = self.client.get(f'/orders/user/{user_id}/orders', headers=headers)
+
+        assert len(response.json) == 1
+
+        with self.assertNumQueries(0):
+            response = self.client.get(f'/orders/user/{user_id}/orders', headers=headers)
+
+        # orders placed in bulk skip the ORM events but still invalidate the cache
+        self.client.post('/orders/orders/bulk', json=[{"size": "SMALL", "quantity": 2, "flavour": "Mix"}], headers=headers)
+
+        response = self.client.get(f'/orders/user/{user_id}/orders', headers=headers)
+
+        assert [order['quantity'] for order in response.json] == [1, 2]
+
+        self.client.patch('/orders/order/status', json={"order_status": "IN_TRANSIT", "ids": [1]}, headers=headers)
+
+        response = self.client.get(f'/orders/user/{user_id}/orders', headers=headers)
+
+        assert response.json[0]['order_status'] == 'OrderStatus.IN_TRANSIT'
+
+    # function to test an invalidation made by one process keeps another sharing the backend from writing back
+    # what it read before it, and that a user's cached pages are capped
+    def test_order_cache_shared_backend(self):
+        backend = TTLCache()
+        reader, writer = OrderCache(backend, max_user_pages=2), OrderCache(backend, max_user_pages=2)
+
+        generation = reader.generation()
+
+        writer.invalidate(1, 1)
+
+        reader.set_order(1, 1, datetime(2023, 1, 1), 1, {'id': 1}, generation)
+        reader.set_user_orders(1, 'page', [{'id': 1}], None, generation)
+
+        assert reader.get_order(1) is None and reader.get_user_orders(1, 'page') is None
+
+        generation = reader.generation()
+
+        for page in ('first', 'second', 'third'):
+            reader.set_user_orders(1, page, [], None, generation)
+
+        assert reader.get_user_orders(1, 'first') is None
+
+        assert reader.get_user_orders(1, 'second') is not None and writer.get_user_orders(1, 'third') is not None
+
+    # function to test the fast serializer renders orders exactly like marshal_with(order_model)
+    def test_serializer_matches_marshal(self):
+        Order(size = 'SMALL', flavour = "Pepperoni", quantity = 1).save()
+        Order(size = 'EXTRA_LARGE', flavour = "Mix", quantity = None, order_status = OrderStatus.IN_TRANSIT).save()
+        Order(size = 'MEDIUM', flavour = "Chicken", quantity = 12, order_status = OrderStatus.DELIVERED).save()
+
+        # keys are left unsorted so their order is compared too
+        expected = json.dumps(marshal(Order.query.order_by(Order.id).all(), order_model), sort_keys=False)
+
+        assert json.dumps(serialize_orders(order_rows().order_by(Order.id).all()), sort_keys=False) == expected
+
+    # function to test order changes are streamed to the user's subscribers
+    def test_user_order_events(self):
+        user = User(username = "testuser", email = "testuser@gmail.com", password_hash = "hash")
+
+        user.save()
+
+        user_id = user.id
+
+        token = create_access_token(identity="testuser", additional_claims={"user_id": user_id})
+
+        headers = {
+            "Authorization": f"Bearer {token}"
+        }
+
+        self.app.config['EVENT_KEEPALIVE'] = 0.01
+
+        response = self.client.get(f'/orders/user/{user_id}/events', headers=headers, buffered=False)
+
+        assert response.status_code == 200
+
+        assert response.mimetype == 'text/event-stream'
+
+        stream = iter(response.response)
+
+        assert next(stream) == b'retry: 3000\n\n'
+
+        self.client.post('/orders/orders', json={"size": "SMALL", "quantity": 1, "flavour": "Mix"}, headers=headers)
+
+        self.client.patch('/orders/order/status/1', json={"order_status": "IN_TRANSIT"}, headers=headers)
+
+        events = [next(stream).decode() for _ in range(2)]
+
+        assert events[0].startswith('event: order\ndata: ')
+
+        assert [json.loads(event.split('data: ')[1]) for event in events] == [
+            {"action": "insert", "id": 1, "order_status": "OrderStatus.PENDING"},
+            {"action": "update", "id": 1, "order_status": "OrderStatus.IN_TRANSIT"},
+        ]
+
+        # nothing else happened, the idle stream only sends keepalives
+        assert next(stream) == b': keepalive\n\n'
+
+        broker = self.app.extensions['event_broker']
+
+        assert broker.subscriber_count() == 1
+
+        response.close()
+
+        assert broker.subscriber_count() == 0
+
+    # function to test a slow subscriber loses its oldest events instead of growing without bound
+    def test_event_queue_drops_oldest(self):
+        broker = InProcessBroker(queue_size=2, policy=DROP_OLDEST)
+
+        subscription = broker.subscribe('user:1')
+
+        for number in range(5):
+            broker.publish('user:1', number)
+
+        assert [subscription.get(timeout=0), subscription.get(timeout=0)] == [3, 4]
+
+        assert subscription.dropped == 3
+
+
+    # function to test the hourly rollups follow every kind of order write and agree with a GROUP BY over orders
+    def test_order_rollups_follow_writes(self):
+        token = create_access_token(identity="testuser")
+
+        headers = {
+            "Authorization": f"Bearer {token}"
+        }
+
+        self.client.post('/orders/orders', json={"size": "SMALL", "quantity": 2, "flavour": "mix"}, headers=headers)
+        self.client.post('/orders/orders/bulk', json=[
+            {"size": "SMALL", "quantity": 3, "flavour": "mix"},
+            {"size": "LARGE", "quantity": 1, "flavour": "pork"},
+            {"size": "LARGE", "quantity": 4, "flavour": "pork"},
+        ], headers=headers)
+
+        self.client.patch('/orders/order/status', json={"order_status": "IN_TRANSIT", "ids": [1, 3]}, headers=headers)
+        self.client.patch('/orders/order/status/3', json={"order_status": "DELIVERED"}, headers=headers)
+        self.client.put('/orders/order/2', json={"size": "MEDIUM", "quantity": 5, "flavour": "chicken"}, headers=headers)
+        self.client.delete('/orders/order/4', headers=headers)
+
+        group_by = ('hour', 'size', 'flavour', 'order_status')
+
+        assert list(aggregate_rollups(group_by)) == list(aggregate_orders(group_by))
+
+        assert {(row['size'], row['order_status']): (row['orders'], row['quantity']) for row in aggregate_rollups(('size', 'order_status'))} == {
+            (Sizes.SMALL, OrderStatus.IN_TRANSIT): (1, 2),
+            (Sizes.MEDIUM, OrderStatus.PENDING): (1, 5),
+            (Sizes.LARGE, OrderStatus.DELIVERED): (1, 1),
+        }
+
+        # rebuilding from scratch gives the same buckets
+        result = self.app.test_cli_runner().invoke(args=['orders', 'rebuild-rollups'])
+
+        assert result.exit_code == 0 and result.output.startswith('Rebuilt ')
+
+        assert list(aggregate_rollups(group_by)) == list(aggregate_orders(group_by))
+
+    # function to test orders without a size all count in one rollup bucket
+    def test_order_rollups_missing_values(self):
+        date_created = datetime(2026, 1, 1, 9)
+
+        # orders stored before sizes and statuses had defaults
+        for quantity in (1, 2):
+            order = Order(flavour = "mix", quantity = quantity, date_created = date_created)
+            order.save()
+
+            order.size = None
+            order.order_status = None
+            order.update()
+
+        assert [(row.size, row.order_status, row.orders, row.quantity) for row in OrderRollup.query.filter(OrderRollup.orders > 0)] == [(None, None, 2, 3)]
+
+        group_by = ('hour', 'size', 'flavour', 'order_status')
+
+        OrderRollup.rebuild()
+
+        assert list(aggregate_rollups(group_by)) == list(aggregate_orders(group_by))
+
+    # function to test the stats endpoints read the rollups for whole hours and the orders table otherwise
+    def test_order_stats(self):
+        Order(size = 'SMALL', flavour = "mix", quantity = 2, date_created = datetime(2026, 1, 1, 9, 15)).save()
+        Order(size = 'SMALL', flavour = "mix", quantity = 3, date_created = datetime(2026, 1, 1, 9, 45)).save()
+        Order(size = 'LARGE', flavour = "pork", quantity = 1, date_created = datetime(2026, 1, 1, 10, 5),
+              order_status = OrderStatus.DELIVERED).save()
+
+        token = create_access_token(identity="testuser")
+
+        headers = {
+            "Authorization": f"Bearer {token}"
+        }
+
+        response = self.client.get('/orders/stats?group_by=size,order_status', headers=headers)
+
+        assert response.status_code == 200
+
+        assert response.json == {'source': 'rollups', 'groups': [
+            {'size': 'LARGE', 'order_status': 'DELIVERED', 'orders': 1, 'quantity': 1},
+            {'size': 'SMALL', 'order_status': 'PENDING', 'orders': 2, 'quantity': 5},
+        ]}
+
+        response = self.client.get('/orders/stats/hourly', headers=headers)
+
+        assert response.json['groups'] == [
+            {'hour': '2026-01-01T09:00:00', 'size': 'SMALL', 'orders': 2, 'quantity': 5},
+            {'hour': '2026-01-01T10:00:00', 'size': 'LARGE', 'orders': 1, 'quantity': 1},
+        ]
+
+        # a range that does not fall on the hour has to look at the orders themselves
+        response = self.client.get('/orders/stats?group_by=flavour&date_from=2026-01-01T09:30:00', headers=headers)
+
+        assert response.json == {'source': 'orders', 'groups': [
+            {'flavour': 'mix', 'orders': 1, 'quantity': 3},
+            {'flavour': 'pork', 'orders': 1, 'quantity': 1},
+        ]}
+
+        response = self.client.get('/orders/stats/funnel', headers=headers)
+
+        assert response.json['funnel'] == [
+            {'order_status': 'PENDING', 'orders': 2, 'quantity': 5, 'reached': 3},
+            {'order_status': 'IN_TRANSIT', 'orders': 0, 'quantity': 0, 'reached': 1},
+            {'order_status': 'DELIVERED', 'orders': 1, 'quantity': 1, 'reached': 1},
+        ]
+
+        response = self.client.get('/orders/stats?group_by=customer', headers=headers)
+
+        assert response.status_code == 400
+
+    # function to test a retried order creation gets the first response back instead of a second order
+    def test_create_order_idempotency_key(self):
+        user = User(username = "testuser", email = "testuser@gmail.com", password_hash = "hash")
+
+        user.save()
+
+        token = create_access_token(identity="testuser", additional_claims={"user_id": user.id})
+
+        headers = {
+            "Authorization": f"Bearer {token}",
+            "Idempotency-Key": "3f1c9a"
+        }
+
+        data = {"size": "SMALL", "quantity": 2, "flavour": "Pepperroni"}
+
+        first = self.client.post('/orders/orders', json=data, headers=headers)
+
+        assert first.status_code == 201
+
+        assert first.headers['Idempotent-Replayed'] == 'false'
+
+        # the retry is answered from the cache without touching the database
+        with self.assertNumQueries(0):
+            retry = self.client.post('/orders/orders', json=data, headers=headers)
+
+        assert retry.status_code == 201
+
+        assert retry.headers['Idempotent-Replayed'] == 'true'
+
+        assert retry.json == first.json
+
+        # and from the idempotency_keys table once the cache has forgotten it
+        self.app.extensions['idempotency'].cache.clear()
+
+        assert self.client.post('/orders/orders', json=data, headers=headers).json == first.json
+
+        # the same key cannot be used for another order
+        response = self.client.post('/orders/orders', json=dict(data, quantity=3), headers=headers)
+
+        assert response.status_code == 422
+
+        assert Order.query.count() == 1
+
+        # keys the idempotency_keys table can't hold are refused before anything is stored
+        for key in ("", "k" * 256):
+            response = self.client.post('/orders/orders', json=data, headers=dict(headers, **{"Idempotency-Key": key}))
+
+            assert response.status_code == 400
+
+        assert Order.query.count() == 1
+
+        assert self.client.post('/orders/orders', json=data, headers=dict(headers, **{"Idempotency-Key": "k" * 255})).status_code == 201
+
+    # function to test old delivered orders move to the archive and are still part of a user's history on request
+    def test_archive_delivered_orders(self):
+        user = User(username = "testuser", email = "testuser@gmail.com", password_hash = "hash")
+
+        user.save()
+
+        old = datetime.utcnow() - timedelta(days=200)
+
+        for day in range(4):
+            Order(size = 'SMALL', flavour = "mix", quantity = 1, customer = user.id, order_status = OrderStatus.DELIVERED,
+                  date_created = old + timedelta(days=day)).save()
+
+        # too recent, and not delivered
+        Order(size = 'SMALL', flavour = "mix", quantity = 1, customer = user.id, order_status = OrderStatus.DELIVERED).save()
+        Order(size = 'LARGE', flavour = "pork", quantity = 2, customer = user.id, date_created = old).save()
+
+        stats = list(aggregate_orders(('order_status', 'size')))
+
+        token = create_access_token(identity="testuser")
+
+        headers = {
+            "Authorization": f"Bearer {token}"
+        }
+
+        # cached before they are archived
+        assert self.client.get('/orders/order/1', headers=headers).status_code == 200
+
+        subscription = self.app.extensions['event_broker'].subscribe(f'user:{user.id}')
+
+        assert len(self.client.get(f'/orders/user/{user.id}/orders', headers=headers).json) == 6
+
+        result = self.app.test_cli_runner().invoke(args=['orders', 'archive', '--older-than', '90', '--batch-size', '3'])
+
+        assert result.output == 'Archived 4 orders\n'
+
+        assert sorted(order.id for order in Order.query.all()) == [5, 6]
+
+        assert sorted(order.id for order in OrderArchive.query.all()) == [1, 2, 3, 4]
+
+        # archiving doesn't change what was ordered
+        assert list(aggregate_orders(('order_status', 'size'))) == stats
+
+        # streamed as archived, not as deleted
+        events = [subscription.get(timeout=0) for _ in range(4)]
+
+        assert [(event['action'], event['id']) for event in events] == [('archive', 1), ('archive', 2), ('archive', 3), ('archive', 4)]
+
+        subscription.close()
+
+        # archived orders are dropped from the caches like deleted ones
+        assert self.client.get('/orders/order/1', headers=headers).status_code == 404
+
+        response = self.client.get(f'/orders/user/{user.id}/orders', headers=headers)
+
+        assert [order['id'] for order in response.json] == [6, 5]
+
+        # the archived orders are merged in by date, page by page
+        ids = []
+        url = f'/orders/user/{user.id}/orders?include_archived=1&limit=4'
+
+        while url:
+            response = self.client.get(url, headers=headers)
+
+            ids += [order['id'] for order in response.json]
+
+            cursor = response.headers.get('X-Next-Cursor')
+            url = cursor and f'/orders/user/{user.id}/orders?include_archived=1&limit=4&cursor={cursor}'
+
+        assert ids == [1, 6, 2, 3, 4, 5]
+
+        # ids are never handed out again, not even once the newest order is gone
+        for order in Order.query.all():
+            order.delete()
+
+        Order(size = 'SMALL', flavour = "mix", quantity = 1, customer = user.id).save()
+
+        assert [order.id for order in Order.query.all()] == [7]
+
+    # function to test the kitchen queue follows the orders and hands each one out once
+    def test_kitchen_queue(self):
+        staff = User(username = "staff", email = "staff@gmail.com", password_hash = "hash", is_staff = True)
+
+        staff.save()
+
+        start = datetime(2023, 1, 1, 12)
+
+        # ready at 12:06, 12:02 and 12:03:30
+        Order(size = 'LARGE', flavour = "pork", quantity = 3, date_created = start).save()
+        Order(size = 'SMALL', flavour = "mix", quantity = 1, date_created = start + timedelta(minutes=1)).save()
+        Order(size = 'MEDIUM', flavour = "mix", quantity = 1, date_created = start + timedelta(minutes=2)).save()
+        Order(size = 'SMALL', flavour = "mix", quantity = 1, order_status = OrderStatus.DELIVERED, date_created = start).save()
+
+        headers = {"Authorization": f"Bearer {create_access_token(identity='staff', additional_claims={'user_id': staff.id})}"}
+
+        assert self.client.get('/orders/kitchen/next', headers={"Authorization": f"Bearer {create_access_token(identity='testuser')}"}).status_code == 403
+
+        # loaded from the table on first use
+        response = self.client.get('/orders/kitchen/next?n=5', headers=headers)
+
+        assert [order['id'] for order in response.json] == [2, 3, 1]
+
+        # placed later but smaller, and moved on by the status route
+        Order(size = 'SMALL', flavour = "mix", quantity = 1, date_created = start + timedelta(minutes=3)).save()
+
+        self.client.patch('/orders/order/status/2', json={"order_status": "IN_TRANSIT"}, headers=headers)
+
+        assert [order['id'] for order in self.client.get('/orders/kitchen/next?n=5', headers=headers).json] == [3, 5, 1]
+
+        # an edit places the order again
+        self.client.put('/orders/order/1', json={"size": "SMALL", "quantity": 1, "flavour": "pork"}, headers=headers)
+
+        assert [order['id'] for order in self.client.get('/orders/kitchen/next?n=2', headers=headers).json] == [1, 3]
+
+        response = self.client.post('/orders/kitchen/claim', headers=headers)
+
+        assert response.status_code == 200 and response.json['id'] == 1 and response.json['order_status'] == 'OrderStatus.IN_TRANSIT'
+
+        assert self.client.post('/orders/kitchen/claim', json={"id": 1}, headers=headers).status_code == 409
+
+        assert self.client.post('/orders/kitchen/claim', json={"id": 99}, headers=headers).status_code == 404
+
+        assert self.client.post('/orders/kitchen/claim', json={"id": 5}, headers=headers).json['id'] == 5
+
+        self.client.delete('/orders/order/3', headers=headers)
+
+        assert self.client.get('/orders/kitchen/next', headers=headers).json == []
+
+        assert self.client.post('/orders/kitchen/claim', headers=headers).status_code == 404
+
+        # another process only learns about orders from the table: one stamped before its last sync but committed
+        # after it, and one taking the id of a deleted order, are still picked up
+        other = KitchenQueue(self.app.config['KITCHEN_PREP_SECONDS'], sync_interval = 0)
+
+        assert other.peek(5) == []
+
+        late = Order(size = 'SMALL', flavour = "mix", quantity = 1, date_created = datetime.utcnow() - timedelta(seconds=30))
+
+        late.save()
+
+        assert other.peek(5) == [late.id]
+
+        late.delete()
+
+        # as next_orders does once it finds the order gone
+        other.discard(late.id)
+
+        replacement = Order(size = 'SMALL', flavour = "mix", quantity = 1)
+
+        replacement.save()
+
+        assert replacement.id in other.peek(5)
+
+# the app runs on a SQLite file here so that requests on several threads each get their own connection
+class ConcurrentOrderTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+        class ConcurrentTestConfig(config_dict['test']):
+            SQLALCHEMY_ECHO = False
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(self.directory, 'test.sqlite3')
+            SQLITE_PRAGMAS = {'journal_mode': 'WAL', 'busy_timeout': 10000}
+
+        self.app = create_app(config=ConcurrentTestConfig)
+
+        self.appctx = self.app.app_context()
+
+        self.appctx.push()
+
+        db.create_all()
+
+    def tearDown(self):
+        db.drop_all()
+
+        db.engine.dispose()
+
+        self.appctx.pop()
+
+        shutil.rmtree(self.directory)
+
+    # fires the same request from many threads at once, returning the responses
+    def request_concurrently(self, count, method, path, **kwargs):
+        barrier = threading.Barrier(count)
+
+        def send(_):
+            client = self.app.test_client()
+
+            barrier.wait()
+
+            return client.open(path, method=method, **kwargs)
+
+        with ThreadPoolExecutor(max_workers=count) as executor:
+            return list(executor.map(send, range(count)))
+
+    # function to test parallel duplicates of an order creation place a single order
+    def test_create_order_idempotency_key_concurrent(self):
+        with self.app.test_request_context():
+            token = create_access_token(identity="testuser")
+
+        headers = {
+            "Authorization": f"Bearer {token}",
+            "Idempotency-Key": "retry-storm"
+        }
+
+        responses = self.request_concurrently(
+            20, 'POST', '/orders/orders', json={"size": "LARGE", "quantity": 1, "flavour": "Chicken"}, headers=headers
+        )
+
+        assert [response.status_code for response in responses] == [201] * 20
+
+        # one request placed the order, every other one got its response
+        assert sorted(response.headers['Idempotent-Replayed'] for response in responses) == ['false'] + ['true'] * 19
+
+        assert len({response.json['id'] for response in responses}) == 1
+
+        assert Order.query.count() == 1
+
+    # function to test concurrent writers of one order: exactly one wins, the others are told rather than overwritten
+    def test_concurrent_order_updates(self):
+        Order(size = 'LARGE', flavour = "Pepperoni", quantity = 2).save()
+
+        with self.app.test_request_context():
+            token = create_access_token(identity="testuser")
+
+        headers = {
+            "Authorization": f"Bearer {token}"
+        }
+
+        etag = self.app.test_client().get('/orders/order/1', headers=headers).headers['ETag']
+
+        responses = self.request_concurrently(
+            20, 'PUT', '/orders/order/1', json={"size": "MEDIUM", "quantity": 3, "flavour": "chicken"},
+            headers=dict(headers, **{"If-Match": etag})
+        )
+
+        statuses = sorted(response.status_code for response in responses)
+
+        # the losers either saw the new version (412) or lost the race to the UPDATE (409)
+        assert statuses[0] == 200 and statuses.count(200) == 1
+
+        assert set(statuses[1:]) <= {409, 412}
+
+        responses = self.request_concurrently(20, 'PATCH', '/orders/order/status/1', json={"order_status": "IN_TRANSIT"}, headers=headers)
+
+        assert sorted(response.status_code for response in responses) == [200] + [409] * 19
+
+        db.session.expire_all()
+
+        assert db.session.get(Order, 1).version == 3
+
+    # function to test cooks claiming at the same time each get a different order
+    def test_concurrent_kitchen_claims(self):
+        staff = User(username = "staff", email = "staff@gmail.com", password_hash = "hash", is_staff = True)
+
+        staff.save()
+
+        for _ in range(5):
+            Order(size = 'SMALL', flavour = "mix", quantity = 1).save()
+
+        with self.app.test_request_context():
+            token = create_access_token(identity="staff", additional_claims={'user_id': staff.id})
+
+        responses = self.request_concurrently(10, 'POST', '/orders/kitchen/claim', headers={"Authorization": f"Bearer {token}"})
+
+        assert sorted(response.status_code for response in responses) == [200] * 5 + [404] * 5
+
+        assert sorted(response.json['id'] for response in responses if response.status_code == 200) == [1, 2, 3, 4, 5]
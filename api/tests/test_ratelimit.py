@@ -0,0 +1,174 @@
+import sqlite3
+import threading
+import time
+import unittest
+from .. import create_app
+from ..config.config import config_dict
+from ..utils import db
+from ..utils.ratelimit import AdmissionController, InMemoryRateLimitBackend, TimedQueuePool, parse_limit
+from ..models.users import User
+from flask_jwt_extended import create_access_token
+from werkzeug.security import generate_password_hash
+
+
+class RateLimitTestCase(unittest.TestCase):
+    def setUp(self):
+        class RateLimitConfig(config_dict['test']):
+            RATE_LIMITING = True
+            RATE_LIMITS = {
+                'POST /auth/login': {'ip': '2/minute'},
+                '/orders': {'identity': '2/minute'},
+            }
+            ADMISSION_MAX_IN_FLIGHT = 4
+
+        self.config = RateLimitConfig
+
+        self.app = create_app(config=RateLimitConfig)
+
+        self.appctx = self.app.app_context()
+
+        self.appctx.push()
+
+        self.client = self.app.test_client()
+
+        db.create_all()
+
+    def tearDown(self):
+        db.drop_all()
+
+        self.appctx.pop()
+
+        self.app = None
+
+        self.client = None
+
+    def test_login_limited_per_ip(self):
+        User(username = "testuser", email = "testuser@gmail.com", password_hash = generate_password_hash("password")).save()
+
+        data = {"email": "testuser@gmail.com", "password": "password"}
+
+        for _ in range(2):
+            assert self.client.post('/auth/login', json = data).status_code == 201
+
+        response = self.client.post('/auth/login', json = data)
+
+        assert response.status_code == 429
+
+        # a token comes back every 30 seconds at 2 a minute
+        assert 1 <= int(response.headers['Retry-After']) <= 30
+
+        # another client has its own bucket
+        assert self.client.post('/auth/login', json = data, environ_base = {'REMOTE_ADDR': '10.0.0.2'}).status_code == 201
+
+        # X-Forwarded-For is ignored when no proxy is trusted to set it
+        assert self.client.post('/auth/login', json = data, headers = {'X-Forwarded-For': '10.0.0.3'}).status_code == 429
+
+    def test_login_limited_per_forwarded_ip(self):
+        proxied = create_app(config=type('ProxiedConfig', (self.config,), {'PROXY_FIX_X_FOR': 1}))
+
+        data = {"email": "testuser@gmail.com", "password": "password"}
+
+        with proxied.app_context():
+            db.create_all()
+
+            User(username = "testuser", email = "testuser@gmail.com", password_hash = generate_password_hash("password")).save()
+
+            client = proxied.test_client()
+
+            # every request comes from the proxy, the clients behind it have a bucket each
+            for address in ('10.0.0.2', '10.0.0.2', '10.0.0.3'):
+                assert client.post('/auth/login', json = data, headers = {'X-Forwarded-For': address}).status_code == 201
+
+            assert client.post('/auth/login', json = data, headers = {'X-Forwarded-For': '10.0.0.2'}).status_code == 429
+
+    def test_orders_limited_per_identity(self):
+        first = {"Authorization": f"Bearer {create_access_token(identity='first')}"}
+        second = {"Authorization": f"Bearer {create_access_token(identity='second')}"}
+
+        assert self.client.get('/orders/orders', headers = first).status_code == 200
+
+        # the '/orders' entry covers every route of the namespace
+        assert self.client.get('/orders/stats/funnel', headers = first).status_code == 200
+
+        assert self.client.get('/orders/orders', headers = first).status_code == 429
+
+        assert self.client.get('/orders/orders', headers = second).status_code == 200
+
+        # requests without a token have no identity bucket, the route refuses them itself
+        assert self.client.get('/orders/orders').status_code == 401
+
+    def test_admission_sheds_load(self):
+        admission = self.app.extensions['admission']
+
+        admission.in_flight = admission.max_in_flight
+
+        response = self.client.get('/orders/orders')
+
+        assert response.status_code == 503 and response.headers['Retry-After'] == '1'
+
+        # the metrics stay reachable
+        assert self.client.get('/metrics').status_code == 200
+
+        admission.in_flight = 0
+
+        self.client.get('/orders/orders')
+
+        # released once the request is done
+        assert admission.in_flight == 0
+
+
+class TokenBucketTestCase(unittest.TestCase):
+
+    def test_bucket_refills_over_time(self):
+        now = [0.0]
+        backend = InMemoryRateLimitBackend(timer = lambda: now[0])
+
+        rate, burst = parse_limit('60/minute;burst=2')
+
+        assert (rate, burst) == (1, 2)
+
+        assert backend.acquire([('client', rate, burst)]) == 0
+        assert backend.acquire([('client', rate, burst)]) == 0
+        assert backend.acquire([('client', rate, burst)]) == 1
+
+        now[0] = 0.5
+
+        assert backend.acquire([('client', rate, burst)]) == 0.5
+
+        now[0] = 1.0
+
+        assert backend.acquire([('client', rate, burst)]) == 0
+
+    def test_refused_request_keeps_its_tokens(self):
+        backend = InMemoryRateLimitBackend(timer = lambda: 0.0)
+
+        rate, burst = parse_limit('60/minute;burst=1')
+
+        assert backend.acquire([('ip', rate, burst)]) == 0
+
+        # the empty ip bucket refuses the request, the identity bucket keeps its token
+        assert backend.acquire([('ip', rate, burst), ('identity', rate, burst)]) == 1
+
+        assert backend.acquire([('identity', rate, burst)]) == 0
+
+    def test_pool_wait_sheds_load(self):
+        pool = TimedQueuePool(lambda: sqlite3.connect(':memory:', check_same_thread = False), pool_size = 1, max_overflow = 0, timeout = 5)
+        admission = AdmissionController(max_pool_wait = 0.1)
+
+        held = pool.connect()
+
+        waiter = threading.Thread(target = lambda: pool.connect().close())
+        waiter.start()
+
+        time.sleep(0.2)
+
+        assert pool.oldest_wait() >= 0.2
+
+        assert not admission.admit([pool])
+
+        held.close()
+        waiter.join(5)
+
+        assert pool.oldest_wait() == 0
+
+        assert admission.admit([pool])
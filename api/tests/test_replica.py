@@ -0,0 +1,160 @@
+import os
+import shutil
+import tempfile
+import unittest
+from .. import create_app
+from sqlalchemy.exc import DatabaseError
+from ..config.config import config_dict
+from ..utils import db
+from ..models.orders import Order
+from ..models.users import User
+from flask_jwt_extended import create_access_token
+
+
+# a second SQLite file stands in for the replica, it's "replicated" by copying the primary's file over it
+class ReplicaTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.primary = os.path.join(self.directory, 'primary.sqlite3')
+        self.replica = os.path.join(self.directory, 'replica.sqlite3')
+
+        class ReplicaTestConfig(config_dict['test']):
+            SQLALCHEMY_ECHO = False
+            SQLALCHEMY_DATABASE_URI = 'sqlite:///' + self.primary
+            REPLICA_DATABASE_URL = 'sqlite:///' + self.replica
+
+        self.config = ReplicaTestConfig
+        self.app = create_app(config=ReplicaTestConfig)
+
+        self.appctx = self.app.app_context()
+
+        self.appctx.push()
+
+        self.client = self.app.test_client()
+
+        db.create_all()
+
+        user = User(username = "testuser", email = "testuser@gmail.com", password_hash = "hash")
+
+        user.save()
+
+        self.user_id = user.id
+
+        Order(size = 'SMALL', flavour = "mix", quantity = 1, customer = self.user_id).save()
+
+        self.replicate()
+
+        self.headers = {"Authorization": f"Bearer {create_access_token(identity='testuser', additional_claims={'user_id': self.user_id})}"}
+        self.other_headers = {"Authorization": f"Bearer {create_access_token(identity='someone')}"}
+
+    def tearDown(self):
+        db.session.remove()
+
+        for engine in db.engines.values():
+            engine.dispose()
+
+        self.appctx.pop()
+
+        shutil.rmtree(self.directory)
+
+    def replicate(self):
+        db.session.remove()
+
+        for engine in db.engines.values():
+            engine.dispose()
+
+        shutil.copyfile(self.primary, self.replica)
+
+    def test_reads_go_to_replica(self):
+        # written to the primary only
+        Order(size = 'LARGE', flavour = "pork", quantity = 2, customer = self.user_id).save()
+
+        assert [order['id'] for order in self.client.get('/orders/orders', headers=self.other_headers).json] == [1]
+
+        assert self.client.get('/orders/order/2', headers=self.other_headers).status_code == 404
+
+        assert [order['id'] for order in self.client.get(f'/orders/user/{self.user_id}/orders', headers=self.other_headers).json] == [1]
+
+        # the stale entries are only cached for the replica's lag
+        assert self.app.extensions['order_cache'].backend._data[('user_orders', self.user_id)][1] <= \
+            self.app.extensions['order_cache'].backend.timer() + self.app.config['REPLICA_STICKY_SECONDS']
+
+        self.replicate()
+
+        assert self.client.get(f'/orders/user/{self.user_id}/order/2', headers=self.other_headers).status_code == 200
+
+    def test_writer_reads_own_writes(self):
+        response = self.client.post('/orders/orders', json={"size": "LARGE", "quantity": 2, "flavour": "pork"}, headers=self.headers)
+
+        assert response.status_code == 201
+
+        order_id = response.json['id']
+
+        # the writer reads from the primary, everyone else from the replica that doesn't have the order yet
+        assert self.client.get(f'/orders/order/{order_id}', headers=self.headers).status_code == 200
+
+        self.app.extensions['order_cache'].backend.clear()
+
+        assert self.client.get(f'/orders/order/{order_id}', headers=self.other_headers).status_code == 404
+
+    def test_last_write_travels_with_the_client(self):
+        response = self.client.post('/orders/orders', json={"size": "LARGE", "quantity": 2, "flavour": "pork"}, headers=self.headers)
+
+        order_id = response.json['id']
+        token = response.headers['X-Last-Write']
+
+        # another worker process, with none of this one's state, gets the writer's next read
+        other = create_app(config=self.config)
+
+        with other.app_context():
+            client = other.test_client()
+
+            assert client.get(f'/orders/order/{order_id}', headers=self.headers).status_code == 404
+
+            assert client.get(f'/orders/order/{order_id}', headers={**self.headers, 'X-Last-Write': token}).status_code == 200
+
+            # a token is only good for the user it was handed to and can't be made up
+            other.extensions['order_cache'].backend.clear()
+
+            assert client.get(f'/orders/order/{order_id}', headers={**self.other_headers, 'X-Last-Write': token}).status_code == 404
+
+            forged = token.rsplit('.', 1)[0] + '.forged'
+
+            assert client.get(f'/orders/order/{order_id}', headers={**self.headers, 'X-Last-Write': forged}).status_code == 404
+
+            db.session.remove()
+
+            for engine in db.engines.values():
+                engine.dispose()
+
+    def test_failing_replica_falls_back_to_primary(self):
+        Order(size = 'LARGE', flavour = "pork", quantity = 2, customer = self.user_id).save()
+
+        self.replicate()
+
+        # the replica's file can't be opened any more
+        os.remove(self.replica)
+        os.mkdir(self.replica)
+
+        router = self.app.extensions['replica_router']
+
+        response = self.client.get('/orders/orders', headers=self.other_headers)
+
+        assert response.status_code == 200 and [order['id'] for order in response.json] == [1, 2]
+
+        assert not router.healthy
+
+        # the replica is left alone until the retry interval is over
+        assert self.client.get('/orders/order/2', headers=self.other_headers).status_code == 200
+
+    def test_replica_query_errors_are_not_retried(self):
+        # the replica answers, with an error that running the query again on the primary wouldn't fix
+        with open(self.replica, 'wb') as file:
+            file.write(b'not a database')
+
+        router = self.app.extensions['replica_router']
+
+        with self.assertRaises(DatabaseError):
+            self.client.get('/orders/orders', headers=self.other_headers)
+
+        assert router.healthy
@@ -0,0 +1,107 @@
+import http.client
+import os
+import re
+import signal
+import subprocess
+import sys
+import threading
+import time
+import unittest
+from .. import create_app
+from ..config.config import config_dict
+from ..utils.server import PooledWSGIServer, per_process_state
+
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+
+class ServerTestCase(unittest.TestCase):
+
+    # shutting the server down waits for the request it is serving instead of cutting it off
+    def test_shutdown_drains_in_flight_requests(self):
+        started = threading.Event()
+
+        def slow_app(environ, start_response):
+            started.set()
+            time.sleep(0.5)
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return [b'done']
+
+        server = PooledWSGIServer('127.0.0.1', 0, slow_app, threads=2)
+        serving = threading.Thread(target=server.serve_forever)
+        serving.start()
+
+        responses = []
+
+        def request():
+            connection = http.client.HTTPConnection('127.0.0.1', server.port)
+            connection.request('GET', '/')
+            response = connection.getresponse()
+            responses.append((response.status, response.read()))
+            connection.close()
+
+        client = threading.Thread(target=request)
+        client.start()
+
+        assert started.wait(5)
+
+        server.shutdown()
+        serving.join(5)
+        client.join(5)
+
+        assert not serving.is_alive()
+        assert responses == [(200, b'done')]
+
+    # only the backends that aren't shared by the worker processes are reported
+    def test_per_process_state(self):
+        class RateLimitedConfig(config_dict['test']):
+            RATE_LIMITING = True
+
+        app = create_app(config=RateLimitedConfig)
+
+        assert [state.split()[0] for state in per_process_state(app)] == ['ORDER_CACHE_BACKEND', 'EVENT_BROKER', 'RATE_LIMIT_BACKEND']
+
+        app.extensions['order_cache'].backend.shared = True
+        app.extensions['event_broker'].shared = True
+
+        assert [state.split()[0] for state in per_process_state(app)] == ['RATE_LIMIT_BACKEND']
+
+    # serve.py forks its workers, answers requests and exits cleanly on SIGTERM
+    def test_serve_forks_workers_and_stops_on_sigterm(self):
+        env = dict(os.environ, FLASK_CONFIG='test', JWT_SECRET_KEY='secret')
+        process = subprocess.Popen(
+            [sys.executable, 'serve.py', '--host', '127.0.0.1', '--port', '0', '--workers', '2', '--threads', '2'],
+            cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True
+        )
+
+        try:
+            port = None
+
+            for line in process.stderr:
+                match = re.search(r'Listening on http://127\.0\.0\.1:(\d+)', line)
+
+                if match:
+                    port = int(match.group(1))
+                    break
+
+            assert port is not None
+
+            for _ in range(4):
+                connection = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+                connection.request('GET', '/metrics')
+                assert connection.getresponse().status == 200
+                connection.close()
+
+            process.send_signal(signal.SIGTERM)
+            output = process.stderr.read()
+
+            assert process.wait(timeout=30) == 0
+            assert output.count('Worker') == 2 and output.count('stopped') == 2
+
+            # the test settings keep the order cache and the events in each process
+            assert output.count('Per-process state split across 2 worker processes') == 2
+        finally:
+            if process.poll() is None:
+                process.kill()
+                process.wait()
+
+            process.stderr.close()
@@ -5,38 +5,18 @@ from .. import create_app
 from ..config.config import config_dict
 from ..utils import db 
 from werkzeug.security import generate_password_hash
+from flask_jwt_extended import decode_token
 from ..models.users import User
+from ..auth.hashing import WerkzeugPasswordHasher
+from ..auth.tokens import RevocationList, decode_is_cacheable
+from ..models.tokens import TokenRevocation
+from unittest.mock import patch
+from .helpers import TransactionalTestCase
+import time
+from datetime import datetime, timedelta
 
 
-class UserTestCase(unittest.TestCase):
-    # 
-    def setUp (self):
-        # telling the config we're using the testing dict 
-        self.app = create_app(config=config_dict['test'])
-
-        # app context help run the db in shell, similar to creating a shell context
-        self.appctx = self.app.app_context()
-
-        # push =create/add, pop = delete
-        self.appctx.push()
-
-        # client is coming from our app
-        self.client = self.app.test_client()
-
-        db.create_all()
-    
-    # tear down function is what we want to achieve
-    # more like resettnig the app
-    # teardown needs to come after the set up else, the tables would still be available
-    def tearDown(self):
-        # drops all tables if there are existing ones
-        db.drop_all()
-
-        self.appctx.pop()
-
-        self.app = None
-
-        self.client = None
+class UserTestCase(TransactionalTestCase):
 
     def test_user_registeration(self):
         # data below replaces the request data json in the register route to test
@@ -67,6 +47,162 @@ class UserTestCase(unittest.TestCase):
 
         assert response.status_code == 200
 
-    
+    def test_login_token_carries_user_id(self):
+        user = User(
+            username = "testuser",
+            email = "testuser@gmail.com",
+            password_hash = generate_password_hash("password")
+        )
+
+        user.save()
+
+        data = {
+            "email": "testuser@gmail.com",
+            "password": "password"
+        }
+
+        response = self.client.post('/auth/login', json = data)
+
+        assert response.status_code == 201
+
+        # both tokens carry the user id so order endpoints can skip the users query
+        assert decode_token(response.json['access_token'])['user_id'] == user.id
+
+        refresh_token = response.json['refresh_token']
+
+        response = self.client.post('/auth/refresh', headers = {"Authorization": f"Bearer {refresh_token}"})
+
+        assert decode_token(response.json['access_token'])['user_id'] == user.id
+
+    def test_login_rehashes_outdated_password(self):
+        # hashed with a lower cost than the one configured
+        user = User(
+            username = "testuser",
+            email = "testuser@gmail.com",
+            password_hash = generate_password_hash("password", method = "pbkdf2:sha256:500")
+        )
+
+        user.save()
+
+        data = {
+            "email": "testuser@gmail.com",
+            "password": "password"
+        }
+
+        response = self.client.post('/auth/login', json = data)
+
+        assert response.status_code == 201
+
+        assert user.password_hash.startswith(self.app.config['PASSWORD_HASH_METHOD'] + '$')
+
+        # the new hash still checks out
+        response = self.client.post('/auth/login', json = data)
+
+        assert response.status_code == 201
+
+    def test_password_hasher_process_pool(self):
+        hasher = WerkzeugPasswordHasher(method = "pbkdf2:sha256:1000", workers = 1)
+
+        try:
+            password_hash = hasher.hash("password")
+
+            assert hasher.verify(password_hash, "password")
+
+            assert not hasher.verify(password_hash, "wrong")
+
+            assert not hasher.needs_rehash(password_hash)
+
+            # not forked from this process and its threads
+            assert hasher._get_pool()._mp_context.get_start_method() != 'fork'
+        finally:
+            hasher.shutdown()
+
+    def test_logout_revokes_token(self):
+        user = User(username = "testuser", email = "testuser@gmail.com", password_hash = generate_password_hash("password"))
+
+        user.save()
+
+        response = self.client.post('/auth/login', json = {"email": "testuser@gmail.com", "password": "password"})
+
+        headers = {"Authorization": f"Bearer {response.json['access_token']}"}
+
+        assert self.client.get('/orders/orders', headers = headers).status_code == 200
+
+        # the second request is answered from the verified token cache, the signature is not checked again
+        with patch('flask_jwt_extended.tokens.jwt.decode') as decode:
+            assert self.client.get('/orders/orders', headers = headers).status_code == 200
+
+        decode.assert_not_called()
+
+        response = self.client.post('/auth/logout', headers = headers)
+
+        assert response.status_code == 200
+
+        # a cached token is still checked against the revocations
+        assert self.client.get('/orders/orders', headers = headers).status_code == 401
+
+        # another process only knows about the revocation from the token_revocations table
+        revocations = RevocationList(sync_interval = 0)
+
+        revocations.sync()
+
+        assert revocations.is_revoked(decode_token(headers['Authorization'][7:], allow_expired = True))
+
+        # expired revocations are deleted and SQLite gives their ids out again, the next revocation is still seen
+        db.session.execute(db.delete(TokenRevocation))
+
+        db.session.add(TokenRevocation(jti = 'reused-id', expires_at = datetime.utcnow() + timedelta(minutes = 5)))
+
+        db.session.commit()
+
+        revocations.sync()
+
+        assert revocations.is_revoked({'jti': 'reused-id'})
+
+    # the cache overrides a method of flask-jwt-extended that isn't public, it's turned off if the method changes
+    def test_token_cache_needs_a_known_decode(self):
+        assert decode_is_cacheable() and self.app.extensions['token_cache'].maxsize > 0
+
+        with patch('api.auth.tokens.decode_is_cacheable', return_value = False):
+            app = create_app(config = config_dict['test'])
+
+        assert app.extensions['token_cache'].maxsize == 0
+
+    def test_deactivation_revokes_tokens(self):
+        user = User(username = "testuser", email = "testuser@gmail.com", password_hash = generate_password_hash("password"))
+
+        user.save()
+
+        data = {"email": "testuser@gmail.com", "password": "password"}
+
+        revocations = self.app.extensions['token_revocations']
+
+        # iat has a one second resolution, tokens issued in the second of the deactivation are refused too: the
+        # first tokens and the deactivation are stamped two seconds back so the tokens issued afterwards aren't
+        with patch.object(revocations, 'clock', lambda: time.time() - 2):
+            tokens = self.client.post('/auth/login', json = data).json
+
+            headers = {"Authorization": f"Bearer {tokens['access_token']}"}
+
+            assert self.client.get('/orders/orders', headers = headers).status_code == 200
+
+            user.is_active = False
+
+            db.session.commit()
+
+        # both the access and the refresh token stop working straight away, not when they expire
+        assert self.client.get('/orders/orders', headers = headers).status_code == 401
+
+        assert self.client.post('/auth/refresh', headers = {"Authorization": f"Bearer {tokens['refresh_token']}"}).status_code == 401
+
+        assert self.client.post('/auth/login', json = data).json is None
+
+        # once reactivated the user logs in again and gets tokens that work
+        user.is_active = True
+
+        db.session.commit()
+
+        headers = {"Authorization": f"Bearer {self.client.post('/auth/login', json = data).json['access_token']}"}
+
+        assert self.client.get('/orders/orders', headers = headers).status_code == 200
 
-    
\ No newline at end of file
@@ -1,3 +1,5 @@
 from flask_sqlalchemy import SQLAlchemy
+from .routing import RoutingSession
 
-db = SQLAlchemy()
\ No newline at end of file
+# reads of the views marked with replica_reads can go to a read replica, see api/utils/replica.py
+db = SQLAlchemy(session_options={'class_': RoutingSession})
\ No newline at end of file
@@ -0,0 +1,129 @@
+import queue
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from threading import Lock
+
+# what to do when a subscriber's queue is full
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+DISCONNECT = 'disconnect'
+
+
+# one consumer of a channel, events wait in a bounded queue so a slow client can't make the publisher block or grow memory
+class Subscription:
+
+    def __init__(self, broker, channel, maxsize=100, policy=DROP_OLDEST):
+        self.broker = broker
+        self.channel = channel
+        self.policy = policy
+        self.queue = queue.Queue(maxsize)
+        self.dropped = 0
+        self.closed = False
+
+    def deliver(self, event):
+        try:
+            self.queue.put_nowait(event)
+            return
+        except queue.Full:
+            self.dropped += 1
+
+        if self.policy == DROP_OLDEST:
+            try:
+                self.queue.get_nowait()
+                self.queue.put_nowait(event)
+            except (queue.Empty, queue.Full):
+                pass
+        elif self.policy == DISCONNECT:
+            self.close()
+
+    # next event, or None after timeout seconds with nothing to deliver
+    def get(self, timeout=None):
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.broker.unsubscribe(self)
+
+            # wakes a stream waiting in get() so it ends now rather than at its next keepalive
+            try:
+                self.queue.put_nowait(None)
+            except queue.Full:
+                pass
+
+
+# what an event broker has to provide, a shared broker (redis pub/sub, NATS...) plugs in by implementing these
+class EventBroker(ABC):
+    # True when an event published in one worker process reaches the subscriptions of all of them
+    shared = False
+
+    @abstractmethod
+    def publish(self, channel, event):
+        raise NotImplementedError
+
+    @abstractmethod
+    def subscribe(self, channel):
+        raise NotImplementedError
+
+    @abstractmethod
+    def unsubscribe(self, subscription):
+        raise NotImplementedError
+
+    # ends every subscription, e.g. when a worker shuts down
+    @abstractmethod
+    def close(self):
+        raise NotImplementedError
+
+
+# fans events out to the subscriptions of this process
+class InProcessBroker(EventBroker):
+
+    def __init__(self, queue_size=100, policy=DROP_OLDEST):
+        self.queue_size = queue_size
+        self.policy = policy
+        self._channels = defaultdict(set)
+        self._lock = Lock()
+
+    def publish(self, channel, event):
+        with self._lock:
+            subscriptions = list(self._channels.get(channel, ()))
+
+        for subscription in subscriptions:
+            subscription.deliver(event)
+
+        return len(subscriptions)
+
+    def subscribe(self, channel):
+        subscription = Subscription(self, channel, self.queue_size, self.policy)
+
+        with self._lock:
+            self._channels[channel].add(subscription)
+
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._channels.get(subscription.channel)
+
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+
+                if not subscriptions:
+                    del self._channels[subscription.channel]
+
+    def close(self):
+        with self._lock:
+            subscriptions = [subscription for channel in self._channels.values() for subscription in channel]
+
+        for subscription in subscriptions:
+            subscription.close()
+
+    def subscriber_count(self, channel=None):
+        with self._lock:
+            if channel is not None:
+                return len(self._channels.get(channel, ()))
+
+            return sum(len(subscriptions) for subscriptions in self._channels.values())
@@ -0,0 +1,73 @@
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from threading import Lock
+
+
+# what a cache backend has to provide, a shared cache (redis, memcached...) plugs in by implementing these four methods
+class CacheBackend(ABC):
+    # True when every worker process sees the same entries, see utils.server.per_process_state
+    shared = False
+
+    @abstractmethod
+    def get(self, key, default=None):
+        raise NotImplementedError
+
+    @abstractmethod
+    def set(self, key, value, ttl=None):
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete(self, key):
+        raise NotImplementedError
+
+    @abstractmethod
+    def clear(self):
+        raise NotImplementedError
+
+
+# bounded in-process cache, least recently used keys are dropped first and every entry expires after ttl seconds
+class TTLCache(CacheBackend):
+
+    def __init__(self, maxsize=1024, ttl=60, timer=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+        self._data = OrderedDict()
+        self._lock = Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    # returns default when the key is missing or has expired
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+
+            value, expires_at = item
+            if expires_at <= self.timer():
+                del self._data[key]
+                return default
+
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = self.timer() + (self.ttl if ttl is None else ttl)
+
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
@@ -0,0 +1,72 @@
+from sqlalchemy import literal
+from sqlalchemy.sql import operators
+from sqlalchemy.types import SmallInteger, TypeDecorator
+
+
+# the member of enum a value stands for: a member, its name or its value, names and values in any case
+def enum_member(enum, value):
+    if isinstance(value, enum):
+        return value
+
+    if isinstance(value, str):
+        for member in enum:
+            if value.upper() == member.name or value.lower() == str(member.value).lower():
+                return member
+
+    raise ValueError(f"'{value}' is not one of {[member.name for member in enum]}")
+
+
+# an enum stored as a small integer code from a fixed lookup table instead of its name, rows and indexes carry
+# two bytes instead of a string and filters compare integers. Members, names and values can be written, rows
+# are read back as members so nothing above the database sees the codes. With none_code, None is stored as
+# that code instead of NULL, for columns that take part in a unique constraint: NULLs are never equal there
+class EnumCode(TypeDecorator):
+    impl = SmallInteger
+    cache_ok = True
+
+    def __init__(self, enum, codes, none_code=None):
+        super().__init__()
+        self.enum = enum
+        # a tuple so it can be part of the statement cache key
+        self.codes = tuple(codes.items())
+        self.none_code = none_code
+        self._code_of = dict(codes)
+        self._member_of = {code: member for member, code in codes.items()}
+
+    # comparisons with a member put its code in the SQL instead of a parameter: SQLite only drops the test of
+    # a partial index's WHERE (order_status = 3) when the query states the same literal, with a parameter it
+    # reads every row back from the table to test it again
+    class comparator_factory(TypeDecorator.Comparator):
+
+        def operate(self, op, *other, **kwargs):
+            if op in (operators.eq, operators.ne):
+                other = tuple(self.inline(value) for value in other)
+            elif op in (operators.in_op, operators.not_in_op) and isinstance(other[0], (list, tuple)):
+                other = ([self.inline(value) for value in other[0]],) + other[1:]
+
+            return super().operate(op, *other, **kwargs)
+
+        def inline(self, value):
+            if isinstance(value, (self.type.enum, str)) or (value is None and self.type.none_code is not None):
+                return literal(value, self.type, literal_execute=True)
+
+            return value
+
+    @property
+    def python_type(self):
+        return self.enum
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return self.none_code
+
+        return self._code_of[enum_member(self.enum, value)]
+
+    def process_literal_param(self, value, dialect):
+        return self.process_bind_param(value, dialect)
+
+    def process_result_value(self, value, dialect):
+        if value is None or value == self.none_code:
+            return None
+
+        return self._member_of[value]
@@ -0,0 +1,51 @@
+from flask import current_app, json
+from flask_restx import Api
+from flask_restx.api import SwaggerView
+
+
+# serves the encoded spec kept by CachedSpecApi
+class CachedSwaggerView(SwaggerView):
+
+    def get(self):
+        return self.api.spec_response()
+
+
+# Api whose swagger.json is built on the first request for it and encoded once, instead of being
+# serialized again for every request to the docs
+class CachedSpecApi(Api):
+
+    def __init__(self, *args, add_specs=True, **kwargs):
+        self._spec_json = None
+        # Api.__init__ doesn't hand add_specs on to init_app, which would register the spec anyway
+        self._specs_enabled = add_specs
+
+        super().__init__(*args, **kwargs)
+
+    def init_app(self, app, **kwargs):
+        kwargs.setdefault('add_specs', self._specs_enabled)
+
+        super().init_app(app, **kwargs)
+
+    def spec_response(self):
+        if self._spec_json is None:
+            schema = self.__schema__
+
+            # a spec that failed to build is answered with its error, like flask-restx does
+            if 'error' in schema:
+                return schema, 500
+
+            self._spec_json = json.dumps(schema)
+
+        return current_app.response_class(self._spec_json, mimetype='application/json')
+
+    def _register_specs(self, app_or_blueprint):
+        if self._add_specs:
+            self._register_view(
+                app_or_blueprint,
+                CachedSwaggerView,
+                self.default_namespace,
+                '/' + self.default_swagger_filename,
+                endpoint='specs',
+                resource_class_args=(self,),
+            )
+            self.endpoints.add('specs')
@@ -0,0 +1,226 @@
+import logging
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from threading import Lock
+from flask import Response, g, has_request_context, request
+from flask_jwt_extended.config import config as jwt_config
+from sqlalchemy import event
+from . import db
+
+slow_query_logger = logging.getLogger('api.slow_query')
+
+# upper bounds, in seconds, of the request latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+# time spent per phase of the current request, in seconds, plus the number of SQL statements
+def request_timings():
+    if not has_request_context():
+        return None
+
+    if 'timings' not in g:
+        reset_request_timings()
+
+    return g.timings
+
+
+# g belongs to the app context, which requests share when one was pushed before them (tests, CLI commands),
+# so every request starts its own count
+def reset_request_timings():
+    g.timings = defaultdict(float)
+    g.query_count = 0
+
+
+# adds the time spent in the block to a phase of the current request (marshal, encode...)
+@contextmanager
+def phase(name):
+    start = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        timings = request_timings()
+
+        if timings is not None:
+            timings[name] += time.perf_counter() - start
+
+
+# cumulative latency histograms and SQL totals per endpoint, rendered in the Prometheus text format
+class Metrics:
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._lock = Lock()
+        self._histograms = {}
+        self._queries = defaultdict(int)
+        self._query_seconds = defaultdict(float)
+
+    def observe(self, endpoint, method, status, seconds, queries, query_seconds):
+        key = (endpoint, method, status)
+
+        with self._lock:
+            histogram = self._histograms.get(key)
+
+            if histogram is None:
+                # one counter per bucket plus +Inf, the running sum and the count
+                histogram = self._histograms[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+
+            histogram[0][bisect_left(self.buckets, seconds)] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+            self._queries[(endpoint, method)] += queries
+            self._query_seconds[(endpoint, method)] += query_seconds
+
+    def render(self):
+        lines = [
+            '# HELP http_request_duration_seconds Request latency by endpoint',
+            '# TYPE http_request_duration_seconds histogram',
+        ]
+
+        with self._lock:
+            for (endpoint, method, status), (counts, total, count) in sorted(self._histograms.items()):
+                labels = f'endpoint="{endpoint}",method="{method}",status="{status}"'
+
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += bucket_count
+                    lines.append(f'http_request_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+
+                lines.append(f'http_request_duration_seconds_sum{{{labels}}} {total}')
+                lines.append(f'http_request_duration_seconds_count{{{labels}}} {count}')
+
+            lines += [
+                '# HELP db_queries_total SQL statements executed by endpoint',
+                '# TYPE db_queries_total counter',
+            ]
+            lines += [
+                f'db_queries_total{{endpoint="{endpoint}",method="{method}"}} {count}'
+                for (endpoint, method), count in sorted(self._queries.items())
+            ]
+
+            lines += [
+                '# HELP db_query_seconds_total Time spent in SQL by endpoint',
+                '# TYPE db_query_seconds_total counter',
+            ]
+            lines += [
+                f'db_query_seconds_total{{endpoint="{endpoint}",method="{method}"}} {seconds}'
+                for (endpoint, method), seconds in sorted(self._query_seconds.items())
+            ]
+
+        return '\n'.join(lines) + '\n'
+
+
+def init_instrumentation(app, api, jwt):
+    if not app.config['INSTRUMENTATION']:
+        return
+
+    metrics = app.extensions['metrics'] = Metrics()
+    slow_query_threshold = app.config['SLOW_QUERY_THRESHOLD']
+
+    with app.app_context():
+        engines = list(db.engines.values())
+
+    # SQL time and count, and the slow query log, from the cursor events of every engine
+    for engine in engines:
+
+        @event.listens_for(engine, 'before_cursor_execute')
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+        @event.listens_for(engine, 'after_cursor_execute')
+        def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            elapsed = time.perf_counter() - conn.info['query_start'].pop()
+
+            timings = request_timings()
+            if timings is not None:
+                timings['db'] += elapsed
+                g.query_count += 1
+
+            if slow_query_threshold is not None and elapsed >= slow_query_threshold:
+                log_slow_query(conn, statement, parameters, elapsed, executemany)
+
+    # JWT verification runs from the decode key lookup to the final claims verification callback. Both loaders
+    # do what flask-jwt-extended does without them, return the configured key and accept the claims, nothing
+    # else in the app sets them
+    @jwt.decode_key_loader
+    def timed_decode_key(jwt_header, jwt_data):
+        if has_request_context():
+            g.jwt_start = time.perf_counter()
+
+        return jwt_config.decode_key
+
+    @jwt.token_verification_loader
+    def timed_token_verification(jwt_header, jwt_data):
+        if has_request_context() and 'jwt_start' in g:
+            request_timings()['jwt'] += time.perf_counter() - g.pop('jwt_start')
+
+        return True
+
+    # JSON encoding of flask-restx responses
+    for mediatype, representation in list(api.representations.items()):
+        api.representations[mediatype] = timed_representation(representation)
+
+    @app.before_request
+    def start_request_timer():
+        g.request_start = time.perf_counter()
+        g.pop('jwt_start', None)
+        reset_request_timings()
+
+    @app.after_request
+    def record_request_timings(response):
+        if 'request_start' not in g:
+            return response
+
+        total = time.perf_counter() - g.request_start
+        timings = request_timings()
+
+        metrics.observe(
+            request.endpoint or 'unknown', request.method, response.status_code,
+            total, g.query_count, timings.get('db', 0.0)
+        )
+
+        if app.config['SERVER_TIMING']:
+            entries = [f'{name};dur={seconds * 1000:.2f}' for name, seconds in timings.items() if name != 'db']
+            entries.append(f'db;dur={timings.get("db", 0.0) * 1000:.2f};desc="{g.query_count} queries"')
+            entries.append(f'total;dur={total * 1000:.2f}')
+
+            response.headers['Server-Timing'] = ', '.join(entries)
+
+        return response
+
+    @app.route(app.config['METRICS_PATH'])
+    def prometheus_metrics():
+        return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+def timed_representation(representation):
+    def output(data, code, headers=None):
+        with phase('encode'):
+            return representation(data, code, headers)
+
+    return output
+
+
+# logs a statement over SLOW_QUERY_THRESHOLD seconds together with its query plan
+def log_slow_query(conn, statement, parameters, elapsed, executemany):
+    plan = None
+
+    if not executemany and statement.lstrip().upper().startswith('SELECT'):
+        explain = 'EXPLAIN QUERY PLAN ' if conn.dialect.name == 'sqlite' else 'EXPLAIN '
+
+        # straight on the DBAPI connection so the EXPLAIN itself doesn't go through these events
+        try:
+            cursor = conn.connection.dbapi_connection.cursor()
+            cursor.execute(explain + statement, parameters)
+            plan = '\n'.join(' '.join(str(column) for column in row) for row in cursor.fetchall())
+            cursor.close()
+        except Exception as error:
+            plan = f'EXPLAIN failed: {error}'
+
+    slow_query_logger.warning(
+        'Slow query (%.1f ms): %s\nParameters: %s\nPlan:\n%s',
+        elapsed * 1000, statement, parameters, plan
+    )
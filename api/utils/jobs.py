@@ -0,0 +1,355 @@
+import atexit
+import logging
+import multiprocessing
+import random
+import threading
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+import click
+from flask import current_app, has_app_context, json
+from flask.cli import AppGroup
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from . import db
+from ..models.jobs import DeadJob, Job
+
+logger = logging.getLogger(__name__)
+
+# name -> (function, max attempts or None for JOB_MAX_ATTEMPTS)
+TASKS = {}
+
+# process pool workers are forked from a server process started clean for the purpose, not from the web process
+# whose other threads may hold locks (the logging module's, a connection pool's) at the moment of the fork
+PROCESS_START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+jobs_cli = AppGroup('jobs', help='Background jobs.')
+
+
+# registers fn(payload) as a task jobs can be enqueued for. A task that raises is retried with exponential
+# backoff, after max_attempts it goes to dead_jobs. Tasks may run more than once (a worker can die after the
+# work but before the job is marked done) so they should be safe to repeat
+def task(name, max_attempts=None):
+    def register(fn):
+        TASKS[name] = (fn, max_attempts)
+
+        return fn
+
+    return register
+
+
+def max_attempts(name):
+    return TASKS[name][1] or current_app.config['JOB_MAX_ATTEMPTS']
+
+
+# adds a job to the session's transaction, it's only seen by the workers once the transaction commits and is
+# gone with it on a rollback. payload is anything JSON can encode
+def enqueue(session, name, payload, delay=0):
+    if name not in TASKS:
+        raise KeyError(f'No task registered as {name!r}')
+
+    now = datetime.utcnow()
+
+    session.execute(db.insert(Job).values(
+        task=name, payload=json.dumps(payload), attempts=0, max_attempts=max_attempts(name),
+        run_at=now + timedelta(seconds=delay), created_at=now
+    ))
+
+    session.info['jobs_enqueued'] = True
+
+
+def run_task(name, payload):
+    function, _ = TASKS[name]
+
+    return function(json.loads(payload))
+
+
+# app of a process pool worker, created by the worker from the config of the app that started the pool
+_worker_app = None
+
+
+# the config handed to the process pool workers, which don't work the queue themselves
+def worker_config(app):
+    return dict(app.config, JOB_WORKERS=0)
+
+
+def init_worker_process(config):
+    global _worker_app
+
+    # imported here because the app package imports this module
+    from .. import create_app
+
+    _worker_app = create_app(SimpleNamespace(**config))
+
+
+# the task function is sent by reference, unpickling it imports the module that registers it in the worker
+def run_task_in_worker_process(function, payload):
+    with _worker_app.app_context():
+        return function(json.loads(payload))
+
+
+# pulls due jobs from the jobs table and runs them on a pool of worker threads or processes, tasks run in an app
+# context either way (each process creates its own app). Several processes can work the same table, a job is
+# claimed by one UPDATE so only one of them gets it
+class JobQueue:
+
+    def __init__(self, app, workers=0, pool='thread', poll_interval=1.0, lease=300, backoff_base=2.0, backoff_max=3600):
+        if pool not in ('thread', 'process'):
+            raise ValueError(f"JOB_POOL must be thread or process, not {pool!r}")
+
+        self.app = app
+        self.workers = workers
+        self.pool = pool
+        self.poll_interval = poll_interval
+        self.lease = lease
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._executor = None
+        self._dispatcher = None
+        self._slots = None
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def started(self):
+        return self._dispatcher is not None
+
+    # the pool and the thread handing it jobs are started on first use so they're created in the serving process
+    def start(self):
+        with self._lock:
+            if self._dispatcher is not None or self.workers <= 0:
+                return
+
+            if self.pool == 'thread':
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='job')
+            else:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context(PROCESS_START_METHOD),
+                    initializer=init_worker_process, initargs=(worker_config(self.app),)
+                )
+
+            self._slots = threading.BoundedSemaphore(self.workers)
+            self._stopping.clear()
+            self._dispatcher = threading.Thread(target=self._dispatch, name='job-dispatcher', daemon=True)
+            self._dispatcher.start()
+
+            atexit.register(self.stop)
+
+    # waits for the running jobs, the ones still queued stay in the table for the next start
+    def stop(self):
+        with self._lock:
+            dispatcher, self._dispatcher = self._dispatcher, None
+
+            if dispatcher is None:
+                return
+
+            self._stopping.set()
+            self._wake.set()
+
+        dispatcher.join()
+        self._executor.shutdown(wait=True)
+
+    # tells the dispatcher there's new work instead of letting it wait for its next poll
+    def wake(self):
+        self._wake.set()
+
+    def _dispatch(self):
+        while not self._stopping.is_set():
+            if not self._slots.acquire(timeout=self.poll_interval):
+                continue
+
+            self._wake.clear()
+
+            try:
+                job = self.claim()
+            except Exception:
+                logger.exception('Could not claim a job')
+                job = None
+
+            if job is None:
+                self._slots.release()
+                self._wake.wait(self.poll_interval)
+                continue
+
+            if self.pool == 'thread':
+                future = self._executor.submit(self._run_in_app, job.task, job.payload)
+            else:
+                future = self._executor.submit(run_task_in_worker_process, TASKS[job.task][0], job.payload)
+
+            future.add_done_callback(lambda future, job=job: self._done(job, future))
+
+    def _run_in_app(self, name, payload):
+        with self.app.app_context():
+            return run_task(name, payload)
+
+    def _done(self, job, future):
+        try:
+            error = future.exception()
+
+            with self.app.app_context():
+                self.finish(job, None if error is None else ''.join(traceback.format_exception(error)))
+        except Exception:
+            logger.exception('Could not record the outcome of job %s', job.id)
+        finally:
+            self._slots.release()
+
+    # takes the next due job, or None. Due jobs are looked for with a read first so an idle queue doesn't take
+    # the write lock at every poll
+    def claim(self):
+        with self.app.app_context():
+            now = datetime.utcnow()
+            due = db.or_(Job.locked_until.is_(None), Job.locked_until <= now)
+
+            next_id = db.select(Job.id).where(Job.run_at <= now, due).order_by(Job.run_at, Job.id).limit(1)
+
+            if db.session.execute(next_id).first() is None:
+                db.session.rollback()
+                return None
+
+            # the row is checked again in the UPDATE, another worker may have taken it in between
+            job = db.session.execute(
+                db.update(Job)
+                .where(Job.id == next_id.scalar_subquery(), due)
+                .values(attempts=Job.attempts + 1, locked_until=now + timedelta(seconds=self.lease))
+                .returning(Job.id, Job.task, Job.payload, Job.attempts, Job.max_attempts, Job.created_at, Job.locked_until)
+            ).first()
+
+            db.session.commit()
+
+            return job
+
+    # a job that ran is deleted, one that failed goes back in the queue after a backoff or, out of attempts,
+    # to dead_jobs. Only while the claim job came from still holds: a job that ran past its lease may have been
+    # claimed again by another worker, which then records the outcome instead. Needs an app context
+    def finish(self, job, error=None):
+        # the lease and attempt count set by claim() tell this claim from any later one
+        claimed = db.and_(Job.id == job.id, Job.locked_until == job.locked_until, Job.attempts == job.attempts)
+
+        if error is None or job.attempts >= job.max_attempts:
+            result = db.session.execute(db.delete(Job).where(claimed))
+        else:
+            result = db.session.execute(
+                db.update(Job).where(claimed)
+                .values(run_at=datetime.utcnow() + timedelta(seconds=self.backoff(job.attempts)), locked_until=None, last_error=error)
+            )
+
+        if result.rowcount == 0:
+            logger.warning('Job %s (%s) ran past its lease and was claimed again, its outcome is left to that claim', job.id, job.task)
+        elif error is not None and job.attempts >= job.max_attempts:
+            logger.error('Job %s (%s) failed %d times, moved to dead_jobs', job.id, job.task, job.attempts)
+
+            db.session.execute(db.insert(DeadJob).values(
+                task=job.task, payload=job.payload, attempts=job.attempts, error=error, created_at=job.created_at,
+                failed_at=datetime.utcnow()
+            ))
+        elif error is not None:
+            logger.warning('Job %s (%s) failed, attempt %d of %d', job.id, job.task, job.attempts, job.max_attempts)
+
+        db.session.commit()
+
+    # backoff_base, twice that, four times... capped at backoff_max, with jitter so jobs that failed together
+    # aren't all retried together
+    def backoff(self, attempts):
+        delay = min(self.backoff_max, self.backoff_base * 2 ** (attempts - 1))
+
+        return delay * random.uniform(0.5, 1)
+
+    # runs the due jobs one after the other on the calling thread until none is left, returns how many ran
+    def run_pending(self):
+        count = 0
+
+        while True:
+            job = self.claim()
+
+            if job is None:
+                return count
+
+            try:
+                self._run_in_app(job.task, job.payload)
+                error = None
+            except Exception as exception:
+                error = ''.join(traceback.format_exception(exception))
+
+            with self.app.app_context():
+                self.finish(job, error)
+
+            count += 1
+
+
+def init_job_queue(app):
+    config = app.config
+
+    queue = app.extensions['job_queue'] = JobQueue(
+        app,
+        workers=config['JOB_WORKERS'],
+        pool=config['JOB_POOL'],
+        poll_interval=config['JOB_POLL_INTERVAL'],
+        lease=config['JOB_LEASE'],
+        backoff_base=config['JOB_BACKOFF_BASE'],
+        backoff_max=config['JOB_BACKOFF_MAX']
+    )
+
+    # the web process works the queue too unless JOB_WORKERS is 0, started with its first request
+    @app.before_request
+    def start_job_queue():
+        if not queue.started:
+            queue.start()
+
+
+# the workers are told as soon as the jobs they can now see are committed
+@event.listens_for(Session, 'after_commit')
+def wake_job_queue(session):
+    if session.info.pop('jobs_enqueued', False) and has_app_context() and 'job_queue' in current_app.extensions:
+        current_app.extensions['job_queue'].wake()
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget_enqueued_jobs(session):
+    session.info.pop('jobs_enqueued', None)
+
+
+# flask jobs work --workers 4, a process that only works the queue
+@jobs_cli.command('work')
+@click.option('--workers', type=int, default=None, help='Jobs run at the same time, JOB_WORKERS by default.')
+@click.option('--once', is_flag=True, help='Run the jobs due now and exit.')
+def work_command(workers, once):
+    """Run background jobs."""
+    queue = current_app.extensions['job_queue']
+
+    if once:
+        click.echo(f'Ran {queue.run_pending()} jobs')
+        return
+
+    queue.workers = workers or queue.workers or 1
+    queue.start()
+
+    click.echo(f'Working the job queue with {queue.workers} {queue.pool} workers, Ctrl-C to stop')
+
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        queue.stop()
+
+
+# flask jobs retry 12 13, or every dead job with --all
+@jobs_cli.command('retry')
+@click.argument('ids', type=int, nargs=-1)
+@click.option('--all', 'retry_all', is_flag=True, help='Retry every dead job.')
+def retry_command(ids, retry_all):
+    """Put dead jobs back in the queue."""
+    query = db.select(DeadJob)
+
+    if not retry_all:
+        query = query.where(DeadJob.id.in_(ids))
+
+    dead = db.session.scalars(query).all()
+
+    for job in dead:
+        db.session.add(Job(task=job.task, payload=job.payload, attempts=0, max_attempts=max_attempts(job.task), created_at=job.created_at))
+        db.session.delete(job)
+
+    db.session.commit()
+
+    click.echo(f'Requeued {len(dead)} jobs')
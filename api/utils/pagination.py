@@ -0,0 +1,86 @@
+import base64
+from datetime import datetime
+from . import db
+
+
+# cursors are opaque to clients, they carry the (date_created, id) of the last row returned
+def encode_cursor(date_created, id):
+    raw = f"{date_created.isoformat()}|{id}"
+
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+# raises ValueError when the cursor has been tampered with or is malformed
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+        date_created, id = raw.split('|')
+
+        return datetime.fromisoformat(date_created), int(id)
+    except (ValueError, UnicodeDecodeError) as error:
+        raise ValueError(f"Invalid cursor: {cursor}") from error
+
+
+# keyset pagination: only rows strictly after (date_created, id) so no OFFSET scan is needed
+def keyset_after(query, model, cursor):
+    date_created, id = decode_cursor(cursor)
+
+    return query.filter(
+        db.or_(
+            model.date_created > date_created,
+            db.and_(model.date_created == date_created, model.id > id)
+        )
+    )
+
+
+# fetches one page, returning the rows and the cursor of the next page (None on the last one)
+def keyset_page(query, model, limit, cursor=None):
+    if cursor:
+        query = keyset_after(query, model, cursor)
+
+    # one extra row tells us whether there is a next page without a COUNT query
+    rows = query.order_by(model.date_created, model.id).limit(limit + 1).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1].date_created, rows[-1].id)
+
+    return rows, next_cursor
+
+
+# one page over several tables paginated on the same (date_created, id) keys, sources are (query, model) pairs.
+# each source is asked for a page of its own and the pages are merged, so a source is never read past the page
+def keyset_merge_page(sources, limit, cursor=None):
+    rows = []
+
+    for query, model in sources:
+        if cursor:
+            query = keyset_after(query, model, cursor)
+
+        rows.extend(query.order_by(model.date_created, model.id).limit(limit + 1).all())
+
+    rows.sort(key=lambda row: (row.date_created, row.id))
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1].date_created, rows[-1].id)
+
+    return rows, next_cursor
+
+
+# generator walking the whole result set a batch at a time, each batch is its own short query
+def keyset_batches(query, model, batch_size, cursor=None, limit=None):
+    sent = 0
+
+    while limit is None or sent < limit:
+        size = batch_size if limit is None else min(batch_size, limit - sent)
+
+        rows, cursor = keyset_page(query, model, size, cursor)
+        if rows:
+            yield rows
+            sent += len(rows)
+
+        if cursor is None:
+            break
@@ -0,0 +1,272 @@
+import math
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from itertools import count
+from threading import Lock
+from flask import g, request
+from flask_jwt_extended import get_jwt_identity, verify_jwt_in_request
+from sqlalchemy.pool import QueuePool
+from werkzeug.utils import import_string
+from . import db
+
+PERIODS = {'second': 1, 'minute': 60, 'hour': 3600, 'day': 86400}
+
+
+# '10/minute' -> (10 / 60 tokens per second, bucket of 10), a burst can be given as '10/minute;burst=20'
+def parse_limit(limit):
+    spec, _, burst = limit.partition(';')
+    amount, _, period = spec.strip().partition('/')
+
+    if period.strip() not in PERIODS:
+        raise ValueError(f'Unknown rate limit period in {limit!r}, use one of {", ".join(PERIODS)}')
+
+    amount = int(amount)
+    burst = int(burst.strip()[len('burst='):]) if burst.strip().startswith('burst=') else amount
+
+    return amount / PERIODS[period.strip()], burst
+
+
+# what a rate limit store has to provide, a shared store (redis...) plugs in by implementing these two methods
+class RateLimitBackend(ABC):
+    # True when every worker process takes from the same buckets
+    shared = False
+
+    # takes a token from each of buckets, a list of (key, rate, burst), when every one of them has one and
+    # returns 0, or else takes none and returns the seconds until they all have one. A request refused by one
+    # limit doesn't use up the others
+    @abstractmethod
+    def acquire(self, buckets):
+        raise NotImplementedError
+
+    @abstractmethod
+    def clear(self):
+        raise NotImplementedError
+
+
+# token buckets of this process, at most maxsize of them, the least recently used are dropped first
+# (a dropped bucket comes back full, which only ever lets a client through)
+class InMemoryRateLimitBackend(RateLimitBackend):
+
+    def __init__(self, maxsize=100000, timer=time.monotonic):
+        self.maxsize = maxsize
+        self.timer = timer
+        # key -> [tokens, time they were counted]
+        self._buckets = OrderedDict()
+        self._lock = Lock()
+
+    def acquire(self, buckets):
+        now = self.timer()
+
+        with self._lock:
+            refilled = [self._refill(key, rate, burst, now) for key, rate, burst in buckets]
+
+            wait = max(
+                ((1 - bucket[0]) / rate for bucket, (_, rate, _) in zip(refilled, buckets) if bucket[0] < 1), default=0
+            )
+
+            if wait:
+                return wait
+
+            for bucket in refilled:
+                bucket[0] -= 1
+
+            return 0
+
+    # the bucket under key with the tokens it gained since it was last counted, needs the lock
+    def _refill(self, key, rate, burst, now):
+        bucket = self._buckets.get(key)
+
+        if bucket is None:
+            bucket = self._buckets[key] = [burst, now]
+
+            if len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+
+        return bucket
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+# RATE_LIMITS entries matching a request: 'POST /auth/login' is one route and method, '/orders' every route
+# under the path (a namespace) whatever the method
+class RateLimiter:
+
+    def __init__(self, backend, limits):
+        self.backend = backend
+        # (method or None, path, {'ip' or 'identity': (rate, burst)})
+        self.rules = []
+        # (method, url rule) -> rules applying to it
+        self._matches = {}
+        self._lock = Lock()
+
+        for key, scopes in limits.items():
+            method, _, path = key.rpartition(' ')
+            unknown = set(scopes) - {'ip', 'identity'}
+
+            if unknown:
+                raise ValueError(f'Unknown rate limit scope {", ".join(sorted(unknown))} for {key!r}, use ip or identity')
+
+            self.rules.append((method.upper() or None, path.rstrip('/') or '/', key,
+                               {scope: parse_limit(limit) for scope, limit in scopes.items()}))
+
+    def matching(self, method, rule):
+        matches = self._matches.get((method, rule))
+
+        if matches is None:
+            matches = [
+                (key, scopes) for rule_method, path, key, scopes in self.rules
+                if rule_method in (None, method) and (rule == path or rule.startswith(path.rstrip('/') + '/'))
+            ]
+
+            with self._lock:
+                self._matches[(method, rule)] = matches
+
+        return matches
+
+    # seconds the client has to wait before this request is allowed, 0 when it is allowed now. A token is only
+    # taken from the buckets when every one of them allows the request
+    def check(self, method, rule, ip, identity):
+        buckets = []
+
+        for key, scopes in self.matching(method, rule):
+            for scope, (rate, burst) in scopes.items():
+                client = ip if scope == 'ip' else identity
+
+                # anonymous requests only have the per IP limits
+                if client is not None:
+                    buckets.append(((key, scope, client), rate, burst))
+
+        return self.backend.acquire(buckets) if buckets else 0
+
+
+# QueuePool that knows how long its oldest waiting checkout has been waiting for a connection
+class TimedQueuePool(QueuePool):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._waiting = {}
+        self._tickets = count()
+        self._wait_lock = Lock()
+
+    def _do_get(self):
+        ticket = next(self._tickets)
+
+        with self._wait_lock:
+            self._waiting[ticket] = time.monotonic()
+
+        try:
+            return super()._do_get()
+        finally:
+            with self._wait_lock:
+                del self._waiting[ticket]
+
+    def oldest_wait(self):
+        with self._wait_lock:
+            return time.monotonic() - min(self._waiting.values()) if self._waiting else 0
+
+
+# sheds load before it piles up: new requests are refused while too many are in flight in this process
+# or while checkouts have been waiting too long for a database connection
+class AdmissionController:
+
+    def __init__(self, max_in_flight=0, max_pool_wait=None):
+        self.max_in_flight = max_in_flight
+        self.max_pool_wait = max_pool_wait
+        self.in_flight = 0
+        self._lock = Lock()
+
+    # True when the request is let in, it then has to be released
+    def admit(self, pools=()):
+        if self.max_pool_wait is not None:
+            for pool in pools:
+                if isinstance(pool, TimedQueuePool) and pool.oldest_wait() >= self.max_pool_wait:
+                    return False
+
+        with self._lock:
+            if self.max_in_flight and self.in_flight >= self.max_in_flight:
+                return False
+
+            self.in_flight += 1
+
+        return True
+
+    def release(self):
+        with self._lock:
+            self.in_flight -= 1
+
+
+def retry_after(seconds):
+    return str(max(1, math.ceil(seconds)))
+
+
+# identity of the request's token when it carries a valid one, a bad token is left for the route to refuse
+def request_identity():
+    try:
+        verify_jwt_in_request(optional=True)
+    except Exception:
+        return None
+
+    return get_jwt_identity()
+
+
+def init_rate_limits(app):
+    config = app.config
+
+    admission = app.extensions['admission'] = AdmissionController(
+        max_in_flight=config['ADMISSION_MAX_IN_FLIGHT'],
+        max_pool_wait=config['ADMISSION_MAX_POOL_WAIT']
+    )
+
+    limiter = None
+
+    if config['RATE_LIMITING']:
+        backend_class = import_string(config['RATE_LIMIT_BACKEND'])
+        limiter = app.extensions['rate_limiter'] = RateLimiter(
+            backend_class(maxsize=config['RATE_LIMIT_MAX_KEYS']), config['RATE_LIMITS']
+        )
+
+    # metrics stay reachable when the app is overloaded, that's when they're needed
+    exempt = {config['METRICS_PATH']}
+
+    @app.before_request
+    def admit_request():
+        if request.path in exempt:
+            return None
+
+        # looked up every time, disposing an engine replaces its pool
+        pools = [engine.pool for engine in db.engines.values()] if admission.max_pool_wait is not None else ()
+
+        if not admission.admit(pools):
+            return {'error': 'Service Unavailable'}, 503, {'Retry-After': retry_after(config['ADMISSION_RETRY_AFTER'])}
+
+        g.admitted = True
+
+        if limiter is None or request.url_rule is None or request.method == 'OPTIONS':
+            return None
+
+        matches = limiter.matching(request.method, request.url_rule.rule)
+
+        if not matches:
+            return None
+
+        # the token is only decoded for routes limited per identity, decoding is cached for the route itself
+        identity = request_identity() if any('identity' in scopes for _, scopes in matches) else None
+
+        wait = limiter.check(request.method, request.url_rule.rule, request.remote_addr, identity)
+
+        if wait:
+            return {'error': 'Too Many Requests'}, 429, {'Retry-After': retry_after(wait)}
+
+        return None
+
+    @app.teardown_request
+    def release_request(exception=None):
+        if g.pop('admitted', False):
+            admission.release()
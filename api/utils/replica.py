@@ -0,0 +1,149 @@
+import logging
+import time
+from functools import wraps
+from flask import current_app, has_app_context, request
+from flask_jwt_extended import get_jwt_identity
+from itsdangerous import BadSignature, Signer
+from sqlalchemy.exc import DBAPIError, OperationalError
+from . import db
+from .ratelimit import request_identity
+from .routing import REPLICA_BIND
+
+logger = logging.getLogger(__name__)
+
+WRITE_METHODS = ('POST', 'PUT', 'PATCH', 'DELETE')
+
+# where the client is handed the signed time of its last write and sends it back from: a cookie, or the
+# header for clients that don't keep cookies
+LAST_WRITE_COOKIE = 'last_write'
+LAST_WRITE_HEADER = 'X-Last-Write'
+
+
+# decides whether a read may go to the replica: not for a user who wrote less than sticky_seconds ago (the
+# replica may not have their write yet) and not while the replica is down. The time of a user's last write
+# travels with the client, signed with secret_key, so whichever worker process gets the next request knows
+# it. A replica read that fails to connect takes it out for retry_interval seconds, then the next read
+# tries it again
+class ReplicaRouter:
+
+    def __init__(self, secret_key, sticky_seconds=5, retry_interval=30, timer=time.monotonic, clock=time.time):
+        self.sticky_seconds = sticky_seconds
+        self.retry_interval = retry_interval
+        self.timer = timer
+        # wall clock time, the last write is compared across processes
+        self.clock = clock
+        self.signer = Signer(secret_key, salt='replica-last-write')
+        self._down_until = 0
+
+    @property
+    def healthy(self):
+        return self.timer() >= self._down_until
+
+    # the signed token of a write identity just made
+    def last_write(self, identity):
+        return self.signer.sign(f'{identity}|{self.clock():.3f}').decode()
+
+    # True when token says identity wrote less than sticky_seconds ago, tokens that are forged, malformed
+    # or someone else's count as no write
+    def wrote_recently(self, identity, token):
+        if identity is None or not token:
+            return False
+
+        try:
+            written_by, written_at = self.signer.unsign(token).decode().rsplit('|', 1)
+            written_at = float(written_at)
+        except (BadSignature, ValueError):
+            return False
+
+        return written_by == str(identity) and self.clock() - written_at < self.sticky_seconds
+
+    def use_replica(self, identity, token=None):
+        return self.healthy and not self.wrote_recently(identity, token)
+
+    def mark_down(self, error):
+        self._down_until = self.timer() + self.retry_interval
+
+        logger.warning('Read replica failed, reading from the primary for %ss: %s', self.retry_interval, error)
+
+
+# the replica is one more bind of db, given the primary's engine options so it is pooled the same way.
+# Called before db.init_app, does nothing unless REPLICA_DATABASE_URL is set
+def init_read_replica(app):
+    url = app.config['REPLICA_DATABASE_URL']
+
+    if not url:
+        return
+
+    binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+    binds[REPLICA_BIND] = dict(app.config.get('SQLALCHEMY_ENGINE_OPTIONS') or {}, url=url)
+
+    app.config['SQLALCHEMY_BINDS'] = binds
+
+    router = app.extensions['replica_router'] = ReplicaRouter(
+        app.config['SECRET_KEY'],
+        sticky_seconds=app.config['REPLICA_STICKY_SECONDS'],
+        retry_interval=app.config['REPLICA_RETRY_INTERVAL']
+    )
+
+    # a user's successful write sends their reads to the primary for a while
+    @app.after_request
+    def stick_to_primary(response):
+        if request.method in WRITE_METHODS and response.status_code < 400:
+            identity = request_identity()
+
+            if identity is not None:
+                token = router.last_write(identity)
+
+                response.headers[LAST_WRITE_HEADER] = token
+                response.set_cookie(
+                    LAST_WRITE_COOKIE, token, max_age=router.sticky_seconds,
+                    secure=request.is_secure, httponly=True, samesite='Lax'
+                )
+
+        return response
+
+
+# the last write token the client sent back, if any
+def request_last_write():
+    return request.headers.get(LAST_WRITE_HEADER) or request.cookies.get(LAST_WRITE_COOKIE)
+
+
+# errors that mean the replica couldn't be reached or couldn't answer, not that the query itself is wrong:
+# only these are worth running again on the primary
+def is_connection_error(error):
+    return error.connection_invalidated or isinstance(error, OperationalError)
+
+
+# True while the current view reads from the replica
+def reading_from_replica():
+    return has_app_context() and db.session().info.get('replica', False)
+
+
+# runs a read-only view on the replica when there is one and the user may read from it. A replica that can't
+# be reached is marked down and the view runs again on the primary, any other database error is raised as it
+# would be from the primary. Goes under jwt_required, the user is known by then
+def replica_reads(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        router = current_app.extensions.get('replica_router')
+
+        if router is None or not router.use_replica(get_jwt_identity(), request_last_write()):
+            return view(*args, **kwargs)
+
+        session = db.session()
+        session.info['replica'] = True
+
+        try:
+            return view(*args, **kwargs)
+        except DBAPIError as error:
+            if not is_connection_error(error):
+                raise
+
+            router.mark_down(error)
+            session.rollback()
+        finally:
+            session.info.pop('replica', None)
+
+        return view(*args, **kwargs)
+
+    return wrapper
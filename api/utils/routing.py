@@ -0,0 +1,19 @@
+from flask_sqlalchemy.session import Session
+from sqlalchemy.sql.dml import UpdateBase
+
+# bind key of the read replica in SQLALCHEMY_BINDS
+REPLICA_BIND = 'replica'
+
+
+# db.session sends reads to the replica while session.info['replica'] is set (see api.utils.replica.replica_reads),
+# flushes and INSERT/UPDATE/DELETE statements always go to the primary
+class RoutingSession(Session):
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and self.info.get('replica') and not self._flushing and not isinstance(clause, UpdateBase):
+            engine = self._db.engines.get(REPLICA_BIND)
+
+            if engine is not None:
+                return engine
+
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
@@ -0,0 +1,229 @@
+import argparse
+import gc
+import logging
+import os
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from flask.logging import default_handler
+from sqlalchemy.exc import SQLAlchemyError
+from werkzeug.serving import BaseWSGIServer, ThreadedWSGIServer, WSGIRequestHandler
+from . import db
+
+logger = logging.getLogger('api.server')
+
+
+# serves each connection on a bounded pool of threads, server_close() stops listening and then waits for the
+# requests already accepted to finish
+class PooledWSGIServer(BaseWSGIServer):
+    multithread = True
+
+    def __init__(self, host, port, app, threads, handler=None):
+        # created first, BaseWSGIServer calls server_close() itself when the port can't be bound
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='request')
+
+        super().__init__(host, port, app, handler)
+
+    def process_request(self, request, client_address):
+        self.executor.submit(self.process_request_thread, request, client_address)
+
+    def process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def server_close(self):
+        super().server_close()
+        self.executor.shutdown(wait=True)
+
+
+# one thread per connection like the threaded dev server, for many long-lived connections (SSE), except the
+# request threads are joined by server_close() instead of dying with the process
+class DrainingThreadedWSGIServer(ThreadedWSGIServer):
+    daemon_threads = False
+    block_on_close = True
+
+
+def make_app_server(app, host, port, threads, keepalive_timeout):
+    # idle keep-alive connections and clients stalling on a read or write give their thread back after this long
+    handler = type('RequestHandler', (WSGIRequestHandler,), {'timeout': keepalive_timeout or None})
+
+    if threads:
+        return PooledWSGIServer(host, port, app, threads, handler)
+
+    return DrainingThreadedWSGIServer(host, port, app, handler)
+
+
+# what the app keeps in each process that several worker processes would each have their own copy of: an order
+# changed through one worker stays cached by the others for up to ORDER_CACHE_TTL, event streams only get the
+# events of the worker they are connected to and every worker lets a client through its rate limits
+def per_process_state(app):
+    found = []
+
+    if not app.extensions['order_cache'].backend.shared:
+        found.append(f"ORDER_CACHE_BACKEND {app.config['ORDER_CACHE_BACKEND']}: orders changed through one worker are served stale by the others")
+
+    if not app.extensions['event_broker'].shared:
+        found.append(f"EVENT_BROKER {app.config['EVENT_BROKER']}: event streams miss the order changes made through other workers")
+
+    limiter = app.extensions.get('rate_limiter')
+
+    if limiter is not None and not limiter.backend.shared:
+        found.append(f"RATE_LIMIT_BACKEND {app.config['RATE_LIMIT_BACKEND']}: clients get each rate limit once per worker")
+
+    return found
+
+
+# stops accepting connections and ends the event streams, the requests still running are waited for by serve_forever()
+def stop_worker(app, server):
+    server.shutdown()
+    app.extensions['event_broker'].close()
+
+
+def run_worker(app, server, forked):
+    # the master process handles Ctrl-C and tells the workers to stop with SIGTERM
+    signal.signal(signal.SIGINT, signal.SIG_IGN if forked else lambda signum, frame: threading.Thread(target=stop_worker, args=(app, server)).start())
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=stop_worker, args=(app, server)).start())
+
+    # jobs queued before a restart run without waiting for a request
+    app.extensions['job_queue'].start()
+
+    server.serve_forever()
+
+    # every in-flight request is done, so are the running jobs, connections and helper processes can go
+    app.extensions['job_queue'].stop()
+
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose()
+
+    app.extensions['password_hasher'].shutdown()
+
+    logger.info('Worker %d stopped', os.getpid())
+
+
+def spawn_worker(app, server):
+    pid = os.fork()
+
+    if pid:
+        return pid
+
+    code = 0
+    try:
+        run_worker(app, server, forked=True)
+    except BaseException:
+        logger.exception('Worker %d failed', os.getpid())
+        code = 1
+    finally:
+        os._exit(code)
+
+
+# pre-fork server: the app is created once in the master process, which then forks workers sharing its memory
+# copy-on-write and its listening socket, restarts the ones that die and drains them all on SIGTERM/SIGINT
+def serve(app, host, port, workers, threads, graceful_timeout, keepalive_timeout=5):
+    server = make_app_server(app, host, port, threads, keepalive_timeout)
+
+    logger.info('Listening on http://%s:%d with %d workers of %s threads', host, server.port, workers, threads or 'unbounded')
+
+    if workers > 1:
+        for state in per_process_state(app):
+            logger.warning('Per-process state split across %d worker processes, %s', workers, state)
+
+    # the kitchen queue is read from the database once, before the workers are forked so they all inherit it.
+    # Without an orders table yet it's left to be loaded on first use
+    with app.app_context():
+        try:
+            app.extensions['kitchen_queue'].sync()
+        except SQLAlchemyError as error:
+            logger.warning('Kitchen queue not loaded: %s', error)
+
+    if workers <= 0:
+        run_worker(app, server, forked=False)
+        return
+
+    # connections opened while the app was created must not be shared by the workers
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose()
+
+    # objects created so far are never collected, so the collector doesn't write to the shared pages
+    gc.freeze()
+
+    stopping = threading.Event()
+
+    def stop(signum, frame):
+        stopping.set()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    children = set()
+
+    for _ in range(workers):
+        children.add(spawn_worker(app, server))
+
+    while not stopping.is_set():
+        pid, status = os.waitpid(-1, os.WNOHANG)
+
+        if not pid:
+            stopping.wait(0.2)
+            continue
+
+        children.discard(pid)
+        logger.warning('Worker %d exited with status %d, starting a new one', pid, status)
+
+        # a worker that dies on startup shouldn't turn into a fork loop
+        stopping.wait(1)
+
+        if not stopping.is_set():
+            children.add(spawn_worker(app, server))
+
+    for pid in children:
+        os.kill(pid, signal.SIGTERM)
+
+    deadline = time.monotonic() + graceful_timeout
+
+    while children and time.monotonic() < deadline:
+        pid, status = os.waitpid(-1, os.WNOHANG)
+
+        if pid:
+            children.discard(pid)
+        else:
+            time.sleep(0.05)
+
+    # whatever is still running after the graceful timeout is cut off
+    for pid in children:
+        logger.warning('Worker %d did not stop within %ss, killing it', pid, graceful_timeout)
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+
+    server.socket.close()
+
+
+# command line of serve.py, every option defaults to its SERVER_* setting
+def main(app, argv=None):
+    config = app.config
+
+    parser = argparse.ArgumentParser(description='Run the API under a multi-process, multi-threaded server')
+    parser.add_argument('--host', default=config['SERVER_HOST'])
+    parser.add_argument('--port', type=int, default=config['SERVER_PORT'])
+    parser.add_argument('--workers', type=int, default=config['SERVER_WORKERS'], help='worker processes, 0 serves from this process')
+    parser.add_argument('--threads', type=int, default=config['SERVER_THREADS'], help='request threads per worker, 0 for one per connection')
+    parser.add_argument('--graceful-timeout', type=float, default=config['SERVER_GRACEFUL_TIMEOUT'],
+                        help='seconds the workers get to finish their requests on shutdown')
+    parser.add_argument('--keepalive-timeout', type=float, default=config['SERVER_KEEPALIVE_TIMEOUT'])
+    args = parser.parse_args(argv)
+
+    # one handler on the root logger tagging lines with the worker's pid, instead of Flask's own on the app logger
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s [%(process)d] %(levelname)s %(name)s: %(message)s')
+    app.logger.removeHandler(default_handler)
+
+    # request lines are only logged when asked for
+    if not config['SERVER_ACCESS_LOG']:
+        logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    serve(app, args.host, args.port, args.workers, args.threads, args.graceful_timeout, args.keepalive_timeout)
@@ -0,0 +1,25 @@
+from sqlalchemy import event
+from . import db
+
+
+# runs the configured PRAGMAs on every connection the pool opens to a SQLite database, the replica's included
+def init_sqlite_pragmas(app):
+    pragmas = app.config.get('SQLITE_PRAGMAS')
+
+    if not pragmas:
+        return
+
+    with app.app_context():
+        engines = list(db.engines.values())
+
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+
+        cursor.close()
+
+    for engine in engines:
+        if engine.dialect.name == 'sqlite':
+            event.listen(engine, 'connect', set_sqlite_pragmas)
@@ -0,0 +1,99 @@
+# holds thousands of idle SSE connections open on one threaded worker, then measures memory per subscriber
+# and how long one published event takes to reach all of them
+# python -m benchmarks.event_subscribers --subscribers 2000
+import argparse
+import logging
+import os
+import selectors
+import socket
+import tempfile
+import threading
+import time
+from werkzeug.serving import make_server
+from flask_jwt_extended import create_access_token
+from api import create_app
+from api.config.config import config_dict
+from api.utils import db
+from api.models.users import User
+
+
+def rss_kb():
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test for idle order event subscribers')
+    parser.add_argument('--subscribers', type=int, default=2000)
+    args = parser.parse_args()
+
+    # connection threads only wait on a queue, a small stack is plenty
+    threading.stack_size(256 * 1024)
+
+    directory = tempfile.mkdtemp()
+
+    class BenchConfig(config_dict['test']):
+        SQLALCHEMY_ECHO = False
+        # a file so every server thread sees the same database
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(directory, 'db.sqlite3')
+        EVENT_KEEPALIVE = 60
+
+    app = create_app(config=BenchConfig)
+
+    with app.app_context():
+        db.create_all()
+        User(username='bench', email='bench@example.com', password_hash='hash').save()
+        token = create_access_token(identity='bench')
+
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    request = (
+        f"GET /orders/user/1/events HTTP/1.1\r\nHost: localhost\r\n"
+        f"Authorization: Bearer {token}\r\nAccept: text/event-stream\r\n\r\n"
+    ).encode()
+
+    selector = selectors.DefaultSelector()
+    baseline = rss_kb()
+    start = time.perf_counter()
+
+    for _ in range(args.subscribers):
+        connection = socket.create_connection(server.server_address)
+        connection.sendall(request)
+
+        # wait for the stream to open before the next client so the listen backlog never overflows
+        received = b''
+        while b'retry: 3000' not in received:
+            received += connection.recv(4096)
+
+        connection.setblocking(False)
+        selector.register(connection, selectors.EVENT_READ)
+
+    connected = time.perf_counter() - start
+    memory = rss_kb() - baseline
+    broker = app.extensions['event_broker']
+
+    print(f"subscribers connected:  {broker.subscriber_count()} in {connected:.1f}s")
+    print(f"RSS growth:             {memory / 1024:.1f} MiB ({memory / args.subscribers:.1f} KiB per subscriber)")
+
+    start = time.perf_counter()
+    broker.publish('user:1', {'action': 'update', 'id': 1, 'order_status': 'OrderStatus.IN_TRANSIT'})
+
+    pending = args.subscribers
+    while pending:
+        for key, _ in selector.select(timeout=10):
+            if b'event: order' in key.fileobj.recv(4096):
+                selector.unregister(key.fileobj)
+                pending -= 1
+
+    print(f"fan-out to everyone:    {(time.perf_counter() - start) * 1000:.1f} ms")
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
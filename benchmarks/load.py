@@ -0,0 +1,340 @@
+# load/benchmark suite for every API route
+#
+# seeds synthetic users and orders, drives each route (all but the long-lived SSE stream) through the Flask
+# test client and/or a threaded WSGI server, and reports p50/p95/p99 latency, throughput and peak RSS per route.
+# Results can be saved as a baseline (benchmarks/baselines/, one file per scale, kept per machine) and later
+# runs fail (exit code 1) when a route gets slower than the baseline by more than --threshold.
+#
+# python -m benchmarks.load --orders 1000000 --users 1000 --requests 200 --client both --save-baseline
+# python -m benchmarks.load --orders 1000000 --users 1000 --requests 200 --client both --compare
+import argparse
+import http.client
+import json
+import logging
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
+from werkzeug.serving import make_server
+from flask_jwt_extended import create_access_token, create_refresh_token
+from api import create_app
+from api.config.config import config_dict
+from api.utils import db
+from api.models.orders import Order, Sizes, OrderStatus
+from api.models.users import User
+
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'baselines')
+
+
+# what the routes need to build their requests: seeded ids, tokens and unique counters
+class Context:
+
+    def __init__(self, users, orders, headers, refresh_headers):
+        self.users = users
+        self.orders = orders
+        self.headers = headers
+        self.refresh_headers = refresh_headers
+        self._counter = count()
+        # orders reserved for the routes that consume them (delete, status transitions)
+        self._deletable = iter(range(orders, orders // 2, -1))
+        self._pending = iter(range(1, orders // 2))
+
+    def next(self):
+        return next(self._counter)
+
+    def deletable_order(self):
+        return next(self._deletable)
+
+    def pending_order(self):
+        return next(self._pending)
+
+    def order(self, i):
+        return i * 7919 % (self.orders // 2) + 1
+
+    def user(self, i):
+        return i * 31 % self.users + 1
+
+
+def order_body(i):
+    return {'size': list(Sizes)[i % len(Sizes)].name, 'quantity': i % 5 + 1, 'flavour': 'Mix'}
+
+
+# name, method, path(context, i), json body(context, i) and headers(context), one per route
+ROUTES = [
+    ('auth.signup', 'POST', lambda c, i: '/auth/signup',
+     lambda c, i: {'username': f'load{c.next()}', 'email': f'load{c.next()}@example.com', 'password': 'password'},
+     lambda c: {}),
+    ('auth.login', 'POST', lambda c, i: '/auth/login',
+     lambda c, i: {'email': f'user{c.user(i)}@example.com', 'password': 'password'},
+     lambda c: {}),
+    ('auth.refresh', 'POST', lambda c, i: '/auth/refresh', None, lambda c: c.refresh_headers),
+    ('orders.list', 'GET', lambda c, i: '/orders/orders?limit=50', None, lambda c: c.headers),
+    ('orders.list_filtered', 'GET', lambda c, i: '/orders/orders?order_status=PENDING&size=LARGE&limit=50', None,
+     lambda c: c.headers),
+    ('orders.stream', 'GET', lambda c, i: '/orders/orders/stream?limit=1000', None, lambda c: c.headers),
+    ('orders.create', 'POST', lambda c, i: '/orders/orders', lambda c, i: order_body(i), lambda c: c.headers),
+    ('orders.bulk_create', 'POST', lambda c, i: '/orders/orders/bulk',
+     lambda c, i: [order_body(i + n) for n in range(100)], lambda c: c.headers),
+    ('orders.stats', 'GET', lambda c, i: '/orders/stats?group_by=order_status,size', None, lambda c: c.headers),
+    ('orders.stats_adhoc', 'GET', lambda c, i: '/orders/stats?group_by=flavour&date_from=2000-01-01T00:30:00', None,
+     lambda c: c.headers),
+    ('orders.stats_funnel', 'GET', lambda c, i: '/orders/stats/funnel', None, lambda c: c.headers),
+    ('orders.stats_hourly', 'GET', lambda c, i: '/orders/stats/hourly', None, lambda c: c.headers),
+    ('orders.get', 'GET', lambda c, i: f'/orders/order/{c.order(i)}', None, lambda c: c.headers),
+    ('orders.update', 'PUT', lambda c, i: f'/orders/order/{c.order(i)}', lambda c, i: order_body(i),
+     lambda c: c.headers),
+    ('orders.delete', 'DELETE', lambda c, i: f'/orders/order/{c.deletable_order()}', None, lambda c: c.headers),
+    ('orders.user_order', 'GET', lambda c, i: f'/orders/user/{c.user(i)}/order/{c.order(i)}', None,
+     lambda c: c.headers),
+    ('orders.user_orders', 'GET', lambda c, i: f'/orders/user/{c.user(i)}/orders?limit=50', None,
+     lambda c: c.headers),
+    # a status only moves forward once, so every request gets a PENDING order of its own
+    ('orders.status', 'PATCH', lambda c, i: f'/orders/order/status/{c.pending_order()}',
+     lambda c, i: {'order_status': 'IN_TRANSIT'}, lambda c: c.headers),
+    ('orders.bulk_status', 'PATCH', lambda c, i: '/orders/order/status',
+     lambda c, i: {'order_status': 'IN_TRANSIT', 'ids': [c.pending_order() for _ in range(20)]},
+     lambda c: c.headers),
+    ('metrics', 'GET', lambda c, i: '/metrics', None, lambda c: {}),
+]
+
+
+def seed(app, users, orders):
+    with app.app_context():
+        db.create_all()
+
+        # one hash shared by every synthetic user, hashing thousands of passwords would dominate seeding
+        password_hash = app.extensions['password_hasher'].hash('password')
+
+        db.session.execute(db.insert(User), [
+            {'username': f'user{n}', 'email': f'user{n}@example.com', 'password_hash': password_hash,
+             'is_active': True}
+            for n in range(1, users + 1)
+        ])
+        db.session.commit()
+
+        sizes = list(Sizes)
+        statuses = list(OrderStatus)
+        batch = 50000
+
+        for start in range(0, orders, batch):
+            Order.bulk_insert([
+                {'size': sizes[n % len(sizes)], 'order_status': statuses[n % len(statuses)] if n > orders // 2 else OrderStatus.PENDING,
+                 'flavour': 'Mix', 'quantity': n % 5 + 1, 'customer': n % users + 1}
+                for n in range(start, min(start + batch, orders))
+            ], chunk_size=5000)
+
+        user = db.session.get(User, 1)
+        claims = {'user_id': user.id}
+
+        headers = {'Authorization': f'Bearer {create_access_token(identity=user.username, additional_claims=claims)}'}
+        refresh_headers = {'Authorization': f'Bearer {create_refresh_token(identity=user.username, additional_claims=claims)}'}
+
+    return Context(users, orders, headers, refresh_headers)
+
+
+def percentile(latencies, fraction):
+    ordered = sorted(latencies)
+
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def summarize(latencies, errors, wall):
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'p50_ms': percentile(latencies, 0.50) * 1000,
+        'p95_ms': percentile(latencies, 0.95) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'throughput_rps': len(latencies) / wall,
+    }
+
+
+# requests go straight into the WSGI app in this thread
+def run_test_client(app, context, route, requests):
+    name, method, path, body, headers = route
+    client = app.test_client()
+    latencies = []
+    errors = 0
+
+    start = time.perf_counter()
+
+    for i in range(requests):
+        kwargs = {'headers': headers(context)}
+        if body is not None:
+            kwargs['json'] = body(context, i)
+
+        request_start = time.perf_counter()
+        response = client.open(path(context, i), method=method, **kwargs)
+        response.get_data()
+        latencies.append(time.perf_counter() - request_start)
+
+        errors += response.status_code >= 400
+
+    return summarize(latencies, errors, time.perf_counter() - start)
+
+
+# requests go over HTTP to a threaded werkzeug server, from `concurrency` client threads with keep-alive connections
+def run_threaded(server, context, route, requests, concurrency):
+    name, method, path, body, headers = route
+    host, port = server.server_address
+    lock = threading.Lock()
+    counter = count()
+    latencies = []
+    errors = [0]
+
+    def worker():
+        connection = http.client.HTTPConnection(host, port)
+
+        while True:
+            i = next(counter)
+            if i >= requests:
+                break
+
+            with lock:
+                # the context counters are shared between client threads
+                url = path(context, i)
+                payload = json.dumps(body(context, i)) if body is not None else None
+
+            request_headers = dict(headers(context), **({'Content-Type': 'application/json'} if payload else {}))
+
+            request_start = time.perf_counter()
+            connection.request(method, url, body=payload, headers=request_headers)
+            response = connection.getresponse()
+            response.read()
+            elapsed = time.perf_counter() - request_start
+
+            with lock:
+                latencies.append(elapsed)
+                errors[0] += response.status >= 400
+
+        connection.close()
+
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for _ in range(concurrency):
+            executor.submit(worker)
+
+    return summarize(latencies, errors[0], time.perf_counter() - start)
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+
+    for key, result in results.items():
+        expected = baseline.get(key)
+
+        if expected is None:
+            continue
+
+        if result['p95_ms'] > expected['p95_ms'] * (1 + threshold):
+            regressions.append(f"{key}: p95 {result['p95_ms']:.1f} ms, baseline {expected['p95_ms']:.1f} ms")
+
+        if result['throughput_rps'] < expected['throughput_rps'] * (1 - threshold):
+            regressions.append(
+                f"{key}: {result['throughput_rps']:.0f} req/s, baseline {expected['throughput_rps']:.0f} req/s"
+            )
+
+    return regressions
+
+
+def run(users, orders, requests, client, concurrency, routes=None):
+    directory = tempfile.mkdtemp()
+
+    class LoadConfig(config_dict['test']):
+        SQLALCHEMY_ECHO = False
+        SLOW_QUERY_THRESHOLD = None
+        # a database file so the threaded server and the seeding share one database
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(directory, 'load.sqlite3')
+        SQLITE_PRAGMAS = config_dict['prod'].SQLITE_PRAGMAS
+
+    app = create_app(config=LoadConfig)
+    context = seed(app, users, orders)
+
+    selected = [route for route in ROUTES if routes is None or route[0] in routes]
+    results = {}
+
+    try:
+        if client in ('test', 'both'):
+            for route in selected:
+                results[f'test:{route[0]}'] = run_test_client(app, context, route, requests)
+
+        if client in ('threaded', 'both'):
+            logging.getLogger('werkzeug').setLevel(logging.ERROR)
+
+            server = make_server('127.0.0.1', 0, app, threaded=True)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+
+            try:
+                for route in selected:
+                    results[f'threaded:{route[0]}'] = run_threaded(server, context, route, requests, concurrency)
+            finally:
+                server.shutdown()
+    finally:
+        with app.app_context():
+            db.engine.dispose()
+
+        shutil.rmtree(directory, ignore_errors=True)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test every API route')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--orders', type=int, default=10000, help='synthetic orders seeded before the run')
+    parser.add_argument('--requests', type=int, default=100, help='requests per route')
+    parser.add_argument('--client', choices=['test', 'threaded', 'both'], default='both')
+    parser.add_argument('--concurrency', type=int, default=8, help='client threads for the threaded run')
+    parser.add_argument('--routes', nargs='+', help='only run these routes, e.g. orders.list auth.login')
+    parser.add_argument('--save-baseline', action='store_true', help='store the results as the baseline for this scale')
+    parser.add_argument('--compare', action='store_true', help='fail when a route regressed against the baseline')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed regression, 0.2 is 20%%')
+    args = parser.parse_args()
+
+    # the delete and status routes use up orders, each from their own half of the table
+    runs = 2 if args.client == 'both' else 1
+    if args.orders // 2 <= args.requests * 21 * runs:
+        parser.error('--orders is too small for the routes that consume orders, raise it or lower --requests')
+
+    results = run(args.users, args.orders, args.requests, args.client, args.concurrency, args.routes)
+
+    print(f"{'route':<32} {'req':>6} {'err':>5} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'req/s':>9}")
+    for key, result in results.items():
+        print(f"{key:<32} {result['requests']:>6} {result['errors']:>5} {result['p50_ms']:>9.2f} "
+              f"{result['p95_ms']:>9.2f} {result['p99_ms']:>9.2f} {result['throughput_rps']:>9.0f}")
+    print(f"peak RSS: {peak_rss_mb():.0f} MiB")
+
+    baseline_path = os.path.join(BASELINE_DIR, f'users{args.users}-orders{args.orders}.json')
+
+    if args.save_baseline:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+
+        with open(baseline_path, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2, sort_keys=True)
+
+        print(f"baseline saved to {baseline_path}")
+
+    if args.compare:
+        with open(baseline_path) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.threshold)
+
+        if regressions:
+            print('regressions:\n  ' + '\n  '.join(regressions))
+            sys.exit(1)
+
+        print('no regressions against the baseline')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,52 @@
+# logins per second per core for each password hashing cost
+# python -m benchmarks.password_hashing --costs 50000 150000 260000 --logins 50
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from api.auth.hashing import WerkzeugPasswordHasher
+
+
+def logins_per_second(hasher, password_hash, logins, threads):
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        results = list(executor.map(lambda _: hasher.verify(password_hash, 'password'), range(logins)))
+
+    assert all(results)
+
+    return logins / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Logins per second per core for each password hashing cost')
+    parser.add_argument('--costs', type=int, nargs='+', default=[50000, 150000, 260000, 600000],
+                        help='pbkdf2:sha256 iteration counts to measure')
+    parser.add_argument('--logins', type=int, default=50, help='logins measured per cost')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='size of the hashing process pool')
+    args = parser.parse_args()
+
+    print(f"{'method':<24} {'inline/core':>12} {'pool total':>12} {'pool/core':>12}")
+
+    for cost in args.costs:
+        method = f'pbkdf2:sha256:{cost}'
+
+        inline = WerkzeugPasswordHasher(method=method, workers=0)
+        pooled = WerkzeugPasswordHasher(method=method, workers=args.workers)
+
+        password_hash = inline.hash('password')
+
+        try:
+            # warm the pool up so process start-up isn't measured
+            pooled.verify(password_hash, 'password')
+
+            inline_rate = logins_per_second(inline, password_hash, args.logins, threads=1)
+            pooled_rate = logins_per_second(pooled, password_hash, args.logins, threads=args.workers * 2)
+        finally:
+            pooled.shutdown()
+
+        print(f"{method:<24} {inline_rate:>12.1f} {pooled_rate:>12.1f} {pooled_rate / args.workers:>12.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+# rows/sec of marshal_with(order_model) over ORM objects against the projected row serializer
+# python -m benchmarks.serializers --sizes 1000 10000 100000
+import argparse
+import time
+from flask_restx import marshal
+from api import create_app
+from api.config.config import config_dict
+from api.utils import db
+from api.utils.encoding import fast_dumps
+from api.models.orders import Order, Sizes, OrderStatus
+from api.orders.views import order_model
+from api.orders.serializers import order_rows, serialize_orders
+
+
+class BenchConfig(config_dict['test']):
+    SQLALCHEMY_ECHO = False
+
+
+def seed(count):
+    sizes = list(Sizes)
+    statuses = list(OrderStatus)
+
+    rows = [
+        {'size': sizes[i % len(sizes)], 'order_status': statuses[i % len(statuses)], 'flavour': 'Mix', 'quantity': i % 5 + 1}
+        for i in range(count)
+    ]
+
+    Order.bulk_insert(rows, chunk_size=5000)
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare order serialization throughput')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    args = parser.parse_args()
+
+    print(f"{'orders':>8} {'marshal rows/s':>16} {'fast rows/s':>14} {'speedup':>8} {'fast+orjson rows/s':>20}")
+
+    for size in args.sizes:
+        app = create_app(config=BenchConfig)
+
+        with app.app_context():
+            db.create_all()
+            seed(size)
+            db.session.expunge_all()
+
+            # warm up statement compilation so the first size isn't penalised
+            marshal(Order.query.limit(10).all(), order_model)
+            serialize_orders(order_rows().limit(10).all())
+            db.session.expunge_all()
+
+            marshalled, marshal_time = timed(lambda: marshal(Order.query.all(), order_model))
+            db.session.expunge_all()
+
+            serialized, fast_time = timed(lambda: serialize_orders(order_rows().all()))
+
+            # the benchmark is only meaningful if both paths agree
+            assert marshalled == serialized
+
+            _, encoded_time = timed(lambda: fast_dumps(serialize_orders(order_rows().all())))
+
+            db.drop_all()
+
+        print(f"{size:>8} {size / marshal_time:>16.0f} {size / fast_time:>14.0f} {marshal_time / fast_time:>7.1f}x {size / encoded_time:>20.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,139 @@
+# throughput of serve.py against the development runner (runserver.py, app.run(debug=True))
+#
+# seeds a SQLite file, starts each server as its own process on that file with the production settings
+# (FLASK_CONFIG=prod, WAL), drives a few read and write routes from benchmarks.load with concurrent keep-alive
+# clients and reports req/s and latency per server and route.
+#
+# python -m benchmarks.servers --workers 4 --threads 16 --concurrency 32
+#
+# 1 CPU machine, 10,000 orders, 2,000 requests per route, 16 client threads, serve.py with 2 workers x 8 threads:
+#
+#   server         route              req/s   p50 ms   p99 ms
+#   runserver      orders.list          192    83.41   120.28
+#   runserver      orders.create        181    21.50  1161.50
+#   runserver      orders.get           355    44.28    70.19
+#   runserver      metrics              675    23.68    36.26
+#   serve.py       orders.list          192    77.09   196.97
+#   serve.py       orders.create        188    29.53  1044.33
+#   serve.py       orders.get           431    34.46    90.18
+#   serve.py       metrics              981    15.88    40.16
+#
+# on a single core the extra process adds no CPU, the gain on the cheap routes comes from the debugger middleware
+# being off and from not starting a thread per connection; orders.list is bound by the query and orders.create by
+# SQLite's single writer (the p99 is the busy_timeout wait) under both. With more cores the workers run Python in
+# parallel where runserver's one process is held to one core by the GIL
+import argparse
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+from api import create_app
+from api.config.config import config_dict
+from api.utils import db
+from .load import ROUTES, seed, run_threaded
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+# read and write routes that don't use up the seeded orders
+BENCHMARK_ROUTES = ('orders.get', 'orders.list', 'orders.create', 'metrics')
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_until_listening(process, port, timeout=30):
+    deadline = time.monotonic() + timeout
+
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'server exited with status {process.returncode}')
+
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+
+    raise RuntimeError(f'server did not listen on {port} within {timeout}s')
+
+
+def server_commands(port, workers, threads):
+    return {
+        # what runserver.py does, minus the reloader's extra process
+        'runserver': [sys.executable, '-c',
+                      f'from runserver import app; app.run(debug=True, use_reloader=False, port={port})'],
+        'serve.py': [sys.executable, 'serve.py', '--host', '127.0.0.1', '--port', str(port),
+                     '--workers', str(workers), '--threads', str(threads)],
+    }
+
+
+def run(users, orders, requests, concurrency, workers, threads):
+    directory = tempfile.mkdtemp()
+    database = 'sqlite:///' + os.path.join(directory, 'servers.sqlite3')
+
+    class SeedConfig(config_dict['test']):
+        SQLALCHEMY_ECHO = False
+        SQLALCHEMY_DATABASE_URI = database
+        SQLITE_PRAGMAS = config_dict['prod'].SQLITE_PRAGMAS
+
+    app = create_app(config=SeedConfig)
+    context = seed(app, users, orders)
+
+    with app.app_context():
+        db.engine.dispose()
+
+    # one client identity sends every request, far past the production rate limits
+    env = dict(os.environ, FLASK_CONFIG='prod', DATABASE_URL=database, SLOW_QUERY_THRESHOLD='', RATE_LIMITING='False')
+    routes = [route for route in ROUTES if route[0] in BENCHMARK_ROUTES]
+    results = []
+
+    try:
+        port = free_port()
+
+        for name, command in server_commands(port, workers, threads).items():
+            process = subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+            try:
+                wait_until_listening(process, port)
+
+                server = SimpleNamespace(server_address=('127.0.0.1', port))
+
+                for route in routes:
+                    results.append((name, route[0], run_threaded(server, context, route, requests, concurrency)))
+            finally:
+                process.send_signal(signal.SIGTERM)
+                process.wait(timeout=60)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare serve.py with the development runner')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--orders', type=int, default=10000)
+    parser.add_argument('--requests', type=int, default=2000, help='requests per route and server')
+    parser.add_argument('--concurrency', type=int, default=16, help='client threads')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='serve.py worker processes')
+    parser.add_argument('--threads', type=int, default=8, help='serve.py threads per worker')
+    args = parser.parse_args()
+
+    results = run(args.users, args.orders, args.requests, args.concurrency, args.workers, args.threads)
+
+    print(f"{'server':<14} {'route':<16} {'req':>6} {'err':>5} {'req/s':>8} {'p50 ms':>8} {'p99 ms':>8}")
+    for server, route, result in results:
+        print(f"{server:<14} {route:<16} {result['requests']:>6} {result['errors']:>5} "
+              f"{result['throughput_rps']:>8.0f} {result['p50_ms']:>8.2f} {result['p99_ms']:>8.2f}")
+
+
+if __name__ == '__main__':
+    main()
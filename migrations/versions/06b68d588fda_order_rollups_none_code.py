@@ -0,0 +1,60 @@
+"""order rollups none code
+
+Revision ID: 06b68d588fda
+Revises: a2982ae2adae
+Create Date: 2026-10-19 09:12:37.418206
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '06b68d588fda'
+down_revision = 'a2982ae2adae'
+branch_labels = None
+depends_on = None
+
+# the code a missing size, flavour or status is stored as, ROLLUP_NONE_CODE of api/models/rollups.py
+NONE_CODE = 0
+
+BUCKET_COLUMNS = ('size', 'flavour', 'order_status')
+
+
+# the rollups are emptied and recomputed from the orders and the archived orders, the upserts made while the
+# bucket columns held NULLs may have split a bucket over several rows
+def rebuild_rollups(bucket):
+    if op.get_bind().dialect.name == 'sqlite':
+        hour = "strftime('%Y-%m-%d %H:00:00.000000', date_created)"
+    else:
+        hour = "date_trunc('hour', date_created)"
+
+    columns = ', '.join(bucket(name) for name in BUCKET_COLUMNS)
+
+    op.execute("DELETE FROM order_rollups")
+    op.execute(
+        f"INSERT INTO order_rollups (hour, size, flavour, order_status, orders, quantity) "
+        f"SELECT {hour}, {columns}, count(id), coalesce(sum(quantity), 0) "
+        f"FROM (SELECT id, date_created, size, flavour, order_status, quantity FROM orders "
+        f"UNION ALL SELECT id, date_created, size, flavour, order_status, quantity FROM orders_archive) AS order_history "
+        f"WHERE date_created IS NOT NULL "
+        f"GROUP BY {hour}, {columns}"
+    )
+
+
+def upgrade():
+    op.execute("DELETE FROM order_rollups")
+
+    with op.batch_alter_table('order_rollups', schema=None) as batch_op:
+        for name in BUCKET_COLUMNS:
+            batch_op.alter_column(name, existing_type=sa.SmallInteger(), nullable=False)
+
+    rebuild_rollups(lambda name: f"coalesce({name}, {NONE_CODE})")
+
+
+def downgrade():
+    with op.batch_alter_table('order_rollups', schema=None) as batch_op:
+        for name in BUCKET_COLUMNS:
+            batch_op.alter_column(name, existing_type=sa.SmallInteger(), nullable=True)
+
+    rebuild_rollups(lambda name: name)
@@ -0,0 +1,29 @@
+"""activate existing users
+
+Revision ID: 9ea770770efc
+Revises: 5eae4798a39f
+Create Date: 2026-10-18 17:49:19.960471
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9ea770770efc'
+down_revision = '5eae4798a39f'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # is_active is enforced from now on. Until now it was never set: every user was stored with the old default
+    # (False) and nothing could activate or deactivate anyone, so no existing row is a deliberate deactivation.
+    # Every existing user is activated, only users deactivated after this revision stay off
+    users = sa.table('users', sa.column('is_active', sa.Boolean()))
+
+    op.execute(users.update().where(sa.or_(users.c.is_active.is_(None), users.c.is_active == sa.false())).values(is_active=True))
+
+
+def downgrade():
+    pass
@@ -0,0 +1,54 @@
+"""orders autoincrement
+
+Revision ID: a2982ae2adae
+Revises: ee9ea7289896
+Create Date: 2026-10-18 19:40:12.503114
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a2982ae2adae'
+down_revision = 'ee9ea7289896'
+branch_labels = None
+depends_on = None
+
+
+# SQLite only takes AUTOINCREMENT when the table is created, so orders is copied into a new one. The partial
+# indexes are dropped and created again around the copy so their WHERE clauses are kept as they are
+def recreate_orders(autoincrement):
+    with op.batch_alter_table('orders', schema=None) as batch_op:
+        batch_op.drop_index('ix_orders_pending_date_created', sqlite_where=sa.text('order_status = 3'))
+        batch_op.drop_index('ix_orders_in_transit_date_created', sqlite_where=sa.text('order_status = 2'))
+
+    with op.batch_alter_table('orders', schema=None, recreate='always', table_kwargs={'sqlite_autoincrement': autoincrement}) as batch_op:
+        pass
+
+    with op.batch_alter_table('orders', schema=None) as batch_op:
+        batch_op.create_index('ix_orders_in_transit_date_created', ['date_created', 'id'], unique=False, sqlite_where=sa.text('order_status = 2'))
+        batch_op.create_index('ix_orders_pending_date_created', ['date_created', 'id'], unique=False, sqlite_where=sa.text('order_status = 3'))
+
+
+def upgrade():
+    # a serial column never hands an id out twice, only SQLite needs the change
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+
+    recreate_orders(True)
+
+    # the copy starts the sequence at the largest id left in orders, ids of orders archived since aren't
+    # handed out again either
+    op.execute("DELETE FROM sqlite_sequence WHERE name = 'orders'")
+    op.execute(
+        "INSERT INTO sqlite_sequence (name, seq) VALUES ('orders', max("
+        "(SELECT coalesce(max(id), 0) FROM orders), (SELECT coalesce(max(id), 0) FROM orders_archive)))"
+    )
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+
+    recreate_orders(False)
@@ -0,0 +1,187 @@
+"""order attribute codes
+
+Revision ID: df235e994734
+Revises: 0c685f3b2906
+Create Date: 2026-10-18 18:52:41.218337
+
+"""
+import logging
+from alembic import op
+import sqlalchemy as sa
+
+logger = logging.getLogger('alembic.env')
+
+
+# revision identifiers, used by Alembic.
+revision = 'df235e994734'
+down_revision = '0c685f3b2906'
+branch_labels = None
+depends_on = None
+
+# the lookup tables of api/models/orders.py as they were when this migration was written
+SIZE_CODES = {'EXTRA_LARGE': 1, 'LARGE': 2, 'MEDIUM': 3, 'SMALL': 4}
+ORDER_STATUS_CODES = {'DELIVERED': 1, 'IN_TRANSIT': 2, 'PENDING': 3}
+FLAVOUR_CODES = {'chicken': 1, 'mix': 2, 'pepperroni': 3, 'pork': 4}
+
+# flavours were free text, these are the spellings of each one that are converted (compared in lower case):
+# the name, the value and str() of the enum member, which the model's default used to store
+FLAVOUR_SPELLINGS = {
+    'chicken': ('chicken', 'orderflavour.chicken'),
+    'mix': ('mix', 'orderflavour.mix'),
+    'pepperroni': ('pepperroni', 'pepperoni', 'orderflavour.pepperoni'),
+    'pork': ('pork', 'orderflavour.pork'),
+}
+# a flavour that is none of these (e.g. 'Onion', flavours used to be free text) becomes the model's default
+FALLBACK_FLAVOUR = 'mix'
+
+ORDER_TABLES = ('orders', 'orders_archive')
+
+
+def literal(value):
+    return f"'{value}'" if isinstance(value, str) else str(value)
+
+
+# CASE expression mapping the values of column, names to codes or back
+def case(column, mapping):
+    whens = ' '.join(f"WHEN {literal(old)} THEN {literal(new)}" for old, new in mapping.items())
+
+    return f"CASE {column} {whens} END"
+
+
+def flavour_case(column):
+    whens = ' '.join(
+        f"WHEN '{spelling}' THEN {FLAVOUR_CODES[flavour]}"
+        for flavour, spellings in FLAVOUR_SPELLINGS.items() for spelling in spellings
+    )
+
+    return f"CASE lower(trim({column})) {whens} ELSE {FLAVOUR_CODES[FALLBACK_FLAVOUR]} END"
+
+
+def rebuild_rollups():
+    # the rollups count every order placed, so they are recomputed from the orders and the archived orders,
+    # flavours spelled differently before now fall in the same bucket
+    if op.get_bind().dialect.name == 'sqlite':
+        hour = "strftime('%Y-%m-%d %H:00:00.000000', date_created)"
+    else:
+        hour = "date_trunc('hour', date_created)"
+
+    op.execute(
+        f"INSERT INTO order_rollups (hour, size, flavour, order_status, orders, quantity) "
+        f"SELECT {hour}, size, flavour, order_status, count(id), coalesce(sum(quantity), 0) "
+        f"FROM (SELECT id, date_created, size, flavour, order_status, quantity FROM orders "
+        f"UNION ALL SELECT id, date_created, size, flavour, order_status, quantity FROM orders_archive) AS order_history "
+        f"WHERE date_created IS NOT NULL "
+        f"GROUP BY {hour}, size, flavour, order_status"
+    )
+
+
+def replace_columns(table, columns, indexes=(), unique=None):
+    # the new columns are filled next to the old ones, then take their names
+    with op.batch_alter_table(table, schema=None) as batch_op:
+        for name, (type_, _, _) in columns.items():
+            batch_op.add_column(sa.Column(f'{name}_new', type_, nullable=True))
+
+    if columns:
+        op.execute(f"UPDATE {table} SET " + ', '.join(f"{name}_new = {expression}" for name, (_, expression, _) in columns.items()))
+
+    with op.batch_alter_table(table, schema=None) as batch_op:
+        if unique is not None:
+            batch_op.drop_constraint(unique, type_='unique')
+
+        for name in indexes:
+            batch_op.drop_index(name)
+
+        for name in columns:
+            batch_op.drop_column(name)
+
+        for name, (type_, _, nullable) in columns.items():
+            batch_op.alter_column(f'{name}_new', new_column_name=name, existing_type=type_, nullable=nullable)
+
+
+def upgrade():
+    # a flavour that isn't one of OrderFlavour can't be coded, those orders are rewritten to FALLBACK_FLAVOUR
+    spellings = [spelling for values in FLAVOUR_SPELLINGS.values() for spelling in values]
+
+    for table in ORDER_TABLES:
+        unknown = op.get_bind().execute(
+            sa.text(f"SELECT flavour, count(*) FROM {table} WHERE lower(trim(flavour)) NOT IN :spellings GROUP BY flavour")
+            .bindparams(sa.bindparam('spellings', expanding=True)),
+            {'spellings': spellings}
+        ).all()
+
+        if unknown:
+            logger.warning(
+                "%s: %d rows with flavours that are not one of OrderFlavour rewritten to '%s': %s", table,
+                sum(count for _, count in unknown), FALLBACK_FLAVOUR, ', '.join(f"'{flavour}' ({count})" for flavour, count in unknown)
+            )
+
+    for table in ORDER_TABLES:
+        replace_columns(table, {
+            'size': (sa.SmallInteger(), case('size', SIZE_CODES), True),
+            'order_status': (sa.SmallInteger(), case('order_status', ORDER_STATUS_CODES), True),
+            'flavour': (sa.SmallInteger(), flavour_case('flavour'), False),
+        }, indexes=('ix_orders_status_date_created',) if table == 'orders' else ())
+
+    with op.batch_alter_table('orders', schema=None) as batch_op:
+        batch_op.create_index('ix_orders_date_created_id', ['date_created', 'id'], unique=False)
+        batch_op.create_index('ix_orders_in_transit_date_created', ['date_created', 'id'], unique=False, sqlite_where=sa.text('order_status = 2'), postgresql_where=sa.text('order_status = 2'))
+        batch_op.create_index('ix_orders_pending_date_created', ['date_created', 'id'], unique=False, sqlite_where=sa.text('order_status = 3'), postgresql_where=sa.text('order_status = 3'))
+
+    # the rollups are emptied and recomputed from the converted orders, their old values aren't converted
+    op.execute("DELETE FROM order_rollups")
+
+    replace_columns('order_rollups', {
+        'size': (sa.SmallInteger(), 'NULL', True),
+        'flavour': (sa.SmallInteger(), 'NULL', True),
+        'order_status': (sa.SmallInteger(), 'NULL', True),
+    }, unique='uq_order_rollups_bucket')
+
+    with op.batch_alter_table('order_rollups', schema=None) as batch_op:
+        batch_op.create_unique_constraint('uq_order_rollups_bucket', ['hour', 'size', 'flavour', 'order_status'])
+
+    rebuild_rollups()
+
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute("DROP TYPE IF EXISTS sizes")
+        op.execute("DROP TYPE IF EXISTS orderstatus")
+
+
+def downgrade():
+    sizes = sa.Enum('SMALL', 'MEDIUM', 'LARGE', 'EXTRA_LARGE', name='sizes')
+    statuses = sa.Enum('PENDING', 'IN_TRANSIT', 'DELIVERED', name='orderstatus')
+
+    if op.get_bind().dialect.name == 'postgresql':
+        sizes.create(op.get_bind(), checkfirst=True)
+        statuses.create(op.get_bind(), checkfirst=True)
+
+    def names(codes):
+        return {code: name for name, code in codes.items()}
+
+    with op.batch_alter_table('orders', schema=None) as batch_op:
+        batch_op.drop_index('ix_orders_pending_date_created', sqlite_where=sa.text('order_status = 3'), postgresql_where=sa.text('order_status = 3'))
+        batch_op.drop_index('ix_orders_in_transit_date_created', sqlite_where=sa.text('order_status = 2'), postgresql_where=sa.text('order_status = 2'))
+        batch_op.drop_index('ix_orders_date_created_id')
+
+    for table in ORDER_TABLES:
+        replace_columns(table, {
+            'size': (sizes, case('size', names(SIZE_CODES)), True),
+            'order_status': (statuses, case('order_status', names(ORDER_STATUS_CODES)), True),
+            'flavour': (sa.String(), case('flavour', names(FLAVOUR_CODES)), False),
+        })
+
+    with op.batch_alter_table('orders', schema=None) as batch_op:
+        batch_op.create_index('ix_orders_status_date_created', ['order_status', 'date_created'], unique=False)
+
+    # the rollups are emptied and recomputed from the converted orders, their old values aren't converted
+    op.execute("DELETE FROM order_rollups")
+
+    replace_columns('order_rollups', {
+        'size': (sizes, 'NULL', True),
+        'flavour': (sa.String(), 'NULL', True),
+        'order_status': (statuses, 'NULL', True),
+    }, unique='uq_order_rollups_bucket')
+
+    with op.batch_alter_table('order_rollups', schema=None) as batch_op:
+        batch_op.create_unique_constraint('uq_order_rollups_bucket', ['hour', 'size', 'flavour', 'order_status'])
+
+    rebuild_rollups()
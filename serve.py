@@ -0,0 +1,9 @@
+from api import create_app
+from api.utils.server import main
+
+# loaded once here, the worker processes are forked from this process and share it
+app = create_app()
+
+# python serve.py --workers 4 --threads 16, FLASK_CONFIG=prod for the production settings
+if __name__ == "__main__":
+    main(app)